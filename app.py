@@ -13,60 +13,74 @@
 
 import os
 import sys
-import json
+import queue
 import logging
-from slack_bolt import App
-from slack_bolt.adapter.flask import SlackRequestHandler
-from atlassian import Jira
-from atlassian import Confluence
-from flask import Flask, request, Response
-from require_api_key import require_api_key
-from google.cloud import secretmanager
+from flask import Flask, request, Response, jsonify
+from libs import context
+from libs.auth import require_api_key
 from libs.jira_activities import publish_agenda
 from libs.jira_activities import publish_adr
 from libs.jira_activities import scorecard_tasks_by_user
 from libs.events import event_catcher
-from libs.connect_connector import connect_with_connector
-from libs.connect_tcp import connect_tcp_socket
+from libs.events import bulk_event_catcher
+from libs.event_analytics import event_summary
+from libs.event_analytics import ensure_events_schema
+from libs.event_analytics import rebuild_rollups
+from libs.event_spool import ensure_spool_schema
+from libs.idempotency import idempotent
+from libs.idempotency import adr_request_key
+from libs.idempotency import event_request_key
+from libs.idempotency import ensure_idempotency_schema
+from libs.message_ledger import ensure_ledger_schema
+from libs.jira_mirror import ensure_mirror_schema
+from libs.jira_mirror import sync_mirror
+from libs.confluence_ingest import ensure_confluence_schema
+from libs.confluence_ingest import ingest_confluence
+from libs.adr_digest import ensure_digest_schema
+from libs.adr_digest import flush_digests
+from libs.slack_commands import register_commands
+from libs.jobs import submit_job
+from libs.jobs import get_job
+from libs.jira_cache import CachedJira
+from libs.channel_router import ValueStreamRouter
+from libs.resilience import Guarded
+from libs.http_pool import PooledWebClient
+from libs.http_pool import pooled_session
+from libs.metrics import instrument_flask
+from libs.metrics import instrument_engine
+from libs.metrics import metrics_response
 
 
 # Establish some basic logging functionality.
 logging.basicConfig(level=logging.DEBUG)
 logging.getLogger().addHandler(logging.StreamHandler(sys.stderr))
 
-# Initalise the connection to Secrets Manager
-secrets_client = secretmanager.SecretManagerServiceClient()
-
-# The link to the secrets, originates from Github Secrets
-SECRET_REF          = os.environ['SECRET_REF']
-
-# Connect to Google Secrets Manager and return the data
-secret_data_raw     = secrets_client.access_secret_version(request={"name": SECRET_REF})
-secret_decoded      = secret_data_raw.payload.data.decode("UTF-8")
-secrets_data        = json.loads(secret_decoded)
-
-# Connect to Slack
-app = App(
-    signing_secret=secrets_data['SLACK_SIGNING_SECRET'],
-    token=secrets_data['SLACK_BOT_TOKEN'])
-
-# Define some friendlier, more usable variables from the returned secrets_data json
-API_KEY                     = secrets_data['API_KEY']
-ATLASSIAN_API_ROOT          = secrets_data['CREDENTIALS']['ATLASSIAN']['API_ROOT']
-ATLASSIAN_JIRA_USER         = secrets_data['CREDENTIALS']['ATLASSIAN']['JIRA']['USERNAME']
-ATLASSIAN_JIRA_PASS         = secrets_data['CREDENTIALS']['ATLASSIAN']['JIRA']['PASSWORD']
-ATLASSIAN_CONFLUENCE_USER   = secrets_data['CREDENTIALS']['ATLASSIAN']['CONFLUENCE']['PASSWORD']
-ATLASSIAN_CONFLUENCE_PASS   = secrets_data['CREDENTIALS']['ATLASSIAN']['CONFLUENCE']['PASSWORD']
-JIRA_SEARCH_FILTER          = str(secrets_data['JIRA_SEARCH_FILTER'])
-SLACK_CHANNEL               = secrets_data['PRIMARY_SLACK_CHANNEL']
-SLACK_CHANNEL_MAP           = secrets_data['SLACK_CHANNEL_MAP']
-AA_SLACK_CHANNEL            = secrets_data['PRIMARY_SLACK_CHANNEL'] # Tenporary
-DB_TYPE                     = secrets_data['DB_CONFIG']['DB_TYPE']
-DB_HOST                     = secrets_data['DB_CONFIG']['DB_HOST']
-DB_PORT                     = secrets_data['DB_CONFIG']['DB_PORT']
-DB_USER                     = secrets_data['DB_CONFIG']['DB_USER']
-DB_PASS                     = secrets_data['DB_CONFIG']['DB_PASS']
-DB_DATABASE                 = secrets_data['DB_CONFIG']['DB_DATABASE']
+# How long the payload from Secrets Manager is cached for, in seconds
+SECRETS_TTL                 = float(os.environ.get('SECRETS_TTL', '300'))
+
+# Define some friendlier, more usable names for the values in the secrets_data
+# json. These are looked up when they are used (see __getattr__ at the end of
+# this module) so importing the app never waits on Secrets Manager.
+SECRET_SETTINGS             = {
+    "SLACK_SIGNING_SECRET": ("SLACK_SIGNING_SECRET",),
+    "SLACK_BOT_TOKEN": ("SLACK_BOT_TOKEN",),
+    "API_KEY": ("API_KEY",),
+    "ATLASSIAN_API_ROOT": ("CREDENTIALS", "ATLASSIAN", "API_ROOT"),
+    "ATLASSIAN_JIRA_USER": ("CREDENTIALS", "ATLASSIAN", "JIRA", "USERNAME"),
+    "ATLASSIAN_JIRA_PASS": ("CREDENTIALS", "ATLASSIAN", "JIRA", "PASSWORD"),
+    "ATLASSIAN_CONFLUENCE_USER": ("CREDENTIALS", "ATLASSIAN", "CONFLUENCE", "USERNAME"),
+    "ATLASSIAN_CONFLUENCE_PASS": ("CREDENTIALS", "ATLASSIAN", "CONFLUENCE", "PASSWORD"),
+    "JIRA_SEARCH_FILTER": ("JIRA_SEARCH_FILTER",),
+    "SLACK_CHANNEL": ("PRIMARY_SLACK_CHANNEL",),
+    "SLACK_CHANNEL_MAP": ("SLACK_CHANNEL_MAP",),
+    "AA_SLACK_CHANNEL": ("PRIMARY_SLACK_CHANNEL",), # Tenporary
+    "DB_TYPE": ("DB_CONFIG", "DB_TYPE"),
+    "DB_HOST": ("DB_CONFIG", "DB_HOST"),
+    "DB_PORT": ("DB_CONFIG", "DB_PORT"),
+    "DB_USER": ("DB_CONFIG", "DB_USER"),
+    "DB_PASS": ("DB_CONFIG", "DB_PASS"),
+    "DB_DATABASE": ("DB_CONFIG", "DB_DATABASE")
+}
 SCORECARD_MAP               = [
     {
         "filter_id": "11131",
@@ -82,33 +96,269 @@ SCORECARD_MAP               = [
     }        
 ]
 
-# Establish basic Database Connectivity.
-if DB_TYPE == "local":
-    print("Establishing Local DB Connection")
-    db = connect_tcp_socket()
+# Background job tuning, these are not secrets so live in the environment.
+JOB_WORKERS                 = int(os.environ.get('JOB_WORKERS', '4'))
+JOB_QUEUE_SIZE              = int(os.environ.get('JOB_QUEUE_SIZE', '100'))
+JOB_HISTORY_SIZE            = int(os.environ.get('JOB_HISTORY_SIZE', '500'))
+
+# The number of jobs run at once under asgi.py, where they wait on I/O rather than threads
+ASYNC_JOB_CONCURRENCY       = int(os.environ.get('ASYNC_JOB_CONCURRENCY', '200'))
+
+# Event buffering, events are written in batches by size or by interval
+EVENT_BUFFER_SIZE           = int(os.environ.get('EVENT_BUFFER_SIZE', '10000'))
+EVENT_BATCH_SIZE            = int(os.environ.get('EVENT_BATCH_SIZE', '500'))
+EVENT_FLUSH_INTERVAL        = float(os.environ.get('EVENT_FLUSH_INTERVAL', '1.0'))
+EVENT_ENQUEUE_TIMEOUT       = float(os.environ.get('EVENT_ENQUEUE_TIMEOUT', '0.5'))
+
+# Bulk uploads to /events/<source_system>/bulk are written EVENT_BULK_BATCH_SIZE
+# events at a time. Lines over EVENT_BULK_MAX_LINE bytes are rejected, and the
+# first EVENT_BULK_ERROR_LIMIT rejections are described in the response.
+EVENT_BULK_BATCH_SIZE       = int(os.environ.get('EVENT_BULK_BATCH_SIZE', '1000'))
+EVENT_BULK_MAX_LINE         = int(os.environ.get('EVENT_BULK_MAX_LINE', '65536'))
+EVENT_BULK_ERROR_LIMIT      = int(os.environ.get('EVENT_BULK_ERROR_LIMIT', '100'))
+
+# Setting EVENT_SPOOL_DIR spools events to local disk rather than the in-memory
+# buffer, see libs/event_spool.py. A new segment file is started every
+# EVENT_SPOOL_SEGMENT_BYTES, and events are replayed EVENT_BULK_BATCH_SIZE at a time.
+# Events over EVENT_SPOOL_MAX_EVENT_BYTES are refused with HTTP 413, and once a
+# process has EVENT_SPOOL_MAX_BYTES on disk further events are refused with HTTP 503.
+EVENT_SPOOL_DIR             = os.environ.get('EVENT_SPOOL_DIR', '')
+EVENT_SPOOL_SEGMENT_BYTES   = int(os.environ.get('EVENT_SPOOL_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+EVENT_SPOOL_MAX_EVENT_BYTES = int(os.environ.get('EVENT_SPOOL_MAX_EVENT_BYTES', '65536'))
+EVENT_SPOOL_MAX_BYTES       = int(os.environ.get('EVENT_SPOOL_MAX_BYTES', str(1024 * 1024 * 1024)))
+
+# Caching of JIRA issue and JQL lookups
+JIRA_CACHE_SIZE             = int(os.environ.get('JIRA_CACHE_SIZE', '1000'))
+JIRA_CACHE_TTL              = float(os.environ.get('JIRA_CACHE_TTL', '60'))
+
+# The number of scorecard filters run against JIRA at the same time
+SCORECARD_CONCURRENCY       = int(os.environ.get('SCORECARD_CONCURRENCY', '4'))
+
+# The number of issues requested per page of JQL results
+JIRA_PAGE_SIZE              = int(os.environ.get('JIRA_PAGE_SIZE', '100'))
+
+# How long, in seconds, repeated webhooks are recognised for, and how many
+# responses each instance keeps in memory.
+IDEMPOTENCY_TTL             = int(os.environ.get('IDEMPOTENCY_TTL', '600'))
+IDEMPOTENCY_CACHE_SIZE      = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '10000'))
+
+# The number of value-stream channels an ADR is posted to at the same time
+ADR_FANOUT_CONCURRENCY      = int(os.environ.get('ADR_FANOUT_CONCURRENCY', '8'))
+
+# Setting ADR_DIGEST_WINDOW, in seconds, collects published ADRs into one
+# message per channel posted when the window closes, e.g. 600 for ten minutes
+ADR_DIGEST_WINDOW           = float(os.environ.get('ADR_DIGEST_WINDOW', '0'))
+
+# The local mirror of the agenda and scorecard filters, JIRA_MIRROR=0 searches
+# JIRA directly instead. Ages are in seconds, a publish syncs a filter first if
+# its mirror is older than JIRA_MIRROR_MAX_AGE and changes are looked for
+# JIRA_MIRROR_OVERLAP further back than the last sync.
+JIRA_MIRROR                 = os.environ.get('JIRA_MIRROR', '1') == '1'
+JIRA_MIRROR_MAX_AGE         = float(os.environ.get('JIRA_MIRROR_MAX_AGE', '300'))
+JIRA_MIRROR_RECONCILE       = float(os.environ.get('JIRA_MIRROR_RECONCILE', '3600'))
+JIRA_MIRROR_OVERLAP         = float(os.environ.get('JIRA_MIRROR_OVERLAP', '120'))
+
+# The /adr slash command, which searches an index of the ADRs matching
+# ADR_INDEX_JQL that's refreshed every ADR_INDEX_REFRESH seconds
+ADR_COMMAND                 = os.environ.get('ADR_COMMAND', '/adr')
+ADR_INDEX_JQL               = os.environ.get('ADR_INDEX_JQL', 'cf[10241] is not EMPTY')
+ADR_INDEX_REFRESH           = float(os.environ.get('ADR_INDEX_REFRESH', '300'))
+ADR_SEARCH_LIMIT            = int(os.environ.get('ADR_SEARCH_LIMIT', '10'))
+
+# Deadlines, in seconds, for each request to JIRA, Confluence and Slack, and
+# the most requests each may have in flight before further calls fail fast.
+# BREAKER_FAILURES failures in a row stop calls to a dependency for
+# BREAKER_RESET seconds, see libs/resilience.py
+JIRA_TIMEOUT                = int(os.environ.get('JIRA_TIMEOUT', '30'))
+CONFLUENCE_TIMEOUT          = int(os.environ.get('CONFLUENCE_TIMEOUT', '30'))
+SLACK_TIMEOUT               = int(os.environ.get('SLACK_TIMEOUT', '10'))
+DEPENDENCY_CONCURRENCY      = {
+    "jira": int(os.environ.get('JIRA_CONCURRENCY', '16')),
+    "confluence": int(os.environ.get('CONFLUENCE_CONCURRENCY', '4')),
+    "slack": int(os.environ.get('SLACK_CONCURRENCY', '16'))
+}
+BULKHEAD_WAIT               = float(os.environ.get('BULKHEAD_WAIT', '5'))
+BREAKER_FAILURES            = int(os.environ.get('BREAKER_FAILURES', '5'))
+BREAKER_RESET               = float(os.environ.get('BREAKER_RESET', '30'))
+
+# Idle keep-alive connections kept for each upstream host, HTTP_POOL_SIZES
+# overrides this for individual hosts, e.g. "slack.com=32,example.atlassian.net=8"
+HTTP_POOL_SIZE              = int(os.environ.get('HTTP_POOL_SIZE', '16'))
+HTTP_POOL_SIZES             = {
+    host.strip(): int(size)
+    for host, _, size in (entry.partition("=") for entry in os.environ.get('HTTP_POOL_SIZES', '').split(",") if entry)
+}
+
+# The Confluence space fed through document_tools.evaluate_document, listed
+# CONFLUENCE_PAGE_SIZE pages at a time. Changed pages are fetched by
+# CONFLUENCE_WORKERS threads and split into chunks of at most
+# CONFLUENCE_CHUNK_SIZE characters, which EVALUATION_WORKERS threads evaluate.
+# Ingestion stays off until evaluate_document is implemented, CONFLUENCE_INGEST=1
+# switches it on.
+CONFLUENCE_INGEST           = os.environ.get('CONFLUENCE_INGEST', '0') == '1'
+CONFLUENCE_SPACE            = os.environ.get('CONFLUENCE_SPACE', '')
+CONFLUENCE_PAGE_SIZE        = int(os.environ.get('CONFLUENCE_PAGE_SIZE', '100'))
+CONFLUENCE_CHUNK_SIZE       = int(os.environ.get('CONFLUENCE_CHUNK_SIZE', '4000'))
+CONFLUENCE_WORKERS          = int(os.environ.get('CONFLUENCE_WORKERS', '4'))
+EVALUATION_WORKERS          = int(os.environ.get('EVALUATION_WORKERS', '4'))
+
+def secret_setting(name):
+    """
+    Looks up one of the SECRET_SETTINGS in the cached secrets_data json.
+    """
+    value = context.get_secrets(SECRETS_TTL)
+    for key in SECRET_SETTINGS[name]:
+        value = value[key]
+
+    return value
+
+def _create_slack_app():
+    """
+    Connects to Slack.
+    """
+    from slack_bolt import App
+
+    # Calls share keep-alive connections rather than each opening its own
+    bolt_app = App(
+        signing_secret=secret_setting("SLACK_SIGNING_SECRET"),
+        client=PooledWebClient(token=secret_setting("SLACK_BOT_TOKEN"), timeout=SLACK_TIMEOUT)
+    )
+
+    # Listen for the slash commands, e.g. /adr
+    register_commands(bolt_app)
+
+    return bolt_app
+
+def _create_slack_handler():
+    """
+    SlackRequestHandler translates WSGI requests to Bolt's interface
+    """
+    from slack_bolt.adapter.flask import SlackRequestHandler
+
+    return SlackRequestHandler(context.get("app"))
+
+def _create_db():
+    """
+    Establish basic Database Connectivity.
+    """
+    db_type = secret_setting("DB_TYPE")
+
+    if db_type == "local":
+        from libs.connect_tcp import connect_tcp_socket
+        print("Establishing Local DB Connection")
+        db = connect_tcp_socket()
 
-elif DB_TYPE == "cloudsql":
-    print("Establishing CloudSQL DB Connection")
-    db = connect_with_connector()
+    elif db_type == "cloudsql":
+        from libs.connect_connector import connect_with_connector
+        print("Establishing CloudSQL DB Connection")
+        db = connect_with_connector()
 
+    else:
+        raise ValueError(f"Unknown DB_TYPE: {db_type}")
 
-# Make a basic connection to JIRA & Confluence
-jira        =   Jira(
-                    url=ATLASSIAN_API_ROOT,
-                    username=ATLASSIAN_JIRA_USER,
-                    password=ATLASSIAN_JIRA_PASS
-                )
-confluence  =   Confluence(
-                    url=ATLASSIAN_API_ROOT,
-                    username=ATLASSIAN_CONFLUENCE_USER,
-                    password=ATLASSIAN_CONFLUENCE_PASS
-                )
+    # Time statements and pool checkouts for /metrics
+    instrument_engine(db)
+
+    # Make sure the events tables, rollups, indexes and idempotency keys exist
+    ensure_events_schema(db)
+    ensure_spool_schema(db)
+    ensure_idempotency_schema(db)
+    ensure_ledger_schema(db)
+    ensure_mirror_schema(db)
+    ensure_confluence_schema(db)
+    ensure_digest_schema(db)
+
+    return db
+
+def _create_jira():
+    """
+    Make a basic connection to JIRA, lookups are cached and those which
+    miss the cache are guarded by a bulkhead and circuit breaker.
+    """
+    from atlassian import Jira
+
+    return CachedJira(
+        Guarded(
+            Jira(
+                url=secret_setting("ATLASSIAN_API_ROOT"),
+                username=secret_setting("ATLASSIAN_JIRA_USER"),
+                password=secret_setting("ATLASSIAN_JIRA_PASS"),
+                timeout=JIRA_TIMEOUT,
+                session=pooled_session(secret_setting("ATLASSIAN_API_ROOT"))
+            ),
+            "jira"
+        ),
+        max_entries=JIRA_CACHE_SIZE,
+        ttl=JIRA_CACHE_TTL
+    )
+
+def _create_confluence():
+    """
+    Make a basic connection to Confluence, guarded as for JIRA.
+    """
+    from atlassian import Confluence
+
+    return Guarded(
+        Confluence(
+            url=secret_setting("ATLASSIAN_API_ROOT"),
+            username=secret_setting("ATLASSIAN_CONFLUENCE_USER"),
+            password=secret_setting("ATLASSIAN_CONFLUENCE_PASS"),
+            timeout=CONFLUENCE_TIMEOUT,
+            session=pooled_session(secret_setting("ATLASSIAN_API_ROOT"))
+        ),
+        "confluence"
+    )
+
+def _create_channel_router():
+    """
+    Builds the value-stream to Slack channel lookup. SLACK_CHANNEL_ALIASES is
+    optional in the secrets and maps alternative names to value-streams.
+    """
+    return ValueStreamRouter(
+        secret_setting("SLACK_CHANNEL_MAP"),
+        default_channel=secret_setting("SLACK_CHANNEL"),
+        aliases=context.get_secrets(SECRETS_TTL).get("SLACK_CHANNEL_ALIASES", {})
+    )
+
+# Each dependency is created the first time something asks for it
+context.register("app", _create_slack_app)
+context.register("slack_handler", _create_slack_handler)
+context.register("db", _create_db)
+context.register("jira", _create_jira)
+context.register("confluence", _create_confluence)
+context.register("channel_router", _create_channel_router)
 
 # Initialise Flask to handle other inbound webhooks and requests
 flask_app = Flask(__name__)
 
-# SlackRequestHandler translates WSGI requests to Bolt's interface
-handler = SlackRequestHandler(app)
+# Time every request, by route, for /metrics
+instrument_flask(flask_app)
+
+# Events spooled, and ADR digests queued, by an earlier worker are picked up
+# when gunicorn starts this one, see gunicorn.conf.py
+
+def accept_job(name, func, *args):
+    """
+    Queues a function as a background job and builds the response for
+    the caller, so that webhooks are answered without waiting on Slack
+    or JIRA.
+
+    Returns:
+    HTTP 202 + Job details, or HTTP 503 if the queue is full
+    """
+
+    try:
+        job = submit_job(name, func, *args)
+
+    except queue.Full:
+
+        return Response("Job Queue Full", status=503, mimetype='text/plain', headers={"Retry-After": "30"})
+
+    response = jsonify({"job_id": job.job_id, "status_url": f"/jobs/{job.job_id}"})
+    response.status_code = 202
+    response.headers["Location"] = f"/jobs/{job.job_id}"
+
+    return response
 
 # Establish a route for inbound Slack events
 @flask_app.route("/slack/events", methods=["POST"])
@@ -117,10 +367,11 @@ def slack_events():
     The default handler for registered slack events which runs
     the apps default dispatch method.
     """
-    return handler.handle(request)
+    return context.get("slack_handler").handle(request)
 
 @flask_app.route("/tda/agenda/publish", methods=["POST"])
-@require_api_key(key=API_KEY)
+@require_api_key
+@idempotent()
 def flask_publish_agenda():
     """
     Triggers the creation of the TDA agenda
@@ -129,29 +380,38 @@ def flask_publish_agenda():
     None: Authenticating with API Key + POST triggers this end point.
 
     Returns:
-    HTTP 201 + OK
+    HTTP 202 + Job details
     """
 
-    return publish_agenda()
+    return accept_job("publish_agenda", publish_agenda)
 
 @flask_app.route("/artefact/adr/publish", methods=["POST"])
-@require_api_key(key=API_KEY)
+@require_api_key
+@idempotent(adr_request_key)
 def flask_publish_adr():
     """
     Triggers the common function for sharing details of the ADR.
 
     Args: 
     request.json['key'] - The JIRA key for the ADR 
+    request.json['updated'] - Optional, the issue's updated time to skip a cache revalidation
+    request.json['status'] - Optional, used with the key to recognise repeated deliveries
 
     Returns:
-    HTTP 201 + "OK"
+    HTTP 202 + Job details, or HTTP 400 if no key is provided
     """
 
-    return publish_adr()
+    # Validate up-front, as the job runs outside of this request
+    request_data = request.get_json(silent=True)
+    if not isinstance(request_data, dict) or not isinstance(request_data.get('key'), str):
+        return Response("Missing Key", status=400, mimetype='text/plain')
+
+    return accept_job("publish_adr", publish_adr, request_data['key'], request_data.get('updated'))
 
 #  A route to deal with inbound web-hooks from Confluence and JIRA.
 @flask_app.route("/events/<source_system>", methods=["POST"])
-@require_api_key(key=API_KEY)
+@require_api_key
+@idempotent(event_request_key, local_only=True)
 def flask_event_catcher(source_system):
     """
     A relatively generic end-point for storing 'event' data into the database. 
@@ -164,15 +424,71 @@ def flask_event_catcher(source_system):
     }
 
     Returns:
-    HTTP 201 + "OK"
+    HTTP 202 + "Accepted", HTTP 400 + {"errors": [...]} if validation fails,
+    HTTP 413 if the event is too large for the spool, or HTTP 503 if the
+    event buffer or spool is full
 
     """
 
     return event_catcher(source_system)
 
+# A route for backfills, taking many events per request as newline-delimited JSON
+@flask_app.route("/events/<source_system>/bulk", methods=["POST"])
+@require_api_key
+def flask_bulk_event_catcher(source_system):
+    """
+    Stores one event per line of the request body, as it's received.
+
+    Args:
+    source_system: From URL / Flask Route
+    Body: {"contributor": ..., "event_type": ...} on each line
+
+    Returns:
+    HTTP 200 + {lines, accepted, rejected, errors}, or HTTP 503 +
+    resume_from_line if the database couldn't be written to
+    """
+
+    return bulk_event_catcher(source_system)
+
+# A route to report on the events captured above, served from the rollup tables
+@flask_app.route("/events/summary", methods=["GET"])
+@require_api_key
+def flask_event_summary():
+    """
+    Provides grouped counts of events, e.g. per contributor per week per source system.
+
+    Args:
+    granularity, group_by, from, to, source_system, contributor, event_type,
+    limit, after: From the query string, see libs/event_analytics.event_summary
+
+    Returns:
+    HTTP 200 + {"rows": [...], "next": cursor}, or HTTP 400 for bad arguments
+    """
+
+    return event_summary()
+
+# A route to recalculate the rollups behind /events/summary from the events table
+@flask_app.route("/events/rollups/rebuild", methods=["POST"])
+@require_api_key
+@idempotent()
+def flask_event_rollups_rebuild():
+    """
+    Recalculates the hourly and daily rollups, for use once after they are
+    first introduced.
+
+    Args:
+    None: Authenticating with API Key + POST triggers this end point.
+
+    Returns:
+    HTTP 202 + Job details
+    """
+
+    return accept_job("rebuild_rollups", rebuild_rollups)
+
 #  A route to deal with inbound web-hooks to trigger the execution and display of a query
 @flask_app.route("/scorecard/summary", methods=["POST"])
-@require_api_key(key=API_KEY)
+@require_api_key
+@idempotent()
 def flask_scorecard_summary():
     """
     Provides a summary of a teams achievements against the corporate scorecard.
@@ -181,10 +497,140 @@ def flask_scorecard_summary():
     filter_id: From URL / Flask Route 
 
     Returns:
-    HTTP 201 + "OK"
+    HTTP 202 + Job details
+    """
+
+    return accept_job("scorecard_tasks_by_user", scorecard_tasks_by_user)
+
+# A route for a scheduler to keep the JIRA mirror up to date between publishes
+@flask_app.route("/jira/mirror/sync", methods=["POST"])
+@require_api_key
+@idempotent()
+def flask_jira_mirror_sync():
+    """
+    Fetches the agenda and scorecard issues changed since the last sync.
+
+    Args:
+    None: Authenticating with API Key + POST triggers this end point.
+
+    Returns:
+    HTTP 202 + Job details
+    """
+
+    return accept_job("sync_jira_mirror", sync_mirror)
+
+# A route for a scheduler to post ADR digests whose window has closed, for
+# when instances are idle and their own flusher isn't running
+@flask_app.route("/artefact/adr/digest/flush", methods=["POST"])
+@require_api_key
+@idempotent()
+def flask_adr_digest_flush():
+    """
+    Posts the ADR digest for each channel whose window has closed.
+
+    Args:
+    None: Authenticating with API Key + POST triggers this end point.
+
+    Returns:
+    HTTP 202 + Job details
+    """
+
+    return accept_job("flush_adr_digests", flush_digests)
+
+# A route for a scheduler to feed changed Confluence pages to evaluate_document
+@flask_app.route("/confluence/ingest", methods=["POST"])
+@require_api_key
+@idempotent()
+def flask_confluence_ingest():
+    """
+    Evaluates the pages of a Confluence space which have changed since the last run.
+
+    Args:
+    request.json['space'] - Optional, the space key. Defaults to CONFLUENCE_SPACE
+
+    Returns:
+    HTTP 202 + Job details, HTTP 400 if no space is given, or HTTP 501 if
+    CONFLUENCE_INGEST is off
+    """
+
+    if not CONFLUENCE_INGEST:
+        return Response("Confluence Ingestion Disabled", status=501, mimetype='text/plain')
+
+    request_data = request.get_json(silent=True) or {}
+    space_key = request_data.get('space') or CONFLUENCE_SPACE
+
+    if not space_key:
+        return Response("No Confluence Space", status=400, mimetype='text/plain')
+
+    return accept_job("ingest_confluence", ingest_confluence, space_key)
+
+# A route to report on the progress of the background jobs started above
+@flask_app.route("/jobs/<job_id>", methods=["GET"])
+@require_api_key
+def flask_job_status(job_id):
+    """
+    Reports the state and progress of a queued publishing job.
+
+    Args:
+    job_id: From URL / Flask Route
+
+    Returns:
+    HTTP 200 + Job details, or HTTP 404 if the job is unknown
     """
 
-    return scorecard_tasks_by_user()
+    job = get_job(job_id)
+    if job is None:
+        return Response("Unknown Job", status=404, mimetype='text/plain')
+
+    return jsonify(job.to_dict())
+
+# A route for JIRA automations to drop cached data about an issue which has changed
+@flask_app.route("/cache/jira/invalidate", methods=["POST"])
+@require_api_key
+def flask_jira_cache_invalidate():
+    """
+    Removes an issue, and any cached searches containing it, from the JIRA cache.
+
+    Args:
+    request.json['key'] - Optional, the JIRA key to drop. Everything is dropped if omitted.
+
+    Returns:
+    HTTP 200 + The number of entries dropped
+    """
+
+    request_data = request.get_json(silent=True) or {}
+
+    return jsonify({"invalidated": context.get("jira").invalidate(request_data.get('key'))})
+
+@flask_app.route("/cache/jira/stats", methods=["GET"])
+@require_api_key
+def flask_jira_cache_stats():
+    """
+    Reports the hit / miss counters for the JIRA cache.
+
+    Args:
+    None
+
+    Returns:
+    HTTP 200 + Cache counters
+    """
+
+    return jsonify(context.get("jira").stats())
+
+# Latency histograms and pool usage for Prometheus, per gunicorn worker
+@flask_app.route("/metrics", methods=["GET"])
+def flask_metrics():
+    """
+    Serves the counters and histograms gathered in libs/metrics.py
+
+    Args:
+    None
+
+    Returns:
+    HTTP 200 + Metrics in the Prometheus text format
+    """
+
+    return metrics_response()
 
 # A simple health-check to validate that the service is at least running
 # and somewhat operational
@@ -202,6 +648,20 @@ def flask_health_check():
 
     return Response("Health-Check-OK", status=200, mimetype='text/plain')
 
+def __getattr__(name):
+    """
+    Resolves the settings held in Secrets Manager, and the dependencies in
+    the application context, when they are first used. This keeps the
+    app.NAME interface used by the libs without doing any work at import.
+    """
+    if name in SECRET_SETTINGS:
+        return secret_setting(name)
+
+    if context.is_registered(name):
+        return context.get(name)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 # Start Flask
 if __name__ == '__main__':
 
@@ -0,0 +1,324 @@
+"""
+    asgi.py -   An asyncio entry point for ArchiBot, serving the same
+                routes as app.py from a single event loop. Slack is
+                reached through Bolt's AsyncApp and AsyncWebClient, JIRA
+                through aiohttp and the database through aiomysql, so a
+                publish waiting on the network costs a coroutine rather
+                than a worker thread.
+
+                Settings and secrets are shared with app.py, which
+                remains the entry point for gunicorn's sync workers.
+
+                Run with uvicorn asgi:asgi_app --host 0.0.0.0 --port 8080
+"""
+
+import queue
+import contextlib
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.routing import Route
+from starlette.responses import Response, JSONResponse, PlainTextResponse
+import app
+from libs import context
+from libs.auth import require_api_key_async
+from libs.async_activities import publish_agenda_async
+from libs.async_activities import publish_adr_async
+from libs.async_activities import scorecard_tasks_by_user_async
+from libs.events import event_catcher_async
+from libs.events import bulk_event_catcher_async
+from libs.events import get_async_event_buffer
+from libs.events import resume_event_spool
+from libs.event_analytics import event_summary_async
+from libs.event_analytics import rebuild_rollups_async
+from libs.idempotency import idempotent_async
+from libs.idempotency import adr_request_key_async
+from libs.idempotency import event_request_key_async
+from libs.jobs import submit_job_async
+from libs.jobs import get_job
+from libs.jira_cache import AsyncCachedJira
+from libs.resilience import Guarded
+from libs.jira_mirror import sync_mirror_async
+from libs.confluence_ingest import ingest_confluence_async
+from libs.adr_digest import flush_digests_async
+from libs.adr_digest import start_flusher_async
+from libs.adr_digest import stop_flusher_async
+from libs.slack_commands import register_commands_async
+from libs.metrics import RequestMetricsMiddleware
+from libs.metrics import render as render_metrics
+from libs.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+
+def _create_async_slack_app():
+    """
+    Connects to Slack with Bolt's asyncio App.
+    """
+    import aiohttp
+    from slack_bolt.async_app import AsyncApp
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    # Without a session AsyncWebClient opens a new one, and a new connection, per call
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=app.HTTP_POOL_SIZES.get("slack.com", app.HTTP_POOL_SIZE))
+    )
+
+    bolt_app = AsyncApp(
+        signing_secret=app.SLACK_SIGNING_SECRET,
+        client=AsyncWebClient(token=app.SLACK_BOT_TOKEN, timeout=app.SLACK_TIMEOUT, session=session)
+    )
+    register_commands_async(bolt_app)
+
+    return bolt_app
+
+def _create_async_slack_handler():
+    """
+    AsyncSlackRequestHandler translates Starlette requests to Bolt's interface
+    """
+    from slack_bolt.adapter.starlette.async_handler import AsyncSlackRequestHandler
+
+    return AsyncSlackRequestHandler(context.get("async_app"))
+
+def _create_async_db():
+    """
+    Establish asyncio Database Connectivity.
+    """
+    from libs.async_db import connect_async
+
+    return connect_async()
+
+def _create_async_jira():
+    """
+    Make an asyncio connection to JIRA, lookups are cached and guarded as in app.py
+    """
+    from libs.async_jira import AsyncJira
+
+    return AsyncCachedJira(
+        Guarded(
+            AsyncJira(
+                url=app.ATLASSIAN_API_ROOT,
+                username=app.ATLASSIAN_JIRA_USER,
+                password=app.ATLASSIAN_JIRA_PASS,
+                timeout=app.JIRA_TIMEOUT
+            ),
+            "jira"
+        ),
+        max_entries=app.JIRA_CACHE_SIZE,
+        ttl=app.JIRA_CACHE_TTL
+    )
+
+# The asyncio dependencies sit alongside those of app.py, e.g. app.async_jira
+context.register("async_app", _create_async_slack_app)
+context.register("async_slack_handler", _create_async_slack_handler)
+context.register("async_db", _create_async_db)
+context.register("async_jira", _create_async_jira)
+
+def accept_job(name, func, *args):
+    """
+    Starts a coroutine as a background job, see app.accept_job
+
+    Returns:
+    HTTP 202 + Job details, or HTTP 503 if too many jobs are waiting
+    """
+
+    try:
+        job = submit_job_async(name, func, *args)
+
+    except queue.Full:
+
+        return PlainTextResponse("Job Queue Full", status_code=503, headers={"Retry-After": "30"})
+
+    return JSONResponse(
+        {"job_id": job.job_id, "status_url": f"/jobs/{job.job_id}"},
+        status_code=202,
+        headers={"Location": f"/jobs/{job.job_id}"}
+    )
+
+async def slack_events(request):
+    """
+    The default handler for registered slack events.
+    """
+    return await context.get("async_slack_handler").handle(request)
+
+@require_api_key_async
+@idempotent_async()
+async def publish_agenda(_request):
+    """
+    Triggers the creation of the TDA agenda, see app.flask_publish_agenda
+    """
+    return accept_job("publish_agenda", publish_agenda_async)
+
+@require_api_key_async
+@idempotent_async(adr_request_key_async)
+async def publish_adr(request):
+    """
+    Triggers the sharing of an ADR, see app.flask_publish_adr
+    """
+    try:
+        request_data = await request.json()
+    except ValueError:
+        request_data = None
+
+    if not isinstance(request_data, dict) or not isinstance(request_data.get('key'), str):
+        return PlainTextResponse("Missing Key", status_code=400)
+
+    return accept_job("publish_adr", publish_adr_async, request_data['key'], request_data.get('updated'))
+
+@require_api_key_async
+@idempotent_async(event_request_key_async, local_only=True)
+async def event_catcher(request):
+    """
+    Stores 'event' data into the database, see app.flask_event_catcher
+    """
+    return await event_catcher_async(request, request.path_params["source_system"])
+
+@require_api_key_async
+async def bulk_event_catcher(request):
+    """
+    Stores newline-delimited JSON events as they're received, see app.flask_bulk_event_catcher
+    """
+    return await bulk_event_catcher_async(request, request.path_params["source_system"])
+
+@require_api_key_async
+async def event_summary(request):
+    """
+    Provides grouped counts of events, see app.flask_event_summary
+    """
+    return await event_summary_async(request)
+
+@require_api_key_async
+@idempotent_async()
+async def event_rollups_rebuild(_request):
+    """
+    Recalculates the rollups behind /events/summary, see app.flask_event_rollups_rebuild
+    """
+    return accept_job("rebuild_rollups", rebuild_rollups_async)
+
+@require_api_key_async
+@idempotent_async()
+async def scorecard_summary(_request):
+    """
+    Provides a summary of achievements against the scorecard, see app.flask_scorecard_summary
+    """
+    return accept_job("scorecard_tasks_by_user", scorecard_tasks_by_user_async)
+
+@require_api_key_async
+@idempotent_async()
+async def jira_mirror_sync(_request):
+    """
+    Fetches the agenda and scorecard issues changed since the last sync, see app.flask_jira_mirror_sync
+    """
+    return accept_job("sync_jira_mirror", sync_mirror_async)
+
+@require_api_key_async
+@idempotent_async()
+async def adr_digest_flush(_request):
+    """
+    Posts the ADR digests whose window has closed, see app.flask_adr_digest_flush
+    """
+    return accept_job("flush_adr_digests", flush_digests_async)
+
+@require_api_key_async
+@idempotent_async()
+async def confluence_ingest(request):
+    """
+    Evaluates the Confluence pages changed since the last run, see app.flask_confluence_ingest
+    """
+    if not app.CONFLUENCE_INGEST:
+        return PlainTextResponse("Confluence Ingestion Disabled", status_code=501)
+
+    try:
+        request_data = await request.json()
+    except ValueError:
+        request_data = None
+
+    space_key = (request_data.get('space') if isinstance(request_data, dict) else None) or app.CONFLUENCE_SPACE
+
+    if not space_key:
+        return PlainTextResponse("No Confluence Space", status_code=400)
+
+    return accept_job("ingest_confluence", ingest_confluence_async, space_key)
+
+@require_api_key_async
+async def job_status(request):
+    """
+    Reports the state and progress of a publishing job.
+    """
+    job = get_job(request.path_params["job_id"])
+    if job is None:
+        return PlainTextResponse("Unknown Job", status_code=404)
+
+    return JSONResponse(job.to_dict())
+
+@require_api_key_async
+async def jira_cache_invalidate(request):
+    """
+    Removes an issue, or everything, from the JIRA cache.
+    """
+    try:
+        request_data = await request.json()
+    except ValueError:
+        request_data = None
+
+    key = request_data.get('key') if isinstance(request_data, dict) else None
+
+    return JSONResponse({"invalidated": context.get("async_jira").invalidate(key)})
+
+@require_api_key_async
+async def jira_cache_stats(_request):
+    """
+    Reports the hit / miss counters for the JIRA cache.
+    """
+    return JSONResponse(context.get("async_jira").stats())
+
+async def metrics(_request):
+    """
+    Serves the metrics gathered in libs/metrics.py
+    """
+    return Response(render_metrics(), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+async def health_check(_request):
+    """
+    A trivial health-check to ensure the app is running.
+    """
+    return PlainTextResponse("Health-Check-OK")
+
+@contextlib.asynccontextmanager
+async def lifespan(_asgi_app):
+    """
+    Replays any spooled events, and posts queued ADR digests, from startup.
+    Writes any buffered events, and closes the JIRA and Slack connections,
+    at shutdown.
+    """
+    resume_event_spool()
+    start_flusher_async()
+
+    yield
+
+    await stop_flusher_async()
+    await get_async_event_buffer().close()
+
+    if context.is_created("async_jira"):
+        await context.get("async_jira").close()
+
+    if context.is_created("async_app") and context.get("async_app").client.session is not None:
+        await context.get("async_app").client.session.close()
+
+routes = [
+    Route("/slack/events", slack_events, methods=["POST"]),
+    Route("/tda/agenda/publish", publish_agenda, methods=["POST"]),
+    Route("/artefact/adr/publish", publish_adr, methods=["POST"]),
+    Route("/artefact/adr/digest/flush", adr_digest_flush, methods=["POST"]),
+    Route("/events/summary", event_summary, methods=["GET"]),
+    Route("/events/rollups/rebuild", event_rollups_rebuild, methods=["POST"]),
+    Route("/events/{source_system}/bulk", bulk_event_catcher, methods=["POST"]),
+    Route("/events/{source_system}", event_catcher, methods=["POST"]),
+    Route("/scorecard/summary", scorecard_summary, methods=["POST"]),
+    Route("/jira/mirror/sync", jira_mirror_sync, methods=["POST"]),
+    Route("/confluence/ingest", confluence_ingest, methods=["POST"]),
+    Route("/jobs/{job_id}", job_status, methods=["GET"]),
+    Route("/cache/jira/invalidate", jira_cache_invalidate, methods=["POST"]),
+    Route("/cache/jira/stats", jira_cache_stats, methods=["GET"]),
+    Route("/metrics", metrics, methods=["GET"]),
+    Route("/health-check", health_check, methods=["GET"])
+]
+
+asgi_app = Starlette(routes=routes, lifespan=lifespan, middleware=[Middleware(RequestMetricsMiddleware)])
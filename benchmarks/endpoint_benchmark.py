@@ -0,0 +1,336 @@
+"""
+    endpoint_benchmark.py - Drives the publishing and event end-points of a
+                            real ArchiBot instance, backed by the local
+                            stand-ins in standins.py, and reports latency
+                            percentiles, throughput and the number of calls
+                            made out to Slack, JIRA and the database.
+
+                            Run from the root of the repository with
+                            python benchmarks/endpoint_benchmark.py --help
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import urllib.request
+import urllib.error
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# benchmarks can only be imported once the root of the repository is on the path
+# pylint: disable=wrong-import-position
+from benchmarks.standins import FakeSlack, FakeJira, LocalDb, write_secrets_file
+# pylint: enable=wrong-import-position
+
+API_KEY = "benchmark"
+
+# The end-points which are driven, and the body sent with request number n
+SCENARIOS = {
+    "agenda": ("/tda/agenda/publish", lambda n, args: {}),
+    "adr": ("/artefact/adr/publish", lambda n, args: {"key": f"ADR-{n % args.adr_keys + 1}"}),
+    "events": ("/events/jira", lambda n, args: {
+        "contributor": f"architect{n % 25}@example.com",
+        "event_type": "ADR Reviewed",
+        "issue_key": f"ADR-{n % args.adr_keys + 1}"
+    }),
+    "scorecard": ("/scorecard/summary", lambda n, args: {}),
+    "bulk": ("/events/jira/bulk", lambda n, args: b"".join(
+        json.dumps({
+            "contributor": f"architect{line % 25}@example.com",
+            "event_type": "ADR Reviewed",
+            "issue_key": f"ADR-{line % args.adr_keys + 1}"
+        }).encode("utf-8") + b"\n"
+        for line in range(args.bulk_lines)
+    ))
+}
+
+
+def percentile(values, fraction):
+    """
+    Returns the value below which the given fraction of values fall.
+    """
+    if not values:
+        return float("nan")
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def call(base_url, method, path, body=None):
+    """
+    Makes one request to the app.
+
+    Returns:
+    (status code, decoded JSON body or None, seconds taken)
+    """
+    # Bytes are sent as they are, e.g. newline-delimited JSON for /bulk
+    if isinstance(body, bytes):
+        data, content_type = body, "application/x-ndjson"
+    else:
+        data, content_type = None if body is None else json.dumps(body).encode("utf-8"), "application/json"
+
+    outbound = urllib.request.Request(
+        base_url + path,
+        data=data,
+        method=method,
+        headers={"x-api-key": API_KEY, "Content-Type": content_type}
+    )
+    started = time.perf_counter()
+
+    try:
+        with urllib.request.urlopen(outbound, timeout=120) as response:
+            status, raw = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, raw = e.code, e.read()
+
+    elapsed = time.perf_counter() - started
+
+    try:
+        payload = json.loads(raw)
+    except ValueError:
+        payload = None
+
+    return status, payload, elapsed
+
+
+def wait_for_jobs(base_url, job_ids, timeout):
+    """
+    Polls /jobs/<id> until every job has finished or the timeout passes.
+
+    Returns:
+    A list of job dicts, as returned by the status end-point.
+    """
+    deadline = time.monotonic() + timeout
+    pending = set(job_ids)
+    finished = []
+
+    while pending and time.monotonic() < deadline:
+
+        for job_id in list(pending):
+            status, job, _ = call(base_url, "GET", f"/jobs/{job_id}")
+            if status == 200 and job["state"] in ("succeeded", "failed"):
+                finished.append(job)
+                pending.discard(job_id)
+
+        if pending:
+            time.sleep(0.1)
+
+    if pending:
+        print(f"{len(pending)} jobs had not finished after {timeout}s", file=sys.stderr)
+
+    return finished
+
+
+def run_scenario(base_url, name, args):
+    """
+    Sends args.requests requests to one end-point, args.concurrency at a time.
+
+    Returns:
+    A dict of results for the report.
+    """
+    path, make_body = SCENARIOS[name]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda n: call(base_url, "POST", path, make_body(n, args)), range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [seconds for _, _, seconds in results]
+    job_ids = [payload["job_id"] for status, payload, _ in results if status == 202 and payload and "job_id" in payload]
+    jobs = wait_for_jobs(base_url, job_ids, args.job_timeout)
+
+    return {
+        "requests": len(results),
+        "statuses": dict(Counter(status for status, _, _ in results)),
+        "rps": len(results) / elapsed,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "jobs": dict(Counter(job["state"] for job in jobs)),
+        "job_p50": percentile([job["finished"] - job["created"] for job in jobs], 0.50),
+        "job_p95": percentile([job["finished"] - job["created"] for job in jobs], 0.95)
+    }
+
+
+def start_app(args, slack, jira, workdir):
+    """
+    Imports the app, points it at the stand-ins and serves it on a local port.
+
+    Returns:
+    (the port, a function which stops the server, the local database)
+    """
+    write_secrets_file(os.path.join(workdir, "secrets.json"), slack, jira, api_key=API_KEY)
+    os.environ["SECRETS_FILE"] = os.path.join(workdir, "secrets.json")
+
+    # The app reads SECRETS_FILE as it's imported, so it can't be imported any sooner
+    # pylint: disable=import-outside-toplevel
+    import app
+    from libs import context
+    from libs.metrics import instrument_engine
+
+    # The app logs every Slack call at DEBUG, which would drown the report
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    from slack_bolt import App
+    from libs.http_pool import PooledWebClient
+    from werkzeug.serving import make_server
+
+    local_db = LocalDb(url=args.db_url, path=os.path.join(workdir, "benchmark.sqlite3"))
+    if args.db_url:
+        local_db.ensure_schema()
+
+    # Slack and the database are replaced, JIRA is reached through the secrets
+    if args.asgi:
+        return start_asgi_app(slack, local_db)
+
+    context.override("app", App(
+        signing_secret=app.SLACK_SIGNING_SECRET,
+        client=PooledWebClient(token=app.SLACK_BOT_TOKEN, base_url=slack.api_url)
+    ))
+    context.override("db", local_db.engine)
+    instrument_engine(local_db.engine)
+
+    server = make_server("127.0.0.1", 0, app.flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server.server_port, server.shutdown, local_db
+
+
+def start_asgi_app(slack, local_db):
+    """
+    Serves asgi.py with uvicorn instead, for comparison with the Flask app.
+    """
+    # As in start_app, the app is only imported once SECRETS_FILE is written
+    # pylint: disable=import-outside-toplevel
+    import uvicorn
+    import asgi
+    import app
+    from libs import context
+    from libs.async_db import AsyncDatabase
+    from libs.metrics import instrument_engine
+    from slack_bolt.async_app import AsyncApp
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    context.override("async_app", AsyncApp(
+        signing_secret=app.SLACK_SIGNING_SECRET,
+        client=AsyncWebClient(token=app.SLACK_BOT_TOKEN, base_url=slack.api_url)
+    ))
+    context.override("async_db", AsyncDatabase(local_db.engine))
+    instrument_engine(local_db.engine)
+
+    server = uvicorn.Server(uvicorn.Config(asgi.asgi_app, host="127.0.0.1", port=0, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+
+    while not server.started:
+        time.sleep(0.05)
+
+    def shutdown():
+        server.should_exit = True
+
+    return server.servers[0].sockets[0].getsockname()[1], shutdown, local_db
+
+
+def app_flush_interval():
+    """
+    Returns how long the app's event buffer may hold an event before writing it.
+    """
+    # As in start_app, the app is only imported once SECRETS_FILE is written
+    # pylint: disable=import-outside-toplevel
+    import app
+
+    return app.EVENT_FLUSH_INTERVAL * 2
+
+
+def report(name, result, outbound):
+    """
+    Prints the results of one scenario.
+    """
+    print(f"{name}")
+    print(f"  requests {result['requests']}  statuses {result['statuses']}  {result['rps']:.1f} req/s")
+    print(
+        f"  http     p50 {result['p50'] * 1000:.1f}ms  p95 {result['p95'] * 1000:.1f}ms  "
+        f"p99 {result['p99'] * 1000:.1f}ms"
+    )
+
+    if result["jobs"]:
+        print(f"  jobs     {result['jobs']}  p50 {result['job_p50']:.2f}s  p95 {result['job_p95']:.2f}s")
+
+    for service, calls in outbound.items():
+        if calls:
+            print(f"  {service:<8} {dict(calls)}")
+
+
+def main():
+    """
+    Runs the chosen scenarios against stand-ins and prints the results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="Comma separated, from: " + ", ".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=20, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at once")
+    parser.add_argument("--bulk-lines", type=int, default=1000, help="Events per request in the bulk scenario")
+    parser.add_argument("--adr-keys", type=int, default=10, help="The number of distinct ADRs published")
+    parser.add_argument("--slack-latency", type=float, default=0.05, help="Seconds per Slack call")
+    parser.add_argument("--slack-429-every", type=int, default=0, help="Rate limit every Nth chat.postMessage")
+    parser.add_argument("--slack-retry-after", type=int, default=1, help="Retry-After sent with each 429")
+    parser.add_argument("--jira-latency", type=float, default=0.1, help="Seconds per JIRA call")
+    parser.add_argument("--jira-jitter", type=float, default=0.0, help="Random extra seconds per JIRA call")
+    parser.add_argument("--agenda-size", type=int, default=20, help="Issues in the TDA agenda filter")
+    parser.add_argument("--scorecard-size", type=int, default=150, help="Issues in each scorecard filter")
+    parser.add_argument("--db-url", default=None, help="A MySQL / MariaDB SQLAlchemy URL, SQLite is used if omitted")
+    parser.add_argument("--asgi", action="store_true", help="Serve asgi.py with uvicorn rather than the Flask app")
+    parser.add_argument("--job-timeout", type=float, default=600, help="Seconds to wait for the queued jobs")
+    args = parser.parse_args()
+
+    slack = FakeSlack(
+        latency=args.slack_latency,
+        rate_limit_every=args.slack_429_every,
+        retry_after=args.slack_retry_after
+    ).start()
+    jira = FakeJira(
+        latency=args.jira_latency,
+        jitter=args.jira_jitter,
+        filter_sizes={"10000": args.agenda_size, "11131": args.scorecard_size,
+                      "11132": args.scorecard_size, "11133": args.scorecard_size}
+    ).start()
+
+    with tempfile.TemporaryDirectory() as workdir:
+
+        port, shutdown, local_db = start_app(args, slack, jira, workdir)
+        base_url = f"http://127.0.0.1:{port}"
+
+        # The app's own clients are created by the first request, not timed here
+        call(base_url, "GET", "/health-check")
+
+        for name in args.scenarios.split(","):
+
+            slack.calls.clear()
+            jira.calls.clear()
+            local_db.statements.clear()
+
+            result = run_scenario(base_url, name, args)
+
+            # Events are written in batches, let the last one land before counting
+            if name == "events":
+                time.sleep(app_flush_interval())
+
+            report(name, result, {"slack": slack.calls, "jira": jira.calls, "db": local_db.statements})
+
+        shutdown()
+
+    slack.stop()
+    jira.stop()
+
+
+if __name__ == '__main__':
+    main()
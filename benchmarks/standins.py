@@ -0,0 +1,562 @@
+"""
+    standins.py -   Local stand-ins for the services ArchiBot talks to, so
+                    the end-points can be benchmarked without Slack, JIRA,
+                    Secrets Manager or Cloud SQL.
+
+                    FakeSlack and FakeJira are small threaded HTTP servers
+                    with configurable latency, which count every call they
+                    are sent. create_local_db builds a SQLite engine which
+                    accepts the MySQL statements the app issues.
+"""
+
+import re
+import json
+import time
+import random
+import threading
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import sqlalchemy
+
+
+class StandIn(ThreadingHTTPServer):
+    """
+    The common parts of a stand-in server, run on a background thread on a
+    free local port.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0.0, jitter=0.0):
+        """
+        Args:
+        handler: The BaseHTTPRequestHandler subclass answering requests
+        latency: Seconds added to every response
+        jitter: Up to this many extra seconds, chosen at random, per response
+        """
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency    = latency
+        self.jitter     = jitter
+        self.calls      = Counter()
+        self.calls_lock = threading.Lock()
+        self.thread     = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        """
+        The base URL the stand-in is listening on.
+        """
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        """
+        Starts serving on the background thread, returning the stand-in.
+        """
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops serving and closes the listening socket.
+        """
+        self.shutdown()
+        self.server_close()
+
+    def process_request(self, request, client_address):
+        # Each request here is a new connection, the rest arrive on kept-alive ones
+        self.count("connections")
+        super().process_request(request, client_address)
+
+    def count(self, name):
+        """
+        Records a call and returns how many of that call have been made.
+        """
+        with self.calls_lock:
+            self.calls[name] += 1
+            return self.calls[name]
+
+    def delay(self):
+        """
+        Waits for the configured latency plus jitter, as a real service would.
+        """
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Shared helpers for the stand-in request handlers.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Keep the benchmark output readable
+        pass
+
+    def read_body(self):
+        """
+        Reads the request body, as bytes.
+        """
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send_json(self, status, payload, headers=None):
+        """
+        Sends a JSON response with the given status and extra headers.
+        """
+        body = json.dumps(payload).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeSlackHandler(StandInHandler):
+    """
+    Answers Slack Web API calls, e.g. POST /api/chat.postMessage
+    """
+
+    # The name BaseHTTPRequestHandler dispatches POST requests to
+    # pylint: disable-next=invalid-name
+    def do_POST(self):
+        """
+        Answers a Web API method, rate limiting chat.postMessage if asked to.
+        """
+        self.read_body()
+        method = urlparse(self.path).path.rsplit("/", 1)[-1]
+        call_number = self.server.count(method)
+
+        self.server.delay()
+
+        # Every Nth post is rate limited, as Slack does to busy channels
+        if method == "chat.postMessage" and self.server.rate_limit_every \
+                and call_number % self.server.rate_limit_every == 0:
+            self.server.count("rate_limited")
+            self.send_json(429, {"ok": False, "error": "ratelimited"},
+                           headers={"Retry-After": str(self.server.retry_after)})
+            return
+
+        if method == "auth.test":
+            self.send_json(200, {"ok": True, "user_id": "UBENCH", "bot_id": "BBENCH", "team_id": "TBENCH"})
+            return
+
+        self.send_json(200, {"ok": True, "channel": "CBENCH", "ts": f"{time.time():.6f}"})
+
+
+class FakeSlack(StandIn):
+    """
+    A stand-in for the Slack Web API. Point a WebClient at
+    base_url=FakeSlack.api_url to use it.
+    """
+
+    def __init__(self, latency=0.05, jitter=0.0, rate_limit_every=0, retry_after=1):
+        """
+        Args:
+        latency / jitter: As for StandIn
+        rate_limit_every: Answer every Nth chat.postMessage with a 429, 0 to never do so
+        retry_after: The Retry-After, in seconds, sent with each 429
+        """
+        super().__init__(FakeSlackHandler, latency, jitter)
+        self.rate_limit_every   = rate_limit_every
+        self.retry_after        = retry_after
+
+    @property
+    def api_url(self):
+        """
+        The base_url to give a WebClient.
+        """
+        return f"{self.url}/api/"
+
+
+class FakeJiraHandler(StandInHandler):
+    """
+    Answers the JIRA REST calls made through atlassian.Jira, i.e. searches
+    and issue lookups, and the Confluence content calls made through
+    atlassian.Confluence.
+    """
+
+    # The name BaseHTTPRequestHandler dispatches GET requests to
+    # pylint: disable-next=invalid-name
+    def do_GET(self):
+        """
+        Routes a JIRA or Confluence call by its path.
+        """
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+
+        self.server.delay()
+
+        if url.path.endswith("/search"):
+            self.server.count("jql")
+            self.send_json(200, self.server.search(query))
+
+        elif url.path.endswith("/rest/api/content"):
+            self.server.count("content")
+            self.send_json(200, self.server.list_pages(query))
+
+        elif "/rest/api/content/" in url.path:
+            self.server.count("page")
+            self.send_json(200, self.server.make_page(url.path.rsplit("/", 1)[-1], body=True))
+
+        elif "/issue/" in url.path:
+            self.server.count("issue")
+            self.send_json(200, self.server.make_issue(url.path.rsplit("/", 1)[-1]))
+
+        else:
+            self.server.count("unknown")
+            self.send_json(404, {"errorMessages": [f"No stand-in for {url.path}"]})
+
+
+class FakeJira(StandIn):
+    """
+    A stand-in for the JIRA REST API. Searches of the form 'filter = N'
+    return filter_sizes[N] issues, or default_size if N isn't listed, and
+    only changed_size of them when they also ask for 'updated >='. Keys
+    added to departed have left every filter, and are what searches for
+    'key in (...) AND NOT filter = N' find.
+
+    It also stands in for Confluence, with a space of space_size pages.
+    Raising page_versions[page_id] edits a page.
+    """
+
+    # Each argument is an independent setting with a default, passed by keyword
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, *, latency=0.1, jitter=0.0, default_size=20, filter_sizes=None, value_streams=None,
+                 changed_size=2, space_size=50):
+        """
+        Args:
+        latency / jitter: As for StandIn
+        default_size: The number of issues in a filter which isn't in filter_sizes
+        filter_sizes: Optional {filter_id: number of issues}
+        changed_size: The number of issues 'updated >=' searches find
+        value_streams: The value-streams ADRs impact, a few are chosen per ADR
+        space_size: The number of pages in the Confluence space
+        """
+        super().__init__(FakeJiraHandler, latency, jitter)
+        self.default_size   = default_size
+        self.filter_sizes   = {str(filter_id): size for filter_id, size in (filter_sizes or {}).items()}
+        self.value_streams  = value_streams or ["Mortgages", "Savings", "Business Banking"]
+        self.changed_size   = changed_size
+        self.space_size     = space_size
+        self.page_versions  = {}
+        self.departed       = set()
+
+    def make_issue(self, key):
+        """
+        Builds an issue with every field the publishers read. The content
+        is derived from the key so repeated lookups agree.
+        """
+        number = int(re.sub(r"\D", "", key) or 0)
+        impacted = [
+            {"value": value_stream}
+            for i, value_stream in enumerate(self.value_streams)
+            if (number >> i) & 1 or i == 0
+        ]
+
+        return {
+            "key": key,
+            "fields": {
+                "summary": f"Stand-in issue {key} " + "lorem ipsum " * (number % 8),
+                "creator": {"displayName": f"Creator {number % 17}"},
+                "assignee": {"displayName": f"Assignee {number % 13}"},
+                "status": {"name": ["To Do", "In Progress", "Done"][number % 3]},
+                "updated": "2024-01-01T00:00:00.000+0000",
+                "customfield_10383": impacted,
+                "customfield_10241": {"value": ["Proposed", "Accepted", "Superseded"][number % 3]}
+            }
+        }
+
+    def search(self, query):
+        """
+        Returns one page of a search, honouring startAt and maxResults.
+        """
+        jql = query.get("jql", "")
+        filter_id = re.search(r"filter = (\d+)", jql)
+        filter_id = filter_id.group(1) if filter_id else ""
+        total = self.filter_sizes.get(filter_id, self.default_size)
+
+        # Incremental syncs of the JIRA mirror see the first few issues change
+        if "updated >=" in jql:
+            total = min(total, self.changed_size)
+        start = int(query.get("startAt", 0))
+        limit = int(query.get("maxResults", 50))
+
+        if "NOT filter =" in jql:
+            keys = [key for key in re.search(r"key in \(([^)]*)\)", jql).group(1).split(", ") if key in self.departed]
+        else:
+            keys = [f"BENCH-{filter_id or 0}{number:05d}" for number in range(total)]
+            keys = [key for key in keys if key not in self.departed]
+
+        return {
+            "startAt": start,
+            "maxResults": limit,
+            "total": len(keys),
+            "issues": [self.make_issue(key) for key in keys[start:start + limit]]
+        }
+
+
+    def make_page(self, page_id, body=False):
+        """
+        Builds a Confluence page, whose body changes with its version.
+        """
+        number = int(page_id) - 100000
+        version = self.page_versions.get(page_id, 1)
+        page = {
+            "id": page_id,
+            "type": "page",
+            "title": f"Stand-in page {number}",
+            "version": {"number": version}
+        }
+
+        if body:
+            paragraphs = [
+                f"<p>Paragraph {paragraph} of page {number}. " + "lorem ipsum " * 40 + "</p>"
+                for paragraph in range(10 + number % 10)
+            ]
+            paragraphs[0] = f"<h1>Version {version}</h1>" + paragraphs[0]
+            page["body"] = {"storage": {"value": "".join(paragraphs), "representation": "storage"}}
+
+        return page
+
+    def list_pages(self, query):
+        """
+        Returns one page of the space's content, honouring start and limit.
+        """
+        start = int(query.get("start", 0))
+        limit = int(query.get("limit", 25))
+        end = min(start + limit, self.space_size)
+        links = {"next": f"/rest/api/content?start={end}"} if end < self.space_size else {}
+
+        return {
+            "start": start,
+            "limit": limit,
+            "size": max(end - start, 0),
+            "results": [self.make_page(str(100000 + number)) for number in range(start, end)],
+            "_links": links
+        }
+
+
+# The tables the app expects, written for SQLite. The real schema is in
+# libs/ modules which create each table and is MySQL specific.
+SQLITE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source_timestamp DOUBLE NOT NULL,
+        source_system VARCHAR(64) NOT NULL,
+        contributor VARCHAR(255) NOT NULL,
+        event_type VARCHAR(255) NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS events_hourly (
+        bucket_start DATETIME NOT NULL,
+        source_system VARCHAR(64) NOT NULL,
+        contributor VARCHAR(255) NOT NULL,
+        event_type VARCHAR(255) NOT NULL,
+        event_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket_start, source_system, contributor, event_type)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS events_daily (
+        bucket_start DATETIME NOT NULL,
+        source_system VARCHAR(64) NOT NULL,
+        contributor VARCHAR(255) NOT NULL,
+        event_type VARCHAR(255) NOT NULL,
+        event_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket_start, source_system, contributor, event_type)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        idempotency_key CHAR(64) NOT NULL PRIMARY KEY,
+        status_code SMALLINT NULL,
+        content_type VARCHAR(255) NULL,
+        body TEXT NULL,
+        expires_at DATETIME NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS event_spool_offsets (
+        spool_id CHAR(32) NOT NULL PRIMARY KEY,
+        segment BIGINT NOT NULL,
+        position BIGINT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS adr_messages (
+        issue_key VARCHAR(64) NOT NULL,
+        channel VARCHAR(64) NOT NULL,
+        ts VARCHAR(32) NOT NULL,
+        content_hash CHAR(64) NOT NULL,
+        updated_at DATETIME NOT NULL,
+        PRIMARY KEY (issue_key, channel)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS adr_digest_entries (
+        channel VARCHAR(64) NOT NULL,
+        issue_key VARCHAR(64) NOT NULL,
+        blocks TEXT NOT NULL,
+        content_hash CHAR(64) NOT NULL,
+        queued_at DATETIME NOT NULL,
+        claimed_by CHAR(32) NULL,
+        claimed_until DATETIME NULL,
+        PRIMARY KEY (channel, issue_key)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS jira_mirror_issues (
+        filter_id VARCHAR(32) NOT NULL,
+        issue_key VARCHAR(64) NOT NULL,
+        position INT NOT NULL,
+        issue TEXT NOT NULL,
+        PRIMARY KEY (filter_id, issue_key)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS jira_mirror_state (
+        filter_id VARCHAR(32) NOT NULL PRIMARY KEY,
+        synced_at DATETIME NOT NULL,
+        reconciled_at DATETIME NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS confluence_pages (
+        page_id VARCHAR(32) NOT NULL PRIMARY KEY,
+        space_key VARCHAR(255) NOT NULL,
+        title VARCHAR(255) NOT NULL,
+        version INT NOT NULL,
+        ingested_at DATETIME NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS confluence_chunks (
+        page_id VARCHAR(32) NOT NULL,
+        chunk_index INT NOT NULL,
+        content_hash CHAR(64) NOT NULL,
+        PRIMARY KEY (page_id, chunk_index)
+    )
+    """
+]
+
+# MySQL only syntax used by the app, and its SQLite equivalent
+MYSQL_TO_SQLITE = [
+    (re.compile(r"\bINSERT IGNORE\b"), "INSERT OR IGNORE"),
+    (re.compile(r"\bON DUPLICATE KEY UPDATE\b"), "ON CONFLICT DO UPDATE SET"),
+    (re.compile(r"\bVALUES\((\w+)\)"), r"excluded.\1"),
+    (re.compile(r"\bDATE_ADD\('1970-01-01', INTERVAL (.+?) SECOND\)"), r"datetime(\1, 'unixepoch')")
+]
+
+
+def _to_sqlite(statement):
+    for pattern, replacement in MYSQL_TO_SQLITE:
+        statement = pattern.sub(replacement, statement)
+    return statement
+
+
+class LocalDb:
+    """
+    A database for the app to use during a benchmark, counting the
+    statements it is sent.
+    """
+
+    def __init__(self, url=None, path=None):
+        """
+        Args:
+        url: A SQLAlchemy URL for a real MySQL / MariaDB database, if there is one
+        path: Otherwise, the SQLite file to use
+        """
+        self.statements = Counter()
+        self._lock      = threading.Lock()
+
+        if url:
+            self.engine = sqlalchemy.create_engine(url, pool_size=10)
+
+        else:
+            self.engine = sqlalchemy.create_engine(
+                f"sqlite:///{path}",
+                connect_args={"check_same_thread": False, "timeout": 30}
+            )
+
+            @sqlalchemy.event.listens_for(self.engine, "before_cursor_execute", retval=True, named=True)
+            def translate(statement, parameters, **_):
+                return _to_sqlite(statement), parameters
+
+            with self.engine.connect() as conn:
+                for statement in SQLITE_SCHEMA:
+                    conn.execute(sqlalchemy.text(statement))
+                conn.commit()
+
+        @sqlalchemy.event.listens_for(self.engine, "after_cursor_execute", named=True)
+        def count(statement, **_):
+            with self._lock:
+                self.statements[statement.split(None, 1)[0].upper()] += 1
+
+    def ensure_schema(self):
+        """
+        Creates the app's own schema on a real database.
+        """
+        # libs import the app, which reads SECRETS_FILE, so they're imported on first use
+        # pylint: disable=import-outside-toplevel
+        from libs.event_analytics import ensure_events_schema
+        from libs.idempotency import ensure_idempotency_schema
+        from libs.event_spool import ensure_spool_schema
+        from libs.message_ledger import ensure_ledger_schema
+        from libs.adr_digest import ensure_digest_schema
+        from libs.jira_mirror import ensure_mirror_schema
+        from libs.confluence_ingest import ensure_confluence_schema
+
+        ensure_events_schema(self.engine)
+        ensure_idempotency_schema(self.engine)
+        ensure_spool_schema(self.engine)
+        ensure_ledger_schema(self.engine)
+        ensure_digest_schema(self.engine)
+        ensure_mirror_schema(self.engine)
+        ensure_confluence_schema(self.engine)
+
+
+# Slack's stand-in is reached through a client the benchmark builds itself, as the
+# secrets only hold its token, but it's taken here so both stand-ins are passed alike
+# pylint: disable-next=unused-argument
+def write_secrets_file(path, slack, jira, api_key="benchmark", channel_map=None):
+    """
+    Writes a secrets payload, in the same shape as Secrets Manager's, which
+    points the app at the stand-ins. Use it with SECRETS_FILE=path.
+    """
+    secrets = {
+        "SLACK_SIGNING_SECRET": "benchmark-signing-secret",
+        "SLACK_BOT_TOKEN": "xoxb-benchmark",
+        "API_KEY": api_key,
+        "CREDENTIALS": {
+            "ATLASSIAN": {
+                "API_ROOT": jira.url,
+                "JIRA": {"USERNAME": "benchmark", "PASSWORD": "benchmark"},
+                "CONFLUENCE": {"USERNAME": "benchmark", "PASSWORD": "benchmark"}
+            }
+        },
+        "JIRA_SEARCH_FILTER": "10000",
+        "PRIMARY_SLACK_CHANNEL": "CBENCHPRIMARY",
+        "SLACK_CHANNEL_MAP": channel_map or {
+            value_stream: f"CBENCH{i}" for i, value_stream in enumerate(jira.value_streams)
+        },
+        "DB_CONFIG": {
+            "DB_TYPE": "local",
+            "DB_HOST": "127.0.0.1",
+            "DB_PORT": 3306,
+            "DB_USER": "benchmark",
+            "DB_PASS": "benchmark",
+            "DB_DATABASE": "benchmark"
+        }
+    }
+
+    with open(path, "w", encoding="UTF-8") as secrets_file:
+        json.dump(secrets, secrets_file)
+
+    return secrets
@@ -0,0 +1,97 @@
+"""
+    template_benchmark.py -     Compares the compiled template registry with
+                                the original load_template, which read the
+                                file and ran str.replace for every message.
+
+                                Run from the root of the repository with
+                                python benchmarks/template_benchmark.py
+"""
+
+import os
+import sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# libs can only be imported once the root of the repository is on the path
+# pylint: disable=wrong-import-position
+from libs.template import TEMPLATE_DIR, render_template, reload_templates
+# pylint: enable=wrong-import-position
+
+# A representative substitution for each template, as used by jira_activities
+TEMPLATE_CONFIGS = {
+    "adr_published": {
+        "%KEY%": "ADR-123",
+        "%STATUS%": "Accepted",
+        "%AUTHOR%": "Jane Architect",
+        "%VS_IMPACTED%": "Mortgages,Savings",
+        "%SUMMARY%": "Adopt \"event sourcing\" for the ledger",
+        "%LINK%": "https://example.atlassian.net/browse/ADR-123"
+    },
+    "tda_agenda": {
+        "%KEY%": "TDA-42",
+        "%AUTHOR%": "Jane Architect",
+        "%SUMMARY%": "Review the payments gateway design",
+        "%LINK%": "https://example.atlassian.net/browse/TDA-42"
+    },
+    "scorecard_item": {
+        "%NAME%": "Jane Architect",
+        "%STATUS%": "In Progress",
+        "%SUMMARY%": "Publish the integration principles",
+        "%LINKURL%": "https://example.atlassian.net/issues/ARCH-7",
+        "%ISSUEKEY%": "ARCH-7"
+    }
+}
+
+
+def legacy_load_template(template_name, template_config):
+    """
+    The original implementation, read from disk with one replace per placeholder.
+    """
+    with open(os.path.join(TEMPLATE_DIR, f'{template_name}.json'), 'r', encoding="utf-8") as file_data:
+
+        file_content = file_data.read()
+
+        for k, v in template_config.items():
+
+            file_content = file_content.replace(k, v, 1)
+
+        return file_content
+
+
+def legacy_to_blocks(template_name, template_config):
+    """
+    What callers needed to do with the legacy output to get Python objects.
+    """
+    return json.loads(legacy_load_template(template_name, template_config))
+
+
+def main(number=20000):
+    """
+    Times both implementations for each template and prints the results.
+    """
+    reload_templates()
+
+    print(f"{'template':<16} {'legacy (us)':>12} {'compiled (us)':>14} {'speed-up':>9}")
+
+    for template_name, template_config in TEMPLATE_CONFIGS.items():
+
+        # The escaping fix means the legacy version can't parse a quoted summary
+        legacy_config = {k: v.replace('"', "'") for k, v in template_config.items()}
+
+        legacy = timeit.timeit(
+            lambda name=template_name, config=legacy_config: legacy_to_blocks(name, config), number=number
+        )
+        compiled = timeit.timeit(
+            lambda name=template_name, config=template_config: render_template(name, config), number=number
+        )
+
+        print(
+            f"{template_name:<16} {legacy / number * 1e6:>12.2f} {compiled / number * 1e6:>14.2f} "
+            f"{legacy / compiled:>8.1f}x"
+        )
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
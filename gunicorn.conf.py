@@ -0,0 +1,21 @@
+"""
+    gunicorn.conf.py -  Read by gunicorn from the working directory when the
+                        Dockerfile starts it.
+
+                        Each worker starts replaying any events spooled, and
+                        posting any ADR digests queued, by the worker it
+                        replaced. This is done once the worker has loaded the
+                        app rather than on a request, so /health-check never
+                        waits on secrets or the database.
+"""
+
+
+def post_worker_init(worker):
+    """
+    Starts the event spool replayer and the ADR digest flusher in a new worker.
+    """
+    from libs.events import resume_event_spool
+    from libs.adr_digest import start_flusher
+
+    resume_event_spool()
+    start_flusher()
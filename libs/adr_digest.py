@@ -0,0 +1,510 @@
+"""
+    adr_digest.py -     Collects ADR publications into a digest per channel
+                        when ADR_DIGEST_WINDOW is set, rather than posting
+                        each one as it happens.
+
+                        A channel's window opens with the first ADR queued
+                        for it and closes ADR_DIGEST_WINDOW seconds later,
+                        when everything queued is posted as one combined
+                        message. Only the latest state of each ADR is kept,
+                        so an ADR which changes several times in a window
+                        appears once. The queue is kept in the database so
+                        a restart doesn't lose it.
+
+                        Before posting, an instance claims the channel's
+                        queued ADRs with a token of its own, so other
+                        instances, or a scheduled flush, skip them rather
+                        than posting the same digest again. A claim lapses
+                        after CLAIM_SECONDS in case its owner dies.
+"""
+
+import sys
+import json
+import uuid
+import weakref
+import asyncio
+import hashlib
+import datetime
+import threading
+import sqlalchemy
+import app
+from libs.template import render_template
+from libs.jobs import report_progress
+from libs.message_builder import MessageBuilder
+from libs.message_builder import AsyncMessageBuilder
+from libs.metrics import PUBLISH_MESSAGES
+
+SCHEMA_STATEMENT    = """
+    CREATE TABLE IF NOT EXISTS adr_digest_entries (
+        channel VARCHAR(64) NOT NULL,
+        issue_key VARCHAR(64) NOT NULL,
+        blocks TEXT NOT NULL,
+        content_hash CHAR(64) NOT NULL,
+        queued_at DATETIME NOT NULL,
+        claimed_by CHAR(32) NULL,
+        claimed_until DATETIME NULL,
+        PRIMARY KEY (channel, issue_key)
+    )
+"""
+
+# The longest the flusher sleeps without checking for closed windows, in seconds
+MAX_FLUSH_WAIT      = 60
+
+# How long a claim on a channel's ADRs lasts, in seconds, long enough to post a digest
+CLAIM_SECONDS       = 300
+
+# Digests for the same channel in this process are posted one at a time, a
+# lock being dropped once nothing holds or waits on it
+_channel_locks       = weakref.WeakValueDictionary()
+_channel_locks_lock  = threading.Lock()
+_async_channel_locks = weakref.WeakValueDictionary()
+
+# The thread, or task under asgi.py, which posts digests as their windows close
+_flusher            = None
+_flusher_wake       = threading.Event()
+_async_flusher      = None
+_async_flusher_wake = None
+
+
+def ensure_digest_schema(engine):
+    """
+    Creates the digest table if it doesn't already exist.
+    """
+    with engine.connect() as conn:
+        create_digest_schema(conn)
+
+
+def create_digest_schema(conn):
+    """
+    The body of ensure_digest_schema, on an open connection.
+    """
+    conn.execute(sqlalchemy.text(SCHEMA_STATEMENT))
+    conn.commit()
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def write_entries(conn, issue_key, channels, blocks):
+    """
+    Queues an ADR's message for each of its channels, replacing any earlier
+    state of the ADR queued in the same window.
+    """
+    if not channels:
+        return
+
+    blocks_json = json.dumps(blocks, separators=(",", ":"), sort_keys=True)
+    blocks_hash = hashlib.sha256(blocks_json.encode("utf-8")).hexdigest()
+
+    # queued_at isn't updated, so the window still opens with the first publication
+    conn.execute(
+        sqlalchemy.text(
+            "INSERT INTO adr_digest_entries (channel, issue_key, blocks, content_hash, queued_at) "
+            "VALUES (:channel, :issue_key, :blocks, :content_hash, :queued_at) "
+            "ON DUPLICATE KEY UPDATE blocks = VALUES(blocks), content_hash = VALUES(content_hash)"
+        ),
+        [
+            {
+                "channel": channel,
+                "issue_key": issue_key,
+                "blocks": blocks_json,
+                "content_hash": blocks_hash,
+                "queued_at": _now()
+            }
+            for channel in channels
+        ]
+    )
+    conn.commit()
+
+
+def read_windows(conn):
+    """
+    Returns {channel: when its window opened} for every channel with ADRs
+    queued which nobody is posting.
+    """
+    rows = conn.execute(
+        sqlalchemy.text(
+            "SELECT channel, MIN(queued_at) AS opened_at FROM adr_digest_entries "
+            "WHERE claimed_by IS NULL OR claimed_until < :now GROUP BY channel"
+        ).columns(opened_at=sqlalchemy.DateTime),
+        {"now": _now()}
+    )
+
+    return {row.channel: row.opened_at for row in rows}
+
+
+def claim_entries(conn, channel, token):
+    """
+    Claims the ADRs queued for a channel which nobody else has claimed, or
+    whose claim has lapsed.
+
+    Returns:
+    The ADRs claimed, in the order they were first queued, empty if another
+    instance is already posting them
+    """
+    now = _now()
+
+    conn.execute(
+        sqlalchemy.text(
+            "UPDATE adr_digest_entries SET claimed_by = :token, claimed_until = :claimed_until "
+            "WHERE channel = :channel AND (claimed_by IS NULL OR claimed_until < :now)"
+        ),
+        {
+            "channel": channel,
+            "token": token,
+            "claimed_until": now + datetime.timedelta(seconds=CLAIM_SECONDS),
+            "now": now
+        }
+    )
+    conn.commit()
+
+    rows = conn.execute(
+        sqlalchemy.text(
+            "SELECT issue_key, blocks, content_hash FROM adr_digest_entries "
+            "WHERE channel = :channel AND claimed_by = :token ORDER BY queued_at, issue_key"
+        ),
+        {"channel": channel, "token": token}
+    )
+
+    return [(row.issue_key, json.loads(row.blocks), row.content_hash) for row in rows]
+
+
+def delete_entries(conn, channel, entries, token):
+    """
+    Removes the entries which have been posted and releases the rest of the
+    claim. An ADR whose state changed while the digest was being posted is
+    left for the next window.
+    """
+    if entries:
+        conn.execute(
+            sqlalchemy.text(
+                "DELETE FROM adr_digest_entries "
+                "WHERE channel = :channel AND issue_key = :issue_key AND content_hash = :content_hash"
+            ),
+            [
+                {"channel": channel, "issue_key": issue_key, "content_hash": entry_hash}
+                for issue_key, _, entry_hash in entries
+            ]
+        )
+
+    conn.execute(
+        sqlalchemy.text(
+            "UPDATE adr_digest_entries SET claimed_by = NULL, claimed_until = NULL "
+            "WHERE channel = :channel AND claimed_by = :token"
+        ),
+        {"channel": channel, "token": token}
+    )
+    conn.commit()
+
+
+def due_channels(windows, now):
+    """
+    Returns the channels whose window has closed.
+    """
+    return [
+        channel for channel, opened_at in windows.items()
+        if (now - opened_at).total_seconds() >= app.ADR_DIGEST_WINDOW
+    ]
+
+
+def _next_close(windows, now):
+    """
+    Returns how long, in seconds, until the next window closes.
+    """
+    if not windows:
+        return MAX_FLUSH_WAIT
+
+    seconds = min(app.ADR_DIGEST_WINDOW - (now - opened_at).total_seconds() for opened_at in windows.values())
+
+    return min(max(seconds, 1), MAX_FLUSH_WAIT)
+
+
+def _window_text():
+    window = int(app.ADR_DIGEST_WINDOW)
+    amount, unit = (window // 60, "minute") if window % 60 == 0 else (window, "second")
+
+    return f"{amount} {unit}" if amount == 1 else f"{amount} {unit}s"
+
+
+def _header_config(entries):
+    return {
+        "%COUNT%": str(len(entries)),
+        "%PLURAL%": "" if len(entries) == 1 else "s",
+        "%WINDOW%": _window_text()
+    }
+
+
+def _digest_text(entries):
+    config = _header_config(entries)
+    return f"ADR Digest: {config['%COUNT%']} ADR{config['%PLURAL%']} updated"
+
+
+def _channel_lock(channel):
+    with _channel_locks_lock:
+        return _channel_locks.setdefault(channel, threading.Lock())
+
+
+def publish_digest(channel):
+    """
+    Posts the ADRs queued for a channel as one message, or as few as Slack
+    allows, and removes them from the queue.
+
+    Returns:
+    The number of ADRs posted
+    """
+    with _channel_lock(channel):
+
+        token = uuid.uuid4().hex
+
+        with app.db.connect() as conn:
+            entries = claim_entries(conn, channel, token)
+
+        if not entries:
+            return 0
+
+        # If posting fails, the ADRs already posted are removed and the claim
+        # on the rest released, so the next flush carries on from there
+        posted = 0
+
+        try:
+            message_builder = MessageBuilder(channel, _digest_text(entries))
+            message_builder.add(render_template("adr_digest_header", _header_config(entries)))
+
+            for entry_number, (_, blocks, _) in enumerate(entries):
+
+                messages_sent = message_builder.messages_sent
+
+                try:
+                    message_builder.add(blocks)
+
+                finally:
+
+                    # Adding an ADR only posts once the ADRs before it are complete
+                    if message_builder.messages_sent > messages_sent:
+                        posted = entry_number
+
+            PUBLISH_MESSAGES.observe(message_builder.flush(), "publish_adr_digest")
+            posted = len(entries)
+
+        finally:
+            with app.db.connect() as conn:
+                delete_entries(conn, channel, entries[:posted], token)
+
+        return len(entries)
+
+
+def flush_digests():
+    """
+    Posts the digest for every channel whose window has closed, also run as
+    a background job from a scheduler.
+
+    Returns:
+    {"channels": channels posted to, "adrs": ADRs posted}
+    """
+    with app.db.connect() as conn:
+        channels = due_channels(read_windows(conn), _now())
+
+    adrs = 0
+    failures = []
+
+    # One channel failing doesn't hold up the rest
+    for channel_number, channel in enumerate(channels, start=1):
+
+        try:
+            adrs += publish_digest(channel)
+        except Exception as e:
+            print(f"Failed to post the ADR digest to {channel}: {e}", file=sys.stderr)
+            failures.append(e)
+
+        report_progress(channel_number, len(channels))
+
+    if failures:
+        raise failures[0]
+
+    return {"channels": len(channels), "adrs": adrs}
+
+
+def _run_flusher():
+    """
+    The body of the flushing thread.
+    """
+    while True:
+
+        try:
+            flush_digests()
+
+            with app.db.connect() as conn:
+                wait = _next_close(read_windows(conn), _now())
+
+        except Exception as e:
+
+            print(f"Failed to flush ADR digests, will retry: {e}", file=sys.stderr)
+            wait = MAX_FLUSH_WAIT
+
+        _flusher_wake.wait(wait)
+        _flusher_wake.clear()
+
+
+def start_flusher():
+    """
+    Starts the flushing thread on first use, after any gunicorn fork, so
+    windows left open by an earlier process are closed too.
+    """
+    global _flusher
+
+    if _flusher is not None or not app.ADR_DIGEST_WINDOW:
+        return
+
+    with _channel_locks_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_run_flusher, name="archibot-adr-digest", daemon=True)
+            _flusher.start()
+
+
+def queue_adr(issue_key, blocks, channels):
+    """
+    Adds an ADR's message to the digest for each of its channels.
+    """
+    if not channels:
+        return
+
+    with app.db.connect() as conn:
+        write_entries(conn, issue_key, channels, blocks)
+
+    start_flusher()
+
+    # The flusher may be sleeping with nothing queued, have it work out when this window closes
+    _flusher_wake.set()
+
+
+def _async_channel_lock(channel):
+    return _async_channel_locks.setdefault(channel, asyncio.Lock())
+
+
+async def publish_digest_async(channel):
+    """
+    The asyncio equivalent of publish_digest.
+    """
+    async with _async_channel_lock(channel):
+
+        token = uuid.uuid4().hex
+        entries = await app.async_db.run(claim_entries, channel, token)
+
+        if not entries:
+            return 0
+
+        posted = 0
+
+        try:
+            message_builder = AsyncMessageBuilder(channel, _digest_text(entries))
+            await message_builder.add(render_template("adr_digest_header", _header_config(entries)))
+
+            for entry_number, (_, blocks, _) in enumerate(entries):
+
+                messages_sent = message_builder.messages_sent
+
+                try:
+                    await message_builder.add(blocks)
+
+                finally:
+                    if message_builder.messages_sent > messages_sent:
+                        posted = entry_number
+
+            PUBLISH_MESSAGES.observe(await message_builder.flush(), "publish_adr_digest")
+            posted = len(entries)
+
+        finally:
+            await app.async_db.run(delete_entries, channel, entries[:posted], token)
+
+        return len(entries)
+
+
+async def flush_digests_async():
+    """
+    The asyncio equivalent of flush_digests.
+    """
+    channels = due_channels(await app.async_db.run(read_windows), _now())
+    adrs = 0
+    failures = []
+
+    for channel_number, channel in enumerate(channels, start=1):
+
+        try:
+            adrs += await publish_digest_async(channel)
+        except Exception as e:
+            print(f"Failed to post the ADR digest to {channel}: {e}", file=sys.stderr)
+            failures.append(e)
+
+        report_progress(channel_number, len(channels))
+
+    if failures:
+        raise failures[0]
+
+    return {"channels": len(channels), "adrs": adrs}
+
+
+async def _run_flusher_async():
+    """
+    The body of the flushing task.
+    """
+    while True:
+
+        try:
+            await flush_digests_async()
+            wait = _next_close(await app.async_db.run(read_windows), _now())
+
+        except Exception as e:
+
+            print(f"Failed to flush ADR digests, will retry: {e}", file=sys.stderr)
+            wait = MAX_FLUSH_WAIT
+
+        try:
+            await asyncio.wait_for(_async_flusher_wake.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+
+        _async_flusher_wake.clear()
+
+
+def start_flusher_async():
+    """
+    Starts the flushing task on the running event loop, on first use.
+    """
+    global _async_flusher, _async_flusher_wake
+
+    if _async_flusher is None and app.ADR_DIGEST_WINDOW:
+        _async_flusher_wake = asyncio.Event()
+        _async_flusher = asyncio.get_running_loop().create_task(_run_flusher_async())
+
+
+async def stop_flusher_async():
+    """
+    Cancels the flushing task at shutdown, anything queued is posted by
+    the next process once its window closes.
+    """
+    global _async_flusher
+
+    if _async_flusher is not None:
+
+        _async_flusher.cancel()
+
+        try:
+            await _async_flusher
+        except asyncio.CancelledError:
+            pass
+
+        _async_flusher = None
+
+
+async def queue_adr_async(issue_key, blocks, channels):
+    """
+    The asyncio equivalent of queue_adr.
+    """
+    if not channels:
+        return
+
+    await app.async_db.run(write_entries, issue_key, channels, blocks)
+
+    start_flusher_async()
+    _async_flusher_wake.set()
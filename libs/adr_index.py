@@ -0,0 +1,247 @@
+"""
+    adr_index.py -  An in-process inverted index over ADR keys, summaries,
+                    statuses and value-streams, answering the /adr slash
+                    command without calling JIRA.
+
+                    The index is loaded from ADR_INDEX_JQL in the background
+                    the first time it is used, picks up ADRs changed in
+                    JIRA every ADR_INDEX_REFRESH seconds, and is updated
+                    straight away whenever an ADR is published.
+"""
+
+import re
+import sys
+import math
+import time
+import asyncio
+import bisect
+import threading
+import app
+from libs.jira_search import PagedJql, AsyncPagedJql, ADR_FIELDS
+
+# Words are runs of letters and digits, keys are also indexed whole e.g. adr-12
+TOKEN_PATTERN       = re.compile(r"[a-z0-9]+")
+KEY_PATTERN         = re.compile(r"^([A-Z][A-Z0-9_]*)-(\d+)$")
+
+
+def tokenise(text):
+    """
+    Splits text into lower case search terms.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def adr_document(issue):
+    """
+    Reduces an ADR from JIRA to what the index keeps, and the slash command shows.
+    """
+    fields = issue['fields']
+
+    return {
+        "key": issue['key'],
+        "summary": fields.get('summary') or "",
+        "status": (fields.get('customfield_10241') or {}).get('value', ""),
+        "author": (fields.get('assignee') or {}).get('displayName', ""),
+        "value_streams": [value_stream['value'] for value_stream in fields.get('customfield_10383') or []]
+    }
+
+
+def _document_terms(document):
+    terms = {document['key'].lower()}
+    terms.update(tokenise(document['key']))
+    terms.update(tokenise(document['summary']))
+    terms.update(tokenise(document['status']))
+
+    for value_stream in document['value_streams']:
+        terms.update(tokenise(value_stream))
+
+    return terms
+
+
+def _newest_first(key):
+    """
+    Sorts ADR-10 after ADR-9, and the most recent ADRs first.
+    """
+    match = KEY_PATTERN.match(key)
+    if match is None:
+        return (key, 0)
+
+    return (match.group(1), -int(match.group(2)))
+
+
+class AdrIndex:
+    """
+    Maps each search term to the keys of the ADRs containing it. A sorted
+    vocabulary of the terms allows prefix searches, so 'mort' finds ADRs
+    impacting Mortgages.
+    """
+
+    def __init__(self):
+        self._lock          = threading.Lock()
+        self._documents     = {}
+        self._terms         = {}
+        self._postings      = {}
+        self._vocabulary    = []
+        self._refreshed_at  = None
+        self._refreshing    = False
+        self._refresh_task  = None
+
+    @property
+    def ready(self):
+        """
+        True once the index has been loaded from JIRA.
+        """
+        return self._refreshed_at is not None
+
+    def update(self, issue):
+        """
+        Adds an ADR to the index, or replaces what we had for it.
+
+        Args:
+        issue: The ADR as returned by JIRA, with at least the ADR_FIELDS
+        """
+        document = adr_document(issue)
+        terms = _document_terms(document)
+        key = document['key']
+
+        with self._lock:
+
+            for term in self._terms.get(key, set()) - terms:
+                self._postings[term].discard(key)
+
+            for term in terms:
+                if term not in self._postings:
+                    self._postings[term] = set()
+                    bisect.insort(self._vocabulary, term)
+                self._postings[term].add(key)
+
+            self._documents[key] = document
+            self._terms[key] = terms
+
+    def get(self, key):
+        """
+        Returns the document for an ADR key, or None.
+        """
+        return self._documents.get(key.upper())
+
+    def _matching(self, term):
+        # Every key containing a term beginning with the search term
+        position = bisect.bisect_left(self._vocabulary, term)
+        keys = set()
+
+        while position < len(self._vocabulary) and self._vocabulary[position].startswith(term):
+            keys |= self._postings[self._vocabulary[position]]
+            position += 1
+
+        return keys
+
+    def search(self, text, limit):
+        """
+        Finds the ADRs containing every term in text.
+
+        Returns:
+        (total matches, [up to limit documents, most recent first])
+        """
+        terms = tokenise(text)
+        if not terms:
+            return 0, []
+
+        with self._lock:
+
+            keys = None
+            for term in sorted(terms, key=len, reverse=True):
+                keys = self._matching(term) if keys is None else keys & self._matching(term)
+                if not keys:
+                    return 0, []
+
+            documents = [self._documents[key] for key in sorted(keys, key=_newest_first)[:limit]]
+
+        return len(keys), documents
+
+    def _start_refresh(self):
+        """
+        Works out whether a refresh is due, and claims it.
+
+        Returns:
+        The JQL to load, or None if no refresh is due
+        """
+        with self._lock:
+
+            if self._refreshing:
+                return None
+
+            if self._refreshed_at is None:
+                jql = app.ADR_INDEX_JQL
+
+            elif time.monotonic() - self._refreshed_at >= app.ADR_INDEX_REFRESH:
+                # JQL only has minute precision, so look back a minute further
+                minutes = math.ceil((time.monotonic() - self._refreshed_at) / 60) + 1
+                jql = f"({app.ADR_INDEX_JQL}) AND updated >= -{minutes}m"
+
+            else:
+                return None
+
+            self._refreshing = True
+
+        return jql
+
+    def _finish_refresh(self, started, succeeded):
+        with self._lock:
+            self._refreshing = False
+            if succeeded:
+                self._refreshed_at = started
+
+    def _refresh(self, jql):
+        started = time.monotonic()
+        succeeded = False
+
+        try:
+            for issue in PagedJql(jql, ADR_FIELDS):
+                self.update(issue)
+            succeeded = True
+
+        except Exception as e:
+
+            print(f"Failed to refresh the ADR index: {e}", file=sys.stderr)
+
+        finally:
+
+            self._finish_refresh(started, succeeded)
+
+    def ensure_fresh(self):
+        """
+        Loads, or refreshes, the index in a background thread if it's due.
+        """
+        jql = self._start_refresh()
+        if jql is not None:
+            threading.Thread(target=self._refresh, args=(jql,), name="archibot-adr-index", daemon=True).start()
+
+    async def _refresh_async(self, jql):
+        started = time.monotonic()
+        succeeded = False
+
+        try:
+            async for issue in AsyncPagedJql(jql, ADR_FIELDS):
+                self.update(issue)
+            succeeded = True
+
+        except Exception as e:
+
+            print(f"Failed to refresh the ADR index: {e}", file=sys.stderr)
+
+        finally:
+
+            self._finish_refresh(started, succeeded)
+
+    def ensure_fresh_async(self):
+        """
+        The asyncio equivalent of ensure_fresh, the refresh runs as a task
+        on the current event loop.
+        """
+        jql = self._start_refresh()
+        if jql is not None:
+            self._refresh_task = asyncio.ensure_future(self._refresh_async(jql))
+
+
+# Shared by every request in the process
+adr_index = AdrIndex()
@@ -0,0 +1,184 @@
+"""
+    async_activities.py -   The asyncio versions of the publishers in
+                            jira_activities.py, run as coroutines under
+                            asgi.py so that a single process can have
+                            hundreds of publishes waiting on JIRA and Slack
+                            at once. The messages are built by the same
+                            helpers, so both versions post the same thing.
+"""
+
+import weakref
+import asyncio
+import app
+from libs.template import render_template
+from libs.jobs import report_progress
+from libs.adr_index import adr_index
+from libs.message_builder import AsyncMessageBuilder
+from libs.message_ledger import read_ledger_async, publish_to_channel_async, UNCHANGED
+from libs.adr_digest import queue_adr_async
+from libs.metrics import PUBLISH_MESSAGES
+from libs.jira_search import AGENDA_FIELDS, ADR_FIELDS, SCORECARD_FIELDS
+from libs.jira_mirror import AsyncMirroredJql
+from libs.jira_activities import _agenda_header_config, _agenda_item_config, _adr_message, _scorecard_item_config
+
+# Bounds on the JIRA searches and Slack posts a single publish runs at once
+_semaphores = {}
+
+# The asyncio equivalent of the locks in message_ledger.py
+_issue_locks = weakref.WeakValueDictionary()
+
+
+def _bounded(name, limit):
+    """
+    Returns a named semaphore, created on first use inside the event loop.
+    """
+    if name not in _semaphores:
+        _semaphores[name] = asyncio.Semaphore(limit)
+
+    return _semaphores[name]
+
+
+async def publish_agenda_async():
+    """
+    Publishes the TDA Agenda to the TDA Slack channel, see publish_agenda
+    """
+
+    # The issues which fit the criteria, read from the local mirror of the filter
+    agenda_search   = AsyncMirroredJql(app.JIRA_SEARCH_FILTER, AGENDA_FIELDS)
+    agenda_issues   = agenda_search.__aiter__()
+
+    # Only the first issue is needed to know whether TDA is going ahead
+    first_issue     = await anext(agenda_issues, None)
+
+    next_wednesday_date, template_config = _agenda_header_config()
+
+    if first_issue is None:
+        message_builder = AsyncMessageBuilder(app.SLACK_CHANNEL, f"TDA Cancelled: {next_wednesday_date}")
+    else:
+        message_builder = AsyncMessageBuilder(app.SLACK_CHANNEL, f"TDA Agenda: {next_wednesday_date}")
+
+    await message_builder.add(render_template("tda_agenda_header", template_config))
+
+    if first_issue is None:
+
+        await message_builder.add(render_template("tda_agenda_noitems", {}))
+
+    else:
+
+        await message_builder.add(render_template("tda_agenda", _agenda_item_config(first_issue)))
+        report_progress(1, agenda_search.total)
+
+        async for issue_number, agenda_issue in _numbered(agenda_issues, start=2):
+            await message_builder.add(render_template("tda_agenda", _agenda_item_config(agenda_issue)))
+            report_progress(issue_number, agenda_search.total)
+
+    PUBLISH_MESSAGES.observe(await message_builder.flush(), "publish_agenda")
+
+
+async def _numbered(async_iterable, start):
+    """
+    The async for equivalent of enumerate()
+    """
+    number = start
+    async for item in async_iterable:
+        yield number, item
+        number += 1
+
+
+async def publish_adr_async(issue_key, issue_updated=None):
+    """
+    Broadcasts the state of an ADR to the channels of those teams impacted
+    by it, see publish_adr
+    """
+    issue_data = await app.async_jira.issue(issue_key, fields=ADR_FIELDS, updated=issue_updated)
+
+    # Keep the /adr search index in step with what was published
+    adr_index.update(issue_data)
+
+    message_adr, vs_slack_ids = _adr_message(issue_data)
+
+    if message_adr is None:
+        return
+
+    # In digest mode the message waits to be posted with the rest of its window
+    if app.ADR_DIGEST_WINDOW:
+        await queue_adr_async(issue_data['key'], message_adr, vs_slack_ids)
+        return
+
+    fanout = _bounded("adr_fanout", app.ADR_FANOUT_CONCURRENCY)
+    posted = 0
+
+    async def post(vs_slack_id):
+        nonlocal posted
+
+        async with fanout:
+            outcome = await publish_to_channel_async(
+                issue_data['key'], vs_slack_id, message_adr, "ADR Published", ledger.get(vs_slack_id)
+            )
+
+        posted += 1
+        report_progress(posted, len(vs_slack_ids))
+
+        return outcome
+
+    # Hold the ADR so two publishes of it can't both post a first message
+    async with _issue_lock_async(issue_data['key']):
+        ledger  = await read_ledger_async(issue_data['key'])
+        results = await asyncio.gather(*(post(vs_slack_id) for vs_slack_id in vs_slack_ids), return_exceptions=True)
+
+    PUBLISH_MESSAGES.observe(
+        sum(1 for result in results if not isinstance(result, BaseException) and result != UNCHANGED),
+        "publish_adr"
+    )
+
+    # Let every post finish before reporting the first failure
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+def _issue_lock_async(issue_key):
+    """
+    Returns the lock serialising publications of one ADR in the event loop.
+    """
+    return _issue_locks.setdefault(issue_key, asyncio.Lock())
+
+
+async def _scorecard_filter_async(scorecard_topic):
+    """
+    Reads the filter behind a single scorecard topic from the mirror.
+    """
+    async with _bounded("scorecard", app.SCORECARD_CONCURRENCY):
+        return [issue async for issue in AsyncMirroredJql(scorecard_topic['filter_id'], SCORECARD_FIELDS)]
+
+
+async def scorecard_tasks_by_user_async():
+    """
+    Displays tasks currently assigned to users, organised by Scorecard
+    category, see scorecard_tasks_by_user
+    """
+    message_builder = AsyncMessageBuilder(app.AA_SLACK_CHANNEL, "Scorecard Progress Update")
+
+    # Every filter runs at once, and topics are posted in order as they complete
+    topic_searches = [asyncio.ensure_future(_scorecard_filter_async(topic)) for topic in app.SCORECARD_MAP]
+
+    try:
+        for topic_number, (scorecard_topic, topic_search) in enumerate(zip(app.SCORECARD_MAP, topic_searches), start=1):
+
+            filter_data = await topic_search
+
+            template_config = {"%SCORECARD_TOPIC%": scorecard_topic['name']}
+            await message_builder.add(render_template("scorecard_topic", template_config))
+
+            for issue in filter_data:
+                await message_builder.add(render_template("scorecard_item", _scorecard_item_config(issue)))
+
+            report_progress(topic_number, len(app.SCORECARD_MAP))
+
+    finally:
+
+        # Don't leave searches running if an earlier topic failed
+        for topic_search in topic_searches:
+            topic_search.cancel()
+
+    PUBLISH_MESSAGES.observe(await message_builder.flush(), "scorecard_tasks_by_user")
@@ -0,0 +1,112 @@
+"""
+    async_db.py -   Database access for asgi.py. The statements themselves
+                    are the same functions of a SQLAlchemy Connection used
+                    by the Flask app, run with the aiomysql driver so the
+                    event loop is never blocked on MySQL.
+"""
+
+import asyncio
+import sqlalchemy
+import app
+from libs.event_analytics import create_events_schema
+from libs.idempotency import create_idempotency_schema
+from libs.message_ledger import create_ledger_schema
+from libs.jira_mirror import create_mirror_schema
+from libs.confluence_ingest import create_confluence_schema
+from libs.event_spool import create_spool_schema
+from libs.adr_digest import create_digest_schema
+from libs.metrics import instrument_engine
+
+
+class AsyncDatabase:
+    """
+    Runs functions of a Connection, i.e. func(conn, *args), without blocking
+    the event loop.
+
+    With an AsyncEngine they are run through run_sync, which hands the
+    waiting to the async driver. Otherwise a regular Engine is used from a
+    thread, which is how Cloud SQL is reached as its connector has no async
+    MySQL driver.
+    """
+
+    def __init__(self, engine, setup=()):
+        """
+        Args:
+        engine: An AsyncEngine, or a regular Engine
+        setup: Functions of a Connection run once before anything else, e.g. to create tables
+        """
+        self.engine         = engine
+        self._setup         = list(setup)
+        self._setup_lock    = None
+
+    async def run(self, func, *args):
+        """
+        Calls func(conn, *args) with an open connection and returns its result.
+        The function is responsible for committing.
+        """
+        if self._setup:
+            await self._run_setup()
+
+        return await self._call(func, *args)
+
+    async def _run_setup(self):
+        if self._setup_lock is None:
+            self._setup_lock = asyncio.Lock()
+
+        async with self._setup_lock:
+            while self._setup:
+                await self._call(self._setup[0])
+                self._setup.pop(0)
+
+    async def _call(self, func, *args):
+        if hasattr(self.engine, "sync_engine"):
+            async with self.engine.connect() as conn:
+                return await conn.run_sync(func, *args)
+
+        return await asyncio.to_thread(self._run_in_thread, func, *args)
+
+    def _run_in_thread(self, func, *args):
+        with self.engine.connect() as conn:
+            return func(conn, *args)
+
+
+def connect_async():
+    """
+    Creates the AsyncDatabase for the configured DB_TYPE.
+    """
+    if app.DB_TYPE == "local":
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        print("Establishing Local Async DB Connection")
+
+        engine = create_async_engine(
+            sqlalchemy.engine.url.URL.create(
+                drivername="mysql+aiomysql",
+                username=app.DB_USER,
+                password=app.DB_PASS,
+                host=app.DB_HOST,
+                port=app.DB_PORT,
+                database=app.DB_DATABASE,
+            ),
+            pool_size=5,
+            max_overflow=2,
+            pool_timeout=30,
+            pool_recycle=1800,
+        )
+
+        # The same statement and pool metrics as the regular engine
+        instrument_engine(engine.sync_engine)
+
+        return AsyncDatabase(engine, setup=[
+            create_events_schema,
+            create_idempotency_schema,
+            create_ledger_schema,
+            create_mirror_schema,
+            create_confluence_schema,
+            create_spool_schema,
+            create_digest_schema
+        ])
+
+    # The Cloud SQL connector only offers asyncpg, so share the regular pool,
+    # which has already been instrumented and had its tables created
+    return AsyncDatabase(app.db)
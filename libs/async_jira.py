@@ -0,0 +1,72 @@
+"""
+    async_jira.py -     A minimal asyncio JIRA client, covering the two REST
+                        calls the publishers make, for use under asgi.py
+                        The arguments and results match atlassian.Jira so
+                        the same cache and field handling can be used.
+"""
+
+import aiohttp
+
+# The most connections held open to JIRA at once
+MAX_CONNECTIONS     = 100
+
+
+class AsyncJira:
+    """
+    Searches and fetches issues with aiohttp. The session is created on
+    first use, as it has to be created inside the running event loop.
+    """
+
+    def __init__(self, url, username, password, api_version="2", timeout=75):
+        self.url            = url.rstrip("/")
+        self.api_root       = f"{self.url}/rest/api/{api_version}"
+        self._auth          = aiohttp.BasicAuth(username, password)
+        self._timeout       = aiohttp.ClientTimeout(total=timeout)
+        self._session       = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                auth=self._auth,
+                connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS),
+                headers={"Accept": "application/json"},
+                timeout=self._timeout,
+                raise_for_status=True
+            )
+
+        return self._session
+
+    async def _get(self, path, params):
+        # aiohttp won't send None, and lists are sent comma separated as JIRA expects
+        params = {
+            name: ",".join(value) if isinstance(value, (list, tuple)) else str(value)
+            for name, value in params.items() if value is not None
+        }
+
+        async with self._get_session().get(f"{self.api_root}/{path}", params=params) as response:
+            return await response.json()
+
+    async def jql(self, jql, fields="*all", start=0, limit=None, expand=None):
+        """
+        The equivalent of Jira.jql(), returns one page of search results.
+        """
+        return await self._get("search", {
+            "jql": jql,
+            "fields": fields,
+            "startAt": start,
+            "maxResults": limit,
+            "expand": expand
+        })
+
+    async def issue(self, key, fields="*all", expand=None):
+        """
+        The equivalent of Jira.issue()
+        """
+        return await self._get(f"issue/{key}", {"fields": fields, "expand": expand})
+
+    async def close(self):
+        """
+        Closes the shared session, used at shutdown.
+        """
+        if self._session is not None:
+            await self._session.close()
@@ -0,0 +1,56 @@
+"""
+    auth.py -   Checks the API key on inbound webhooks. The key is looked
+                up when a request arrives, rather than when the routes are
+                declared, so that secrets are not needed at import time.
+"""
+
+import hmac
+from functools import wraps
+from flask import request, jsonify
+import app
+
+# The header the API key is expected in
+API_KEY_HEADER = 'x-api-key'
+
+
+def require_api_key(view_function):
+    """
+    A decorator which rejects requests without the correct API key.
+
+    Returns:
+    The wrapped view, or HTTP 403 + {"message": "Invalid API key"}
+    """
+
+    @wraps(view_function)
+    def decorated_function(*args, **kwargs):
+
+        if api_key_valid(request.headers.get(API_KEY_HEADER, '')):
+            return view_function(*args, **kwargs)
+
+        return jsonify({"message": "Invalid API key"}), 403
+
+    return decorated_function
+
+
+def api_key_valid(provided_key):
+    """
+    Compares a key with API_KEY, in constant time.
+    """
+    return hmac.compare_digest(provided_key.encode("utf-8"), str(app.API_KEY).encode("utf-8"))
+
+
+def require_api_key_async(view_function):
+    """
+    The asyncio equivalent of require_api_key, for Starlette end-points.
+    """
+    from starlette.responses import JSONResponse
+
+    @wraps(view_function)
+    async def decorated_function(request):
+
+        if api_key_valid(request.headers.get(API_KEY_HEADER, '')):
+            return await view_function(request)
+
+        return JSONResponse({"message": "Invalid API key"}, status_code=403)
+
+    return decorated_function
@@ -0,0 +1,71 @@
+"""
+    channel_router.py -     Works out which Slack channels hear about an ADR,
+                            from the value-streams it impacts. The lookup
+                            table is built once from SLACK_CHANNEL_MAP.
+"""
+
+
+def _normalise(name):
+    """
+    Value-stream names are matched ignoring case and extra whitespace.
+    """
+    return " ".join(str(name).split()).casefold()
+
+
+def _as_list(value):
+    """
+    Allows a single channel / stream or a list of them in the configuration.
+    """
+    return [value] if isinstance(value, str) else list(value)
+
+
+class ValueStreamRouter:
+    """
+    Maps value-stream names to Slack channels.
+
+    A value-stream may map to several channels, and a channel may serve several
+    value-streams. Aliases let alternative names (e.g. "BB" for "Business
+    Banking") resolve to the same channels.
+    """
+
+    def __init__(self, channel_map, default_channel, aliases=None):
+        """
+        Args:
+        channel_map: {value-stream: channel or [channels]}, i.e. SLACK_CHANNEL_MAP
+        default_channel: Where value-streams without a mapping are sent
+        aliases: Optional {alias: value-stream or [value-streams]}
+        """
+        self.default_channel = default_channel
+        self._routes = {}
+
+        for value_stream, channels in channel_map.items():
+            self._add(_normalise(value_stream), _as_list(channels))
+
+        for alias, value_streams in (aliases or {}).items():
+            for value_stream in _as_list(value_streams):
+                self._add(_normalise(alias), self._routes.get(_normalise(value_stream), []))
+
+    def _add(self, name, channels):
+        """
+        Adds channels to a name, keeping the first-seen order without repeats.
+        """
+        routes = self._routes.setdefault(name, [])
+        for channel in channels:
+            if channel not in routes:
+                routes.append(channel)
+
+    def channels_for(self, value_streams):
+        """
+        Resolves a list of value-stream names to the channels to post to.
+
+        Returns:
+        A list of channel ids, in order and without duplicates.
+        """
+        channels = []
+
+        for value_stream in value_streams:
+            for channel in self._routes.get(_normalise(value_stream)) or [self.default_channel]:
+                if channel not in channels:
+                    channels.append(channel)
+
+        return channels
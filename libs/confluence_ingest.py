@@ -0,0 +1,363 @@
+"""
+    confluence_ingest.py -  Feeds the pages of a Confluence space through
+                            document_tools.evaluate_document, a run at a time.
+
+                            The space is listed a page of results at a time,
+                            with only each page's version number. Pages whose
+                            version differs from the last run are fetched, their
+                            bodies split into chunks of at most
+                            CONFLUENCE_CHUNK_SIZE characters, and only chunks
+                            whose hash hasn't been seen for the page before are
+                            evaluated. A re-run therefore costs the listing plus
+                            whatever has changed since.
+"""
+
+import asyncio
+import hashlib
+import datetime
+import threading
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor
+import sqlalchemy
+import app
+from libs.jobs import report_progress
+from libs.document_tools import evaluate_document
+
+SCHEMA_STATEMENTS   = [
+    """
+    CREATE TABLE IF NOT EXISTS confluence_pages (
+        page_id VARCHAR(32) NOT NULL PRIMARY KEY,
+        space_key VARCHAR(255) NOT NULL,
+        title VARCHAR(255) NOT NULL,
+        version INT NOT NULL,
+        ingested_at DATETIME NOT NULL,
+        INDEX idx_confluence_pages_space (space_key)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS confluence_chunks (
+        page_id VARCHAR(32) NOT NULL,
+        chunk_index INT NOT NULL,
+        content_hash CHAR(64) NOT NULL,
+        PRIMARY KEY (page_id, chunk_index)
+    )
+    """
+]
+
+# Storage format tags which start a new line of text
+BLOCK_TAGS          = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote", "table"}
+
+# The pools fetching pages and evaluating chunks, created on first use
+_pools              = {}
+_pools_lock         = threading.Lock()
+
+
+def ensure_confluence_schema(engine):
+    """
+    Creates the ingestion tables if they don't already exist.
+    """
+    with engine.connect() as conn:
+        create_confluence_schema(conn)
+
+
+def create_confluence_schema(conn):
+    """
+    The body of ensure_confluence_schema, on an open connection.
+    """
+    for statement in SCHEMA_STATEMENTS:
+        conn.execute(sqlalchemy.text(statement))
+    conn.commit()
+
+
+def _shared_pool(name, max_workers):
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"archibot-{name}")
+
+        return _pools[name]
+
+
+class _StorageText(HTMLParser):
+    """
+    Collects the text of a page in Confluence's storage format, one line
+    per paragraph, heading, list item or table row.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines  = [[]]
+
+    def handle_starttag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self.lines.append([])
+
+    def handle_endtag(self, tag):
+        if tag in BLOCK_TAGS:
+            self.lines.append([])
+
+    def handle_data(self, data):
+        self.lines[-1].append(data)
+
+
+def storage_to_text(storage):
+    """
+    Converts a page body in storage format to plain text, dropping markup
+    and blank lines.
+    """
+    parser = _StorageText()
+    parser.feed(storage)
+    parser.close()
+
+    lines = (" ".join("".join(line).split()) for line in parser.lines)
+
+    return "\n".join(line for line in lines if line)
+
+
+def chunk_text(text, chunk_size):
+    """
+    Splits text into chunks of at most chunk_size characters, breaking
+    between lines where possible and between words otherwise.
+    """
+    chunks = []
+    current = ""
+
+    for line in text.split("\n"):
+
+        # Lines too long for a chunk of their own are split between words
+        while len(line) > chunk_size:
+            split_at = line.rfind(" ", 0, chunk_size + 1)
+            if split_at <= 0:
+                split_at = chunk_size
+
+            if current:
+                chunks.append(current)
+                current = ""
+
+            chunks.append(line[:split_at])
+            line = line[split_at:].lstrip()
+
+        if current and len(current) + 1 + len(line) > chunk_size:
+            chunks.append(current)
+            current = ""
+
+        current = f"{current}\n{line}" if current else line
+
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+def content_hash(chunk):
+    """
+    Returns the hash a chunk is recognised by on later runs.
+    """
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+
+def read_versions(conn, space_key):
+    """
+    Returns {page_id: version} for the pages ingested from a space.
+    """
+    rows = conn.execute(
+        sqlalchemy.text("SELECT page_id, version FROM confluence_pages WHERE space_key = :space_key"),
+        {"space_key": space_key}
+    )
+
+    return {row.page_id: row.version for row in rows}
+
+
+def read_chunk_hashes(conn, page_id):
+    """
+    Returns the set of chunk hashes stored for a page.
+    """
+    rows = conn.execute(
+        sqlalchemy.text("SELECT content_hash FROM confluence_chunks WHERE page_id = :page_id"),
+        {"page_id": page_id}
+    )
+
+    return {row.content_hash for row in rows}
+
+
+def write_page(conn, page_id, space_key, title, version, hashes):
+    """
+    Records a page as ingested at a version, along with its chunk hashes.
+    """
+    conn.execute(sqlalchemy.text("DELETE FROM confluence_chunks WHERE page_id = :page_id"), {"page_id": page_id})
+
+    if hashes:
+        conn.execute(
+            sqlalchemy.text(
+                "INSERT INTO confluence_chunks (page_id, chunk_index, content_hash) "
+                "VALUES (:page_id, :chunk_index, :content_hash)"
+            ),
+            [
+                {"page_id": page_id, "chunk_index": chunk_index, "content_hash": chunk_hash}
+                for chunk_index, chunk_hash in enumerate(hashes)
+            ]
+        )
+
+    conn.execute(
+        sqlalchemy.text(
+            "INSERT INTO confluence_pages (page_id, space_key, title, version, ingested_at) "
+            "VALUES (:page_id, :space_key, :title, :version, :ingested_at) "
+            "ON DUPLICATE KEY UPDATE space_key = VALUES(space_key), title = VALUES(title), "
+            "version = VALUES(version), ingested_at = VALUES(ingested_at)"
+        ),
+        {
+            "page_id": page_id,
+            "space_key": space_key,
+            "title": title[:255],
+            "version": version,
+            "ingested_at": datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        }
+    )
+    conn.commit()
+
+
+def delete_pages(conn, page_ids):
+    """
+    Forgets pages which have been removed from the space.
+    """
+    for page_id in page_ids:
+        conn.execute(sqlalchemy.text("DELETE FROM confluence_chunks WHERE page_id = :page_id"), {"page_id": page_id})
+        conn.execute(sqlalchemy.text("DELETE FROM confluence_pages WHERE page_id = :page_id"), {"page_id": page_id})
+    conn.commit()
+
+
+def space_pages(space_key):
+    """
+    Lists every page in a space with its version, a page of results at a time.
+    """
+    start = 0
+
+    while True:
+
+        results = app.confluence.get("rest/api/content", params={
+            "spaceKey": space_key,
+            "type": "page",
+            "expand": "version",
+            "start": start,
+            "limit": app.CONFLUENCE_PAGE_SIZE
+        })
+        pages = results.get("results", [])
+
+        yield from pages
+
+        start += len(pages)
+
+        # Confluence links to the next page of results while there is one
+        if not pages or "next" not in results.get("_links", {}):
+            return
+
+
+def ingest_page(space_key, page_id):
+    """
+    Fetches a page, evaluates the chunks we haven't seen before and records
+    the version ingested.
+
+    Returns:
+    The number of chunks evaluated
+    """
+    page = app.confluence.get(f"rest/api/content/{page_id}", params={"expand": "body.storage,version"})
+
+    chunks = chunk_text(storage_to_text(page['body']['storage']['value']), app.CONFLUENCE_CHUNK_SIZE)
+    hashes = [content_hash(chunk) for chunk in chunks]
+
+    with app.db.connect() as conn:
+        known_hashes = read_chunk_hashes(conn, page_id)
+
+    # Chunks are evaluated side by side, the version is only recorded once
+    # they have all succeeded so a failed page is retried on the next run
+    evaluation_pool = _shared_pool("document_evaluation", app.EVALUATION_WORKERS)
+    evaluations = [
+        evaluation_pool.submit(evaluate_document, {
+            "page_id": page_id,
+            "title": page['title'],
+            "chunk_index": chunk_index,
+            "text": chunk
+        })
+        for chunk_index, (chunk, chunk_hash) in enumerate(zip(chunks, hashes))
+        if chunk_hash not in known_hashes
+    ]
+
+    for evaluation in evaluations:
+        evaluation.result()
+
+    with app.db.connect() as conn:
+        write_page(conn, page_id, space_key, page['title'], page['version']['number'], hashes)
+
+    return len(evaluations)
+
+
+def ingest_confluence(space_key=None):
+    """
+    Brings the evaluations for a space up to date, run as a background job.
+
+    Args:
+    space_key: The Confluence space, defaults to CONFLUENCE_SPACE
+
+    Returns:
+    A summary of the run, kept as the job's result
+    """
+    space_key = space_key or app.CONFLUENCE_SPACE
+
+    with app.db.connect() as conn:
+        known_versions = read_versions(conn, space_key)
+
+    page_pool = _shared_pool("confluence_ingest", app.CONFLUENCE_WORKERS)
+
+    # Only a few pages are fetched ahead, so the listing streams rather than
+    # queueing every page in the space
+    in_flight = threading.BoundedSemaphore(app.CONFLUENCE_WORKERS * 2)
+    ingests = []
+    seen = set()
+
+    def release(_):
+        in_flight.release()
+
+    for pages_listed, page in enumerate(space_pages(space_key), start=1):
+
+        seen.add(page['id'])
+
+        if known_versions.get(page['id']) != page['version']['number']:
+            in_flight.acquire()
+            ingest = page_pool.submit(ingest_page, space_key, page['id'])
+            ingest.add_done_callback(release)
+            ingests.append(ingest)
+
+        report_progress(pages_listed)
+
+    # Let every page finish before reporting the first failure
+    chunks_evaluated = 0
+    failures = []
+    for ingest in ingests:
+        try:
+            chunks_evaluated += ingest.result()
+        except Exception as e:
+            failures.append(e)
+
+    if failures:
+        raise failures[0]
+
+    # The whole space was listed, so anything we didn't see has gone
+    removed = set(known_versions) - seen
+    if removed:
+        with app.db.connect() as conn:
+            delete_pages(conn, removed)
+
+    return {
+        "space": space_key,
+        "pages": len(seen),
+        "pages_changed": len(ingests),
+        "pages_removed": len(removed),
+        "chunks_evaluated": chunks_evaluated
+    }
+
+
+async def ingest_confluence_async(space_key=None):
+    """
+    Runs ingest_confluence on a thread for asgi.py, there's no asyncio
+    Confluence client and the evaluation itself is blocking.
+    """
+    return await asyncio.to_thread(ingest_confluence, space_key)
@@ -0,0 +1,102 @@
+"""
+    context.py -    The application context. Secrets, the database and the
+                    Atlassian and Slack clients are created the first time
+                    they are used, rather than when app.py is imported, so
+                    the container can start serving as soon as possible.
+"""
+
+import os
+import json
+import time
+import threading
+
+# Shared state for the cached secrets and the lazily created dependencies.
+_secrets_lock       = threading.Lock()
+_secrets_data       = None
+_secrets_loaded_at  = 0.0
+_factories          = {}
+_instances          = {}
+_instance_locks     = {}
+
+
+def _fetch_secrets():
+    """
+    Reads the secret payload from Google Secrets Manager. The client library
+    is imported here as it is slow to import and not needed until now.
+
+    SECRETS_FILE may name a local JSON file holding the same payload, which
+    is used instead for local development and benchmarking.
+    """
+    if os.environ.get('SECRETS_FILE'):
+        with open(os.environ['SECRETS_FILE'], encoding="UTF-8") as secrets_file:
+            return json.load(secrets_file)
+
+    from google.cloud import secretmanager
+
+    secrets_client = secretmanager.SecretManagerServiceClient()
+
+    # The link to the secrets, originates from Github Secrets
+    secret_data_raw = secrets_client.access_secret_version(request={"name": os.environ['SECRET_REF']})
+
+    return json.loads(secret_data_raw.payload.data.decode("UTF-8"))
+
+
+def get_secrets(ttl):
+    """
+    Returns the decoded secrets, only going back to Secrets Manager once the
+    cached copy is older than ttl seconds.
+    """
+    global _secrets_data, _secrets_loaded_at
+
+    with _secrets_lock:
+        if _secrets_data is None or time.monotonic() - _secrets_loaded_at > ttl:
+            _secrets_data = _fetch_secrets()
+            _secrets_loaded_at = time.monotonic()
+
+        return _secrets_data
+
+
+def register(name, factory):
+    """
+    Registers the function which creates a dependency on first use.
+    """
+    _factories[name] = factory
+    _instance_locks[name] = threading.Lock()
+
+
+def is_registered(name):
+    """
+    Returns True if a dependency with this name has been registered.
+    """
+    return name in _factories
+
+
+def get(name):
+    """
+    Returns a dependency, creating it if this is the first time it is used.
+    """
+    instance = _instances.get(name)
+
+    if instance is None:
+        with _instance_locks[name]:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = _factories[name]()
+                _instances[name] = instance
+
+    return instance
+
+
+def is_created(name):
+    """
+    Returns True if a dependency has already been created.
+    """
+    return name in _instances
+
+
+def override(name, instance):
+    """
+    Replaces a dependency with an instance created elsewhere, e.g. a client
+    pointed at a local stand-in. The registered factory is not called.
+    """
+    _instances[name] = instance
@@ -4,14 +4,14 @@
 """
 
 # Performs activities
-def evaluate_document():
+def evaluate_document(document):
     """
         Uses Gemini to evaluate documents
 
         Args:
-        None
+        document: A chunk of a Confluence page, {page_id, title, chunk_index, text}
 
         Returns:
         None
     """
-    return "Wibble"
+    raise NotImplementedError(f"Evaluating Confluence page {document['page_id']} isn't implemented yet")
@@ -0,0 +1,366 @@
+"""
+    event_analytics.py -    Keeps hourly and daily rollups of the events table
+                            up to date as batches are written, and serves
+                            grouped counts from them so that reports don't
+                            need to scan every event.
+"""
+
+import json
+import base64
+import datetime
+from collections import Counter
+import sqlalchemy
+from flask import request, jsonify
+import app
+
+# The granularities which can be asked for, and the rollup each is served from
+ROLLUP_TABLES       = {
+    "hour": "events_hourly",
+    "day": "events_daily",
+    "week": "events_daily"
+}
+
+# The columns results can be grouped by, in the order they appear in the keys
+GROUP_COLUMNS       = ["source_system", "contributor", "event_type"]
+
+MAX_SUMMARY_LIMIT   = 1000
+
+SCHEMA_STATEMENTS   = [
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        source_timestamp DOUBLE NOT NULL,
+        source_system VARCHAR(64) NOT NULL,
+        contributor VARCHAR(255) NOT NULL,
+        event_type VARCHAR(255) NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS events_hourly (
+        bucket_start DATETIME NOT NULL,
+        source_system VARCHAR(64) NOT NULL,
+        contributor VARCHAR(255) NOT NULL,
+        event_type VARCHAR(255) NOT NULL,
+        event_count BIGINT UNSIGNED NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket_start, source_system, contributor, event_type),
+        KEY ix_events_hourly_contributor (contributor, bucket_start)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS events_daily (
+        bucket_start DATETIME NOT NULL,
+        source_system VARCHAR(64) NOT NULL,
+        contributor VARCHAR(255) NOT NULL,
+        event_type VARCHAR(255) NOT NULL,
+        event_count BIGINT UNSIGNED NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket_start, source_system, contributor, event_type),
+        KEY ix_events_daily_contributor (contributor, bucket_start)
+    )
+    """
+]
+
+# Indexes added to the events table, which may pre-date this module
+EVENT_INDEXES       = {
+    "ix_events_source_system_time": "(source_system, source_timestamp)",
+    "ix_events_contributor_time": "(contributor, source_timestamp)"
+}
+
+
+def ensure_events_schema(engine):
+    """
+    Creates the events and rollup tables, and the composite indexes on the
+    events table, if they don't already exist.
+    """
+    with engine.connect() as conn:
+        create_events_schema(conn)
+
+
+def create_events_schema(conn):
+    """
+    The body of ensure_events_schema, on an open connection.
+    """
+    for statement in SCHEMA_STATEMENTS:
+        conn.execute(sqlalchemy.text(statement))
+
+    existing_indexes = set(conn.execute(sqlalchemy.text(
+        "SELECT DISTINCT index_name FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() AND table_name = 'events'"
+    )).scalars())
+
+    for index_name, columns in EVENT_INDEXES.items():
+        if index_name not in existing_indexes:
+            conn.execute(sqlalchemy.text(f"CREATE INDEX {index_name} ON events {columns}"))
+
+    conn.commit()
+
+
+def _bucket_start(source_timestamp, granularity):
+    """
+    Works out the start of the hour or day, in UTC, an event falls into.
+    """
+    moment = datetime.datetime.fromtimestamp(float(source_timestamp), datetime.timezone.utc).replace(tzinfo=None)
+
+    if granularity == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def update_rollups(conn, event_rows):
+    """
+    Adds a batch of events to the hourly and daily rollups. This is run on
+    the same connection, and in the same transaction, as the insert of the
+    events themselves so the two can't disagree.
+
+    Args:
+    conn: An open SQLAlchemy connection
+    event_rows: The event rows which have just been inserted
+    """
+    for granularity, table in (("hour", "events_hourly"), ("day", "events_daily")):
+
+        counts = Counter(
+            (
+                _bucket_start(row["source_timestamp"], granularity),
+                row["source_system"],
+                row["contributor"],
+                row["event_type"]
+            )
+            for row in event_rows
+        )
+
+        conn.execute(
+            sqlalchemy.text(
+                f"INSERT INTO {table} (bucket_start, source_system, contributor, event_type, event_count) "
+                "VALUES (:bucket_start, :source_system, :contributor, :event_type, :event_count) "
+                "ON DUPLICATE KEY UPDATE event_count = event_count + VALUES(event_count)"
+            ),
+            [
+                {
+                    "bucket_start": bucket_start,
+                    "source_system": source_system,
+                    "contributor": contributor,
+                    "event_type": event_type,
+                    "event_count": event_count
+                }
+                for (bucket_start, source_system, contributor, event_type), event_count in counts.items()
+            ]
+        )
+
+
+def rebuild_rollups():
+    """
+    Recalculates both rollups from the events table, run as a background job
+    by POST /events/rollups/rebuild once after the rollups are first
+    introduced. Normal operation keeps them up to date.
+
+    Returns:
+    {"events_hourly": rows written, "events_daily": rows written}
+    """
+    with app.db.connect() as conn:
+        return recalculate_rollups(conn)
+
+
+async def rebuild_rollups_async():
+    """
+    The asyncio equivalent of rebuild_rollups.
+    """
+    return await app.async_db.run(recalculate_rollups)
+
+
+def recalculate_rollups(conn):
+    """
+    The body of rebuild_rollups, on an open connection.
+    """
+    rows = {}
+
+    for table, seconds in (("events_hourly", 3600), ("events_daily", 86400)):
+        conn.execute(sqlalchemy.text(f"DELETE FROM {table}"))
+        rows[table] = conn.execute(sqlalchemy.text(
+            f"INSERT INTO {table} (bucket_start, source_system, contributor, event_type, event_count) "
+            f"SELECT DATE_ADD('1970-01-01', INTERVAL FLOOR(source_timestamp / {seconds}) * {seconds} SECOND) "
+            "AS bucket, "
+            "source_system, contributor, event_type, COUNT(*) "
+            "FROM events GROUP BY bucket, source_system, contributor, event_type"
+        )).rowcount
+
+    conn.commit()
+
+    return rows
+
+
+def _encode_cursor(row):
+    """
+    Turns the key of the last row on a page into an opaque cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps(row).encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor):
+    """
+    Reverses _encode_cursor, raising ValueError on anything malformed.
+    """
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def _parse_time(value):
+    """
+    Accepts an ISO 8601 date / datetime, or a unix timestamp.
+    """
+    try:
+        return datetime.datetime.fromtimestamp(float(value), datetime.timezone.utc).replace(tzinfo=None)
+    except (OverflowError, OSError) as e:
+        raise ValueError(f"Timestamp out of range: {value}") from e
+    except ValueError:
+        moment = datetime.datetime.fromisoformat(value)
+
+    # The rollups are held in UTC without a timezone
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return moment
+
+
+def query_summary(conn, granularity, group_by, start, end, filters, limit, after=None):
+    """
+    Reads grouped event counts from the appropriate rollup.
+
+    Args:
+    conn: An open SQLAlchemy connection
+    granularity: hour, day or week
+    group_by: A list of GROUP_COLUMNS to group by
+    start / end: The datetime range, end is exclusive
+    filters: A dict of GROUP_COLUMNS to exact values
+    limit: The page size
+    after: The key of the last row of the previous page, if any
+
+    Returns:
+    A list of dict rows, ordered by bucket and then the grouped columns.
+    """
+    table = ROLLUP_TABLES[granularity]
+
+    # Weeks start on a Monday and are built from the daily rollup
+    if granularity == "week":
+        bucket = "DATE_SUB(bucket_start, INTERVAL WEEKDAY(bucket_start) DAY)"
+    else:
+        bucket = "bucket_start"
+
+    key_columns = ["bucket"] + group_by
+    parameters = {"start": start, "end": end, "limit": limit}
+    where = ["bucket_start >= :start", "bucket_start < :end"]
+
+    for column, value in filters.items():
+        where.append(f"{column} = :filter_{column}")
+        parameters[f"filter_{column}"] = value
+
+    # Keyset pagination, carry on from the last key of the previous page
+    having = ""
+    if after is not None:
+        having = f"HAVING ({', '.join(key_columns)}) > ({', '.join(f':after_{i}' for i in range(len(key_columns)))})"
+        for i, value in enumerate(after):
+            parameters[f"after_{i}"] = value
+
+    statement = (
+        f"SELECT {bucket} AS bucket{''.join(', ' + column for column in group_by)}, SUM(event_count) AS event_count "
+        f"FROM {table} WHERE {' AND '.join(where)} "
+        f"GROUP BY {', '.join(key_columns)} {having} "
+        f"ORDER BY {', '.join(key_columns)} LIMIT :limit"
+    )
+
+    return [dict(row._mapping) for row in conn.execute(sqlalchemy.text(statement), parameters)]
+
+
+def _summary_arguments(args):
+    """
+    Parses the query string of the /events/summary end-point, raising
+    ValueError for anything invalid.
+
+    Returns:
+    (granularity, group_by, start, end, filters, limit, after)
+    """
+    granularity = args.get("granularity", "day")
+    if granularity not in ROLLUP_TABLES:
+        raise ValueError(f"granularity must be one of {', '.join(ROLLUP_TABLES)}")
+
+    group_by = [column for column in args.get("group_by", "source_system,contributor").split(",") if column]
+    if any(column not in GROUP_COLUMNS for column in group_by):
+        raise ValueError(f"group_by may only contain {', '.join(GROUP_COLUMNS)}")
+
+    end = _parse_time(args["to"]) if "to" in args else datetime.datetime.utcnow()
+    start = _parse_time(args["from"]) if "from" in args else end - datetime.timedelta(days=30)
+
+    limit = min(int(args.get("limit", "100")), MAX_SUMMARY_LIMIT)
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+
+    after = _decode_cursor(args["after"]) if "after" in args else None
+    if after is not None and (not isinstance(after, list) or len(after) != len(group_by) + 1):
+        raise ValueError("The cursor doesn't match group_by")
+    filters = {column: args[column] for column in GROUP_COLUMNS if column in args}
+
+    return granularity, group_by, start, end, filters, limit, after
+
+
+def _summary_page(rows, group_by, limit):
+    """
+    Turns the rows read with one extra into a page and the cursor for the next.
+    """
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[0:limit]
+        next_cursor = _encode_cursor([str(rows[-1]["bucket"])] + [rows[-1][column] for column in group_by])
+
+    for row in rows:
+        row["bucket"] = row["bucket"].isoformat() if hasattr(row["bucket"], "isoformat") else str(row["bucket"])
+        row["event_count"] = int(row["event_count"])
+
+    return {"rows": rows, "next": next_cursor}
+
+
+def event_summary():
+    """
+    Serves grouped event counts for the /events/summary end-point.
+
+    Args (query string):
+    granularity: hour, day (default) or week
+    group_by: Comma separated GROUP_COLUMNS, default source_system,contributor
+    from / to: ISO 8601 or unix times, default the last 30 days
+    source_system / contributor / event_type: Optional exact filters
+    limit: The page size, default 100
+    after: The cursor returned with the previous page
+
+    Returns:
+    HTTP 200 + {"rows": [...], "next": cursor or null}, or HTTP 400
+    """
+    try:
+        granularity, group_by, start, end, filters, limit, after = _summary_arguments(request.args)
+
+    except ValueError as ve:
+
+        return jsonify({"errors": [{"path": "", "message": str(ve)}]}), 400
+
+    # One extra row tells us whether there's another page
+    with app.db.connect() as conn:
+        rows = query_summary(conn, granularity, group_by, start, end, filters, limit + 1, after)
+
+    return jsonify(_summary_page(rows, group_by, limit))
+
+
+async def event_summary_async(request):
+    """
+    The asyncio equivalent of event_summary, for a Starlette request.
+    """
+    from starlette.responses import JSONResponse
+
+    try:
+        granularity, group_by, start, end, filters, limit, after = _summary_arguments(request.query_params)
+
+    except ValueError as ve:
+
+        return JSONResponse({"errors": [{"path": "", "message": str(ve)}]}, status_code=400)
+
+    rows = await app.async_db.run(query_summary, granularity, group_by, start, end, filters, limit + 1, after)
+
+    return JSONResponse(_summary_page(rows, group_by, limit))
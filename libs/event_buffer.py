@@ -0,0 +1,353 @@
+"""
+    event_buffer.py -   An in-process buffer for inbound events. Events are
+                        accepted straight away and written to the database
+                        in batches, either when enough have arrived or when
+                        the flush interval passes, whichever comes first.
+                        A batch the database rejects is split until the
+                        rows at fault are found and dropped, the rest are
+                        written. AsyncEventBuffer is the same for asgi.py
+"""
+
+import sys
+import json
+import time
+import atexit
+import asyncio
+import threading
+from collections import deque
+import sqlalchemy
+
+
+def rejected_by_database(error):
+    """
+    Returns whether the database refused the rows themselves, e.g. a value
+    too long for its column, rather than failing for reasons of its own.
+    """
+    return isinstance(error, (sqlalchemy.exc.DataError, sqlalchemy.exc.IntegrityError))
+
+
+def _dead_letter(row, error):
+    print(f"Dropping an event the database rejected: {json.dumps(row, default=str)}: {error}", file=sys.stderr)
+
+
+def write_bisecting(writer, batch):
+    """
+    Writes a batch, splitting it in half while the database rejects it so
+    only the rows it rejects on their own are dropped, and logged to stderr.
+
+    Returns:
+    The rows which couldn't be written for any other reason, to be retried
+    """
+    try:
+        writer(batch)
+        return []
+
+    except Exception as e:
+
+        if not rejected_by_database(e):
+            print(f"Failed to write {len(batch)} events, will retry: {e}", file=sys.stderr)
+            return batch
+
+        if len(batch) == 1:
+            _dead_letter(batch[0], e)
+            return []
+
+    # Stop at the first half which can't be written, so the order is kept
+    middle = len(batch) // 2
+    unwritten = write_bisecting(writer, batch[:middle])
+
+    return unwritten + batch[middle:] if unwritten else write_bisecting(writer, batch[middle:])
+
+
+async def write_bisecting_async(writer, batch):
+    """
+    The asyncio equivalent of write_bisecting, the writer is a coroutine function.
+    """
+    try:
+        await writer(batch)
+        return []
+
+    except Exception as e:
+
+        if not rejected_by_database(e):
+            print(f"Failed to write {len(batch)} events, will retry: {e}", file=sys.stderr)
+            return batch
+
+        if len(batch) == 1:
+            _dead_letter(batch[0], e)
+            return []
+
+    middle = len(batch) // 2
+    unwritten = await write_bisecting_async(writer, batch[:middle])
+
+    return unwritten + batch[middle:] if unwritten else await write_bisecting_async(writer, batch[middle:])
+
+
+class EventBuffer:
+    """
+    A bounded buffer of event rows with a background flushing thread.
+    """
+
+    def __init__(self, writer, max_size, batch_size, flush_interval):
+        """
+        Args:
+        writer: A function which writes a list of event rows in one go
+        max_size: The most events held before callers are made to wait
+        batch_size: The number of events which triggers an early flush
+        flush_interval: The longest an event waits before being written, in seconds
+        """
+        self.writer         = writer
+        self.max_size       = max_size
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self._events        = deque()
+        self._condition     = threading.Condition()
+        self._flusher       = None
+        self._closed        = False
+
+    def _start(self):
+        """
+        Starts the flushing thread on first use, after any gunicorn fork.
+        """
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run, name="archibot-event-flusher", daemon=True)
+            self._flusher.start()
+            atexit.register(self.close)
+
+    def offer(self, event, timeout):
+        """
+        Adds an event to the buffer, waiting up to timeout seconds for space.
+
+        Returns:
+        True if the event was accepted, False if the buffer stayed full.
+        """
+        deadline = time.monotonic() + timeout
+
+        with self._condition:
+            self._start()
+
+            while len(self._events) >= self.max_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+
+            if self._closed:
+                return False
+
+            self._events.append(event)
+
+            if len(self._events) >= self.batch_size:
+                self._condition.notify_all()
+
+        return True
+
+    def depth(self):
+        """
+        Returns the number of events waiting to be written.
+        """
+        return len(self._events)
+
+    def _take_batch(self):
+        """
+        Removes up to a batch of events from the front of the buffer.
+        """
+        batch = []
+        while self._events and len(batch) < self.batch_size:
+            batch.append(self._events.popleft())
+
+        # Let any waiting callers know there is space again
+        self._condition.notify_all()
+
+        return batch
+
+    def _write(self, batch):
+        """
+        Writes a batch, putting whatever couldn't be written back at the
+        front of the buffer. Rows the database rejects are dropped rather
+        than retried forever.
+        """
+        unwritten = write_bisecting(self.writer, batch)
+
+        if unwritten:
+            with self._condition:
+                self._events.extendleft(reversed(unwritten))
+
+            return False
+
+        return True
+
+    def _run(self):
+        """
+        The body of the flushing thread.
+        """
+        while True:
+
+            with self._condition:
+                if len(self._events) < self.batch_size and not self._closed:
+                    self._condition.wait(self.flush_interval)
+
+                if self._closed:
+                    return
+
+                batch = self._take_batch()
+
+            # Back off for an interval if the database is unhappy
+            if batch and not self._write(batch):
+                time.sleep(self.flush_interval)
+
+    def flush(self):
+        """
+        Writes everything currently in the buffer, on the calling thread.
+        """
+        while True:
+
+            with self._condition:
+                batch = self._take_batch()
+
+            if not batch or not self._write(batch):
+                return
+
+    def close(self):
+        """
+        Stops the flushing thread and drains the buffer, used at shutdown.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        if self._flusher is not None:
+            self._flusher.join(timeout=self.flush_interval * 2)
+
+        self.flush()
+
+
+class AsyncEventBuffer:
+    """
+    The asyncio equivalent of EventBuffer, flushed by a task on the event
+    loop rather than a thread. The writer is a coroutine function.
+    """
+
+    def __init__(self, writer, max_size, batch_size, flush_interval):
+        self.writer         = writer
+        self.max_size       = max_size
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self._events        = deque()
+        self._condition     = None
+        self._flusher       = None
+        self._closed        = False
+
+    def _start(self):
+        """
+        Starts the flushing task on first use, inside the running event loop.
+        """
+        if self._flusher is None:
+            self._condition = asyncio.Condition()
+            self._flusher = asyncio.get_running_loop().create_task(self._run())
+
+    async def offer(self, event, timeout):
+        """
+        Adds an event to the buffer, waiting up to timeout seconds for space.
+
+        Returns:
+        True if the event was accepted, False if the buffer stayed full.
+        """
+        self._start()
+
+        async with self._condition:
+
+            try:
+                await asyncio.wait_for(
+                    self._condition.wait_for(lambda: len(self._events) < self.max_size or self._closed),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                return False
+
+            if self._closed:
+                return False
+
+            self._events.append(event)
+
+            if len(self._events) >= self.batch_size:
+                self._condition.notify_all()
+
+        return True
+
+    def depth(self):
+        """
+        Returns the number of events waiting to be written.
+        """
+        return len(self._events)
+
+    def _take_batch(self):
+        """
+        Removes up to a batch of events from the front of the buffer.
+        """
+        batch = []
+        while self._events and len(batch) < self.batch_size:
+            batch.append(self._events.popleft())
+
+        self._condition.notify_all()
+
+        return batch
+
+    async def _write(self, batch):
+        """
+        The asyncio equivalent of EventBuffer._write.
+        """
+        unwritten = await write_bisecting_async(self.writer, batch)
+
+        if unwritten:
+            self._events.extendleft(reversed(unwritten))
+            return False
+
+        return True
+
+    async def _run(self):
+        """
+        The body of the flushing task.
+        """
+        while not self._closed:
+
+            async with self._condition:
+                if len(self._events) < self.batch_size:
+                    try:
+                        await asyncio.wait_for(
+                            self._condition.wait_for(lambda: len(self._events) >= self.batch_size or self._closed),
+                            self.flush_interval
+                        )
+                    except asyncio.TimeoutError:
+                        pass
+
+                batch = self._take_batch()
+
+            if batch and not await self._write(batch):
+                await asyncio.sleep(self.flush_interval)
+
+    async def flush(self):
+        """
+        Writes everything currently in the buffer.
+        """
+        while self._events:
+
+            async with self._condition:
+                batch = self._take_batch()
+
+            if not await self._write(batch):
+                return
+
+    async def close(self):
+        """
+        Stops the flushing task and drains the buffer, used at shutdown.
+        """
+        if self._flusher is None:
+            return
+
+        async with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        await self._flusher
+        await self.flush()
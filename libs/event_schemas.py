@@ -0,0 +1,100 @@
+"""
+    event_schemas.py -  A registry of the jsonschema used to validate events
+                        from each source system. Validators are built once
+                        when a schema is registered, rather than per request.
+"""
+
+import copy
+from jsonschema.validators import validator_for
+
+# The minimum every event must provide, used for any unregistered source.
+# The lengths match the columns of the events table.
+GENERIC_EVENT_SCHEMA = {
+    "type" : "object",
+    "required": ["contributor", "event_type"],
+    "properties" : {
+        "source_timestamp" : {"type" : "string"},
+        "contributor" : {"type" : "string", "maxLength" : 255},
+        "event_type" : {"type" : "string", "maxLength" : 255}
+    }
+}
+
+# The length of the events table's source_system column
+MAX_SOURCE_SYSTEM_LENGTH = 64
+
+_validators = {}
+
+
+def _build_validator(schema):
+    """
+    Checks a schema is itself valid and returns a reusable validator for it.
+    """
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+
+    return validator_class(schema)
+
+
+def extend_generic_schema(properties, required=None):
+    """
+    Builds a schema for a source from the generic schema plus extra fields.
+
+    Args:
+    properties: Additional jsonschema properties for the source
+    required: Additional required property names
+
+    Returns:
+    A new schema dict.
+    """
+    schema = copy.deepcopy(GENERIC_EVENT_SCHEMA)
+    schema["properties"].update(properties)
+    schema["required"] = schema["required"] + list(required or [])
+
+    return schema
+
+
+def register_event_schema(source_system, schema):
+    """
+    Registers the schema for events from a given source system, replacing
+    any existing one. Raises jsonschema.SchemaError if the schema is invalid.
+    """
+    _validators[source_system.casefold()] = _build_validator(schema)
+
+
+def event_validation_errors(source_system, event):
+    """
+    Validates an event against the schema for its source system, falling
+    back to the generic schema if the source has not been registered.
+
+    Args:
+    source_system: The source system, as given in the URL
+    event: The decoded JSON body of the request
+
+    Returns:
+    A list of {"path", "message"} dicts, empty when the event is valid.
+    """
+    validator = _validators.get(source_system.casefold(), _generic_validator)
+
+    return [
+        {"path": "/".join(str(part) for part in error.absolute_path), "message": error.message}
+        for error in sorted(validator.iter_errors(event), key=lambda error: list(map(str, error.absolute_path)))
+    ]
+
+
+_generic_validator = _build_validator(GENERIC_EVENT_SCHEMA)
+
+# The richer schemas for the sources we know about
+register_event_schema("jira", extend_generic_schema({
+    "issue_key" : {"type" : "string", "pattern" : "^[A-Z][A-Z0-9_]*-[0-9]+$"},
+    "issue_status" : {"type" : "string"}
+}))
+register_event_schema("confluence", extend_generic_schema({
+    "page_id" : {"type" : "string"},
+    "space_key" : {"type" : "string"},
+    "page_version" : {"type" : "integer", "minimum" : 1}
+}))
+register_event_schema("ci", extend_generic_schema({
+    "pipeline" : {"type" : "string"},
+    "run_id" : {"type" : "string"},
+    "outcome" : {"type" : "string", "enum" : ["success", "failure", "cancelled"]}
+}))
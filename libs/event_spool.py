@@ -0,0 +1,566 @@
+"""
+    event_spool.py -    A write-ahead spool for inbound events, so accepting
+                        an event doesn't depend on the database being healthy.
+
+                        Events are appended to segment files on local disk and
+                        acknowledged once they have been fsync'd. Callers which
+                        arrive while an fsync is under way wait for the next,
+                        so one fsync covers every event written in between.
+
+                        A replayer thread writes the spooled events to the
+                        database in batches. The position it has reached is
+                        stored in the same transaction as each batch, so after
+                        a crash it carries on from exactly where the database
+                        says it got to, without losing or repeating events.
+                        Events the database rejects are logged and skipped,
+                        as for EventBuffer.
+
+                        This only holds while the spool's directory survives
+                        the process. A slot is only replayed by a process
+                        which later claims it from the same directory, so a
+                        spool on a disk which goes with its instance, e.g.
+                        Cloud Run's in-memory filesystem, is lost with it.
+"""
+
+import os
+import sys
+import time
+import json
+import uuid
+import fcntl
+import atexit
+import threading
+import sqlalchemy
+from libs.metrics import register, Gauge
+from libs.event_buffer import write_bisecting
+
+SCHEMA_STATEMENTS   = [
+    """
+    CREATE TABLE IF NOT EXISTS event_spool_offsets (
+        spool_id CHAR(32) NOT NULL PRIMARY KEY,
+        segment BIGINT NOT NULL,
+        position BIGINT NOT NULL
+    )
+    """
+]
+
+SEGMENT_PREFIX      = "events-"
+SEGMENT_SUFFIX      = ".ndjson"
+
+# The most the replayer reads from a segment at a time, and so the largest event
+READ_BYTES          = 1024 * 1024
+
+SPOOL_BACKLOG       = register(Gauge(
+    "archibot_event_spool_backlog_bytes",
+    "Bytes of spooled events not yet written to the database"
+))
+
+
+def ensure_spool_schema(engine):
+    """
+    Creates the spool offsets table if it doesn't already exist.
+    """
+    with engine.connect() as conn:
+        create_spool_schema(conn)
+
+
+def create_spool_schema(conn):
+    """
+    The body of ensure_spool_schema, on an open connection.
+    """
+    for statement in SCHEMA_STATEMENTS:
+        conn.execute(sqlalchemy.text(statement))
+    conn.commit()
+
+
+def read_offset(conn, spool_id):
+    """
+    Returns the (segment, position) the replayer of a spool has reached, or
+    None if it has never written anything.
+    """
+    row = conn.execute(
+        sqlalchemy.text("SELECT segment, position FROM event_spool_offsets WHERE spool_id = :spool_id"),
+        {"spool_id": spool_id}
+    ).first()
+
+    return None if row is None else (row.segment, row.position)
+
+
+def write_offset(conn, spool_id, offset):
+    """
+    Moves a spool's offset on, inside the caller's transaction.
+    """
+    conn.execute(
+        sqlalchemy.text(
+            "INSERT INTO event_spool_offsets (spool_id, segment, position) "
+            "VALUES (:spool_id, :segment, :position) "
+            "ON DUPLICATE KEY UPDATE segment = VALUES(segment), position = VALUES(position)"
+        ),
+        {"spool_id": spool_id, "segment": offset[0], "position": offset[1]}
+    )
+
+
+def _segment_name(segment):
+    return f"{SEGMENT_PREFIX}{segment:012d}{SEGMENT_SUFFIX}"
+
+
+def claim_slot(directory):
+    """
+    Claims a sub-directory of the spool for this process, e.g. one per
+    gunicorn worker. A slot is held with an flock, so a restarted worker
+    takes over the slot, and the events, of the one it replaced.
+
+    Returns:
+    (slot path, the open lock file)
+    """
+    slot_number = 0
+
+    while True:
+
+        slot = os.path.join(directory, f"slot-{slot_number}")
+        os.makedirs(slot, exist_ok=True)
+        lock_file = open(os.path.join(slot, "lock"), "a+b")
+
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot, lock_file
+
+        except BlockingIOError:
+
+            lock_file.close()
+            slot_number += 1
+
+
+def _spool_id(slot):
+    """
+    Reads the id a slot's offset is stored under, creating it the first time.
+    """
+    path = os.path.join(slot, "spool_id")
+
+    if not os.path.exists(path):
+        with open(path + ".tmp", "w", encoding="UTF-8") as id_file:
+            id_file.write(uuid.uuid4().hex)
+            id_file.flush()
+            os.fsync(id_file.fileno())
+        os.replace(path + ".tmp", path)
+
+    with open(path, encoding="UTF-8") as id_file:
+        return id_file.read().strip()
+
+
+class EventSpool:
+    """
+    Append-only segment files of newline-delimited JSON event rows, with a
+    background thread replaying them into the database.
+    """
+
+    def __init__(self, directory, writer, reader, segment_bytes, batch_size, idle_interval,
+                 max_event_bytes=READ_BYTES, max_bytes=None):
+        """
+        Args:
+        directory: Where the spool is kept, each process uses a slot within it
+        writer: writer(rows, spool_id, offset) stores rows and the offset reached in one transaction
+        reader: reader(spool_id) returns the stored offset, or None
+        segment_bytes: The size at which a new segment file is started
+        batch_size: The most events written to the database at once
+        idle_interval: How long, in seconds, the replayer waits when idle or after a failure
+        max_event_bytes: The largest event accepted, at most READ_BYTES
+        max_bytes: Optional, the most this process's slot may hold on disk
+        """
+        self.directory      = directory
+        self.writer         = writer
+        self.reader         = reader
+        self.segment_bytes  = segment_bytes
+        self.batch_size     = batch_size
+        self.idle_interval  = idle_interval
+        self.max_event_bytes = min(max_event_bytes, READ_BYTES)
+        self.max_bytes      = max_bytes
+        self.spool_id       = None
+        self._condition     = threading.Condition()
+        self._lock_file     = None
+        self._fd            = None
+        self._segment       = 0
+        self._size          = 0
+        self._syncing       = False
+        self._durable       = (0, 0)
+        self._spooled_bytes = 0
+        self._replayed      = None
+        self._replayer      = None
+        self._closed        = False
+
+    def _start(self):
+        """
+        Opens the spool and starts the replayer on first use, after any
+        gunicorn fork. Called holding the condition.
+        """
+        if self._replayer is not None:
+            return
+
+        slot, self._lock_file = claim_slot(self.directory)
+        self.directory = slot
+        self.spool_id = _spool_id(slot)
+
+        # Writing always starts a new segment, the last one may end part way
+        # through an event which was never acknowledged
+        segments = self.segments()
+        self._spooled_bytes = sum(os.path.getsize(self._path(segment)) for segment in segments)
+        self._open_segment((segments[-1] + 1) if segments else 1)
+
+        self._replayer = threading.Thread(target=self._run, name="archibot-event-spool", daemon=True)
+        self._replayer.start()
+        atexit.register(self.close)
+
+    def start(self):
+        """
+        Starts replaying anything left in the spool, without waiting for an event.
+        """
+        if self._replayer is not None:
+            return
+
+        with self._condition:
+            if not self._closed:
+                self._start()
+
+    def segments(self):
+        """
+        Returns the numbers of the segment files in the spool, oldest first.
+        """
+        return sorted(
+            int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def _path(self, segment):
+        return os.path.join(self.directory, _segment_name(segment))
+
+    def _open_segment(self, segment):
+        self._fd = os.open(self._path(segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._segment = segment
+        self._size = 0
+        self._durable = (segment, 0)
+
+        # Make the new file's directory entry durable too
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def _rotate(self):
+        """
+        Finishes the current segment and starts the next. Called holding the
+        condition, once no fsync is under way.
+        """
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._open_segment(self._segment + 1)
+
+    def _write_line(self, line):
+        """
+        Writes a whole line to the current segment. Called holding the
+        condition.
+
+        Raises:
+        OSError if the line couldn't be written, after cutting the segment
+        back so the next event isn't appended to part of this one
+        """
+        written = 0
+
+        try:
+            while written < len(line):
+                count = os.write(self._fd, line[written:])
+                if not count:
+                    raise OSError(f"Nothing could be written to {_segment_name(self._segment)}")
+                written += count
+
+        except OSError:
+
+            os.ftruncate(self._fd, self._size)
+            raise
+
+    def append(self, row):
+        """
+        Adds an event row to the spool, returning once it's on disk.
+
+        Raises:
+        ValueError if the event is larger than max_event_bytes
+        OSError if the event couldn't be written, e.g. the disk or spool is full
+        """
+        line = (json.dumps(row, separators=(",", ":")) + "\n").encode("utf-8")
+
+        if len(line) > self.max_event_bytes:
+            raise ValueError(f"The event is {len(line)} bytes, the most the spool accepts is {self.max_event_bytes}")
+
+        with self._condition:
+
+            if self._closed:
+                raise OSError("The event spool is closed")
+
+            self._start()
+
+            if self.max_bytes and self._spooled_bytes + len(line) > self.max_bytes:
+                raise OSError(f"The event spool is full, {self._spooled_bytes} bytes are waiting to be replayed")
+
+            # Rotating closes the file, so wait for any fsync of it to finish
+            if self._size >= self.segment_bytes:
+                while self._syncing:
+                    self._condition.wait()
+                self._rotate()
+
+            self._write_line(line)
+            self._size += len(line)
+            self._spooled_bytes += len(line)
+            written = (self._segment, self._size)
+
+            # Group commit, one caller fsyncs for everyone waiting at the time
+            while self._durable < written:
+
+                if self._syncing:
+                    self._condition.wait()
+                    continue
+
+                self._syncing = True
+                target, fd = (self._segment, self._size), self._fd
+                self._condition.release()
+
+                try:
+                    os.fsync(fd)
+
+                finally:
+
+                    self._condition.acquire()
+                    self._syncing = False
+                    self._condition.notify_all()
+
+                self._durable = max(self._durable, target)
+
+    def backlog(self):
+        """
+        Returns the number of bytes spooled but not yet replayed.
+        """
+        with self._condition:
+            if self._replayed is None:
+                return 0
+            durable, replayed = self._durable, self._replayed
+
+        if replayed[0] == durable[0]:
+            return max(durable[1] - replayed[1], 0)
+
+        total = durable[1] - replayed[1]
+        for segment in range(replayed[0], durable[0]):
+            try:
+                total += os.path.getsize(self._path(segment))
+            except OSError:
+                pass
+
+        return max(total, 0)
+
+    def _skip_line(self, segment_file, position, end):
+        """
+        Finds the end of a line too long to read in one go, which append
+        never writes but an older spool may hold.
+
+        Returns:
+        The position after its newline, or None if the data runs out first
+        """
+        segment_file.seek(position)
+
+        while end is None or position < end:
+
+            data = segment_file.read(READ_BYTES if end is None else min(end - position, READ_BYTES))
+            if not data:
+                return None
+
+            newline = data.find(b"\n")
+            if newline >= 0:
+                return position + newline + 1
+
+            position += len(data)
+
+        return None
+
+    def _read_batch(self, offset):
+        """
+        Reads up to batch_size events from offset, never past what has been
+        fsync'd.
+
+        Returns:
+        (entries, the offset after them), where entries is a list of (row,
+        the offset after the row) and is empty if there's nothing to read
+        """
+        segment, position = offset
+
+        with self._condition:
+            durable = self._durable
+
+        if segment > durable[0]:
+            return [], offset
+
+        end = durable[1] if segment == durable[0] else None
+        skip_to = None
+
+        try:
+            with open(self._path(segment), "rb") as segment_file:
+                segment_file.seek(position)
+                data = segment_file.read(READ_BYTES if end is None else min(end - position, READ_BYTES))
+
+                if len(data) == READ_BYTES and b"\n" not in data:
+                    skip_to = self._skip_line(segment_file, position + len(data), end)
+
+        except FileNotFoundError:
+            data = b""
+
+        if skip_to is not None:
+            print(f"Skipping an event over {READ_BYTES} bytes in {_segment_name(segment)} at {position}",
+                  file=sys.stderr)
+            return [], (segment, skip_to)
+
+        entries = []
+        consumed = 0
+
+        while len(entries) < self.batch_size:
+
+            newline = data.find(b"\n", consumed)
+            if newline < 0:
+                break
+
+            line = data[consumed:newline]
+            consumed = newline + 1
+
+            try:
+                entries.append((json.loads(line), (segment, position + consumed)))
+            except ValueError:
+                print(f"Skipping an unreadable event in {_segment_name(segment)} at {position}", file=sys.stderr)
+
+        if consumed:
+            return entries, (segment, position + consumed)
+
+        # The end of an earlier segment, anything left is a partial event
+        # which was never acknowledged
+        if segment < durable[0]:
+            return self._read_batch((segment + 1, 0))
+
+        return [], offset
+
+    def _discard_replayed(self, offset):
+        """
+        Deletes the segment files before the one the stored offset is in.
+        """
+        for segment in self.segments():
+            if segment >= offset[0]:
+                return
+
+            size = os.path.getsize(self._path(segment))
+            os.remove(self._path(segment))
+
+            with self._condition:
+                self._spooled_bytes -= size
+
+    def _resume_offset(self):
+        stored = self.reader(self.spool_id)
+        segments = self.segments()
+
+        # A spool nobody has replayed from starts at its oldest segment
+        if stored is None:
+            return (segments[0], 0) if segments else (self._segment, 0)
+
+        return stored
+
+    def _write_entries(self, entries):
+        """
+        Writes some of a batch, moving the stored offset to the end of them.
+        """
+        self.writer([row for row, _ in entries], self.spool_id, entries[-1][1])
+
+    def _run(self):
+        """
+        The body of the replayer thread.
+        """
+        offset = None
+
+        while True:
+
+            with self._condition:
+                if self._closed:
+                    return
+
+            try:
+
+                if offset is None:
+                    offset = self._resume_offset()
+                    self._discard_replayed(offset)
+                    self._replayed = offset
+
+                entries, next_offset = self._read_batch(offset)
+
+                # Events the database rejects are dropped, and the offset
+                # moves past them with the next batch written
+                unwritten = write_bisecting(self._write_entries, entries) if entries else []
+
+                if unwritten:
+
+                    # Carry on from the first event not written once the database recovers
+                    written = len(entries) - len(unwritten)
+                    offset = self._replayed = entries[written - 1][1] if written else offset
+                    time.sleep(self.idle_interval)
+                    continue
+
+                if entries:
+                    self._discard_replayed(next_offset)
+
+                offset = self._replayed = next_offset
+
+            except Exception as e:
+
+                # Back off while the spool can't be read, the offset stays put
+                print(f"Failed to replay spooled events, will retry: {e}", file=sys.stderr)
+                time.sleep(self.idle_interval)
+                continue
+
+            # Wait for the next fsync once everything on disk has been replayed
+            with self._condition:
+                if not self._closed and self._durable <= offset:
+                    self._condition.wait(self.idle_interval)
+
+    def close(self):
+        """
+        Stops the replayer and closes the current segment, used at shutdown.
+        Anything not yet replayed is picked up when the slot is next used.
+        """
+        with self._condition:
+
+            if self._closed:
+                return
+
+            self._closed = True
+            self._condition.notify_all()
+
+            while self._syncing:
+                self._condition.wait()
+
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+
+        if self._replayer is not None and self._replayer is not threading.current_thread():
+            self._replayer.join(timeout=self.idle_interval * 2)
+
+        if self._lock_file is not None:
+            self._lock_file.close()
+
+
+# The spools in this process, for /metrics
+_spools             = []
+
+
+def track_spool(spool):
+    """
+    Adds a spool to those whose backlog /metrics reports, returning it.
+    """
+    _spools.append(spool)
+    return spool
+
+
+SPOOL_BACKLOG.add_collector(lambda: {(): sum(spool.backlog() for spool in _spools)} if _spools else {})
@@ -1,17 +1,217 @@
 """
     events.py - A simple collection of code to capture and
                 eventually analyse events which pertain to
-                the activities of John Architect. 
+                the activities of John Architect.
 """
 
 
 import time
 import sys
+import json
+import asyncio
+import threading
 import sqlalchemy
-from flask import request, Response
-from jsonschema import validate
-from jsonschema.exceptions import ValidationError
+from flask import request, Response, jsonify
 import app
+from libs.event_buffer import EventBuffer
+from libs.event_buffer import AsyncEventBuffer
+from libs.event_spool import EventSpool
+from libs.event_spool import track_spool
+from libs.event_spool import read_offset
+from libs.event_spool import write_offset
+from libs.event_schemas import event_validation_errors
+from libs.event_schemas import MAX_SOURCE_SYSTEM_LENGTH
+from libs.event_analytics import update_rollups
+
+# A parameterised insert, executed with many rows at once the driver
+# turns this into a single multi-row INSERT.
+INSERT_EVENTS = sqlalchemy.text(
+    "INSERT INTO events (source_timestamp, source_system, contributor, event_type) "
+    "VALUES (:source_timestamp, :source_system, :contributor, :event_type)"
+)
+
+
+def insert_events(event_rows):
+    """
+    Writes a batch of events to the database, and adds them to the hourly
+    and daily rollups, in a single transaction.
+
+    Args:
+    event_rows: A list of dicts matching the columns of the events table
+
+    Returns:
+    None
+    """
+    with app.db.connect() as conn:
+        write_events(conn, event_rows)
+
+
+def write_events(conn, event_rows):
+    """
+    The body of insert_events, on an open connection.
+    """
+    conn.execute(INSERT_EVENTS, event_rows)
+    update_rollups(conn, event_rows)
+    conn.commit()
+
+
+async def insert_events_async(event_rows):
+    """
+    The asyncio equivalent of insert_events, through app.async_db
+    """
+    await app.async_db.run(write_events, event_rows)
+
+
+def write_spooled_events(event_rows, spool_id, offset):
+    """
+    Writes a batch of events replayed from the spool, moving the spool's
+    offset on in the same transaction so no event is written twice.
+    """
+    with app.db.connect() as conn:
+        conn.execute(INSERT_EVENTS, event_rows)
+        update_rollups(conn, event_rows)
+        write_offset(conn, spool_id, offset)
+        conn.commit()
+
+
+def read_spool_offset(spool_id):
+    """
+    Returns how far the events from a spool have been written.
+    """
+    with app.db.connect() as conn:
+        return read_offset(conn, spool_id)
+
+
+# Events are accepted into the buffer and written in batches
+_event_buffer       = None
+_event_buffer_lock  = threading.Lock()
+_async_event_buffer = None
+_event_spool        = None
+
+
+def get_event_buffer():
+    """
+    Returns the shared event buffer, creating it on first use.
+    """
+    global _event_buffer
+
+    with _event_buffer_lock:
+        if _event_buffer is None:
+            _event_buffer = EventBuffer(
+                insert_events,
+                max_size=app.EVENT_BUFFER_SIZE,
+                batch_size=app.EVENT_BATCH_SIZE,
+                flush_interval=app.EVENT_FLUSH_INTERVAL
+            )
+
+    return _event_buffer
+
+
+def get_async_event_buffer():
+    """
+    Returns the shared AsyncEventBuffer used under asgi.py, creating it on first use.
+    """
+    global _async_event_buffer
+
+    if _async_event_buffer is None:
+        _async_event_buffer = AsyncEventBuffer(
+            insert_events_async,
+            max_size=app.EVENT_BUFFER_SIZE,
+            batch_size=app.EVENT_BATCH_SIZE,
+            flush_interval=app.EVENT_FLUSH_INTERVAL
+        )
+
+    return _async_event_buffer
+
+
+def get_event_spool():
+    """
+    Returns the shared event spool, creating it on first use, or None if
+    EVENT_SPOOL_DIR isn't set.
+    """
+    global _event_spool
+
+    if not app.EVENT_SPOOL_DIR:
+        return None
+
+    with _event_buffer_lock:
+        if _event_spool is None:
+            _event_spool = track_spool(EventSpool(
+                app.EVENT_SPOOL_DIR,
+                write_spooled_events,
+                read_spool_offset,
+                segment_bytes=app.EVENT_SPOOL_SEGMENT_BYTES,
+                batch_size=app.EVENT_BULK_BATCH_SIZE,
+                idle_interval=app.EVENT_FLUSH_INTERVAL,
+                max_event_bytes=app.EVENT_SPOOL_MAX_EVENT_BYTES,
+                max_bytes=app.EVENT_SPOOL_MAX_BYTES
+            ))
+
+    return _event_spool
+
+
+def resume_event_spool():
+    """
+    Starts replaying events left in the spool by an earlier process, rather
+    than waiting for the next event to arrive.
+    """
+    event_spool = get_event_spool()
+
+    if event_spool is not None:
+        event_spool.start()
+
+
+def spool_event(row):
+    """
+    Appends an event to the spool, returning once it's on disk.
+
+    Returns:
+    The HTTP status for the caller, 202 if the event was spooled, 413 if it's
+    too large or 503 if it couldn't be written
+    """
+    try:
+        get_event_spool().append(row)
+
+    except ValueError as e:
+
+        print(f"Rejecting event: {e}", file=sys.stderr)
+        return 413
+
+    except OSError as e:
+
+        print(f"Failed to spool event, rejecting it: {e}", file=sys.stderr)
+        return 503
+
+    return 202
+
+
+def event_row(source_system, event_data):
+    """
+    Validates an event against the precompiled schema for its source, and
+    turns it into a row for the events table.
+
+    Returns:
+    (row, None), or (None, [validation errors])
+    """
+    # The source comes from the URL rather than the body, so the schema doesn't cover it
+    if len(source_system) > MAX_SOURCE_SYSTEM_LENGTH:
+        message = f"The source system is longer than {MAX_SOURCE_SYSTEM_LENGTH} characters"
+        return None, [{"path": "", "message": message}]
+
+    validation_errors = event_validation_errors(source_system, event_data)
+
+    if validation_errors:
+        return None, validation_errors
+
+    # Generate the date in unix format
+    return {
+        "source_timestamp": time.time(),
+        "source_system": source_system,
+        "contributor": event_data['contributor'],
+        "event_type": event_data['event_type']
+    }, None
+
+
 def event_catcher(source_system):
     """
         flask_event_catcher     A highly generic end-point, designed to catch
@@ -20,53 +220,311 @@ def event_catcher(source_system):
                                 data structure for now..
     """
 
-    # Validate the message meets the required format, we use jsonschema for this
-    message_schema = {
-        "type" : "object",
-        "required": ["contributor", "event_type"],
-        "properties" : {
-            "source_timestamp" : {"type" : "string"},
-            "contributor" : {"type" : "string"},
-            "event_type" : {"type" : "string"}
+    # Validate the message against the precompiled schema for its source
+    row, validation_errors = event_row(source_system, request.get_json(silent=True))
+
+    if validation_errors:
+
+        # Print any validation errors to the console
+        print(validation_errors, file=sys.stderr)
+
+        # Let the calling client know exactly what went wrong
+        return jsonify({"errors": validation_errors}), 400
+
+    elif get_event_spool() is not None:
+
+        # The spool is on local disk, so this doesn't wait on the database
+        status = spool_event(row)
+
+        if status == 413:
+            return Response("Event Too Large", status=413, mimetype='text/plain')
+
+        if status == 503:
+            return Response("Busy", status=503, mimetype='text/plain', headers={"Retry-After": "5"})
+
+        return Response("Accepted", status=202, mimetype='text/plain')
+
+    else:
+
+        # Hand the event to the buffer, if it stays full the caller should back off
+        if not get_event_buffer().offer(row, timeout=app.EVENT_ENQUEUE_TIMEOUT):
+
+            print("Event buffer is full, rejecting event", file=sys.stderr)
+            return Response("Busy", status=503, mimetype='text/plain', headers={"Retry-After": "5"})
+
+        return Response("Accepted", status=202, mimetype='text/plain')
+
+
+async def event_catcher_async(request, source_system):
+    """
+    The asyncio equivalent of event_catcher, for a Starlette request.
+    """
+    from starlette.responses import JSONResponse, PlainTextResponse
+
+    try:
+        event_data = await request.json()
+    except ValueError:
+        event_data = None
+
+    row, validation_errors = event_row(source_system, event_data)
+
+    if validation_errors:
+
+        print(validation_errors, file=sys.stderr)
+        return JSONResponse({"errors": validation_errors}, status_code=400)
+
+    # Waiting on the fsync is done on a thread, leaving the event loop free
+    if get_event_spool() is not None:
+
+        status = await asyncio.to_thread(spool_event, row)
+
+        if status == 413:
+            return PlainTextResponse("Event Too Large", status_code=413)
+
+        if status == 503:
+            return PlainTextResponse("Busy", status_code=503, headers={"Retry-After": "5"})
+
+        return PlainTextResponse("Accepted", status_code=202)
+
+    if not await get_async_event_buffer().offer(row, timeout=app.EVENT_ENQUEUE_TIMEOUT):
+
+        print("Event buffer is full, rejecting event", file=sys.stderr)
+        return PlainTextResponse("Busy", status_code=503, headers={"Retry-After": "5"})
+
+    return PlainTextResponse("Accepted", status_code=202)
+
+
+class BulkLoad:
+    """
+    Tallies a newline-delimited JSON upload as it's read, validating each
+    line and gathering the valid events into batches of EVENT_BULK_BATCH_SIZE.
+    Only the current batch and the first EVENT_BULK_ERROR_LIMIT errors are
+    held, so memory use doesn't grow with the size of the upload.
+    """
+
+    def __init__(self, source_system):
+        self.source_system  = source_system
+        self.lines          = 0
+        self.accepted       = 0
+        self.rejected       = 0
+        self.errors         = []
+        self.rows           = []
+        self.batch_start    = None
+
+    def _reject(self, errors):
+        self.rejected += 1
+        if len(self.errors) < app.EVENT_BULK_ERROR_LIMIT:
+            self.errors.append({"line": self.lines, "errors": errors})
+
+    def add(self, line):
+        """
+        Validates the next line of the upload.
+
+        Args:
+        line: The line as bytes, or None if it was longer than EVENT_BULK_MAX_LINE
+
+        Returns:
+        True once a batch is ready to be written
+        """
+        self.lines += 1
+
+        if line is None:
+            self._reject([{"path": "", "message": f"Line is longer than {app.EVENT_BULK_MAX_LINE} bytes"}])
+            return False
+
+        # Blank lines, e.g. a trailing newline, are skipped
+        if not line.strip():
+            return False
+
+        try:
+            event_data = json.loads(line)
+        except ValueError as e:
+            self._reject([{"path": "", "message": f"Invalid JSON: {e}"}])
+            return False
+
+        row, validation_errors = event_row(self.source_system, event_data)
+
+        if validation_errors:
+            self._reject(validation_errors)
+            return False
+
+        if not self.rows:
+            self.batch_start = self.lines
+        self.rows.append(row)
+
+        return len(self.rows) >= app.EVENT_BULK_BATCH_SIZE
+
+    def take_batch(self):
+        """
+        Returns the rows gathered so far, the caller counts them as accepted
+        once they are written.
+        """
+        rows, self.rows = self.rows, []
+        return rows
+
+    def summary(self):
+        """
+        Returns the counts of lines read, accepted and rejected, and the
+        errors kept for the first rejections.
+        """
+        return {
+            "lines": self.lines,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "errors": self.errors
         }
-    }
 
-    # Figure out of the schema is valid, if it is - commit the data to our DB.
+    def failure(self, error):
+        """
+        The summary for an upload abandoned because a batch couldn't be
+        written. Nothing from resume_from_line onwards has been stored, so
+        the caller can send the rest of the file again from there.
+        """
+        print(f"Failed to write bulk events from line {self.batch_start}: {error}", file=sys.stderr)
+
+        summary = self.summary()
+        summary["resume_from_line"] = self.batch_start
+
+        return summary
+
+
+def read_lines(stream, max_line):
+    """
+    Reads lines from a file-like request stream, a line at a time.
+
+    Yields:
+    Each line as bytes, or None in place of a line longer than max_line
+    """
+    while True:
+
+        line = stream.readline(max_line + 1)
+        if not line:
+            return
+
+        if len(line) > max_line and not line.endswith(b"\n"):
+
+            # Read past the rest of the line without keeping it
+            while line and not line.endswith(b"\n"):
+                line = stream.readline(max_line + 1)
+
+            yield None
+            continue
+
+        yield line
+
+
+async def read_lines_async(chunks, max_line):
+    """
+    The asyncio equivalent of read_lines, splitting an async iterator of
+    body chunks, e.g. Starlette's request.stream(), into lines.
+    """
+    buffer = b""
+    skipping = False
+
+    async for chunk in chunks:
+
+        buffer += chunk
+        start = 0
+
+        while True:
+
+            newline = buffer.find(b"\n", start)
+            if newline < 0:
+                break
+
+            line, start = buffer[start:newline + 1], newline + 1
+
+            # The end of a line which was too long, already reported
+            if skipping:
+                skipping = False
+                continue
+
+            # As for read_lines, the newline doesn't count towards max_line
+            yield None if len(line) - 1 > max_line else line
+
+        buffer = buffer[start:]
+
+        if len(buffer) > max_line:
+
+            if not skipping:
+                yield None
+
+            skipping = True
+            buffer = b""
+
+    if buffer and not skipping:
+        yield buffer
+
+
+def bulk_event_catcher(source_system):
+    """
+    Stores newline-delimited JSON events, one event per line, as the
+    request body is read. Valid events are written in batches straight to
+    the database rather than through the event buffer, so the counts
+    returned are of events stored.
+
+    Returns:
+    HTTP 200 + {lines, accepted, rejected, errors}, or HTTP 503 + the same
+    and resume_from_line if the database couldn't be written to
+    """
+    bulk_load = BulkLoad(source_system)
+
     try:
 
-        # Validate the POST'd data against our message schema
-        validate(instance=request.json, schema=message_schema)
+        for line in read_lines(request.stream, app.EVENT_BULK_MAX_LINE):
+            if bulk_load.add(line):
+                bulk_load.accepted += _write_batch(bulk_load.take_batch())
 
-    except ValidationError as ve:
+        bulk_load.accepted += _write_batch(bulk_load.take_batch())
 
-        # Print any validation errors to the console
-        print(ve)
+    except sqlalchemy.exc.SQLAlchemyError as e:
 
-        # Let the calling client know something went wrong
-        return "Validation Errors"
+        return jsonify(bulk_load.failure(e)), 503
 
-    else:
+    return jsonify(bulk_load.summary()), 200
 
-        # Generate the date in unix format
-        source_timestamp = time.time()
 
-        with app.db.connect() as conn:
-            # Execute the insertion of data
+def _write_batch(rows):
+    """
+    Writes a batch of bulk events, if there are any.
+
+    Returns:
+    The number of events written
+    """
+    if rows:
+        insert_events(rows)
 
+    return len(rows)
 
-            try:
-                conn.execute(
-                    sqlalchemy.text(
-                        f"INSERT INTO events (source_timestamp, source_system, contributor, event_type) VALUES ('{source_timestamp}', '{source_system}', '{request.json['contributor']}', '{request.json['event_type']}')"
-                    )
-                )
-                conn.commit()
 
-            except Exception as e:
+async def bulk_event_catcher_async(request, source_system):
+    """
+    The asyncio equivalent of bulk_event_catcher, for a Starlette request.
+    """
+    from starlette.responses import JSONResponse
 
-                print (e, file=sys.stderr)
-                return Response("Failed", status=500, mimetype='text/plain')
+    bulk_load = BulkLoad(source_system)
 
-            else:
+    try:
+
+        async for line in read_lines_async(request.stream(), app.EVENT_BULK_MAX_LINE):
+            if bulk_load.add(line):
+                bulk_load.accepted += await _write_batch_async(bulk_load.take_batch())
+
+        bulk_load.accepted += await _write_batch_async(bulk_load.take_batch())
+
+    except sqlalchemy.exc.SQLAlchemyError as e:
+
+        return JSONResponse(bulk_load.failure(e), status_code=503)
+
+    return JSONResponse(bulk_load.summary())
+
+
+async def _write_batch_async(rows):
+    """
+    The asyncio equivalent of _write_batch.
+    """
+    if rows:
+        await insert_events_async(rows)
 
-                return Response("Accepted", status=201, mimetype='text/plain')
+    return len(rows)
@@ -0,0 +1,168 @@
+"""
+    http_pool.py -  Keep-alive connection pools, one per upstream host, shared
+                    by every thread in the process. The Atlassian clients reach
+                    them through a requests Session and the Slack WebClient
+                    through PooledWebClient, so a long publish pays for a TLS
+                    handshake once rather than on every call.
+
+                    Each host keeps up to HTTP_POOL_SIZE idle connections, or
+                    the size given for it in HTTP_POOL_SIZES. Calls beyond that
+                    open a connection which is closed afterwards, the number in
+                    flight being limited by the bulkheads in resilience.py
+"""
+
+import logging
+import threading
+from urllib.error import URLError
+from urllib.parse import urlsplit
+import urllib3
+import requests
+from requests.adapters import HTTPAdapter
+from slack_sdk import WebClient
+import app
+from libs.metrics import register, Counter
+
+POOL_REQUESTS       = register(Counter(
+    "archibot_http_pool_requests_total",
+    "Requests sent through each host's connection pool",
+    ("host",)
+))
+POOL_CONNECTIONS    = register(Counter(
+    "archibot_http_pool_connections_total",
+    "Connections opened by each host's connection pool, requests minus connections were sent on a reused connection",
+    ("host",)
+))
+
+# One PoolManager per host, created on first use
+_managers           = {}
+_managers_lock      = threading.Lock()
+
+
+def pool_manager(host):
+    """
+    Returns the shared PoolManager for a host.
+
+    Args:
+    host: The host name, e.g. slack.com
+    """
+    with _managers_lock:
+
+        if host not in _managers:
+            _managers[host] = urllib3.PoolManager(
+                num_pools=4,
+                maxsize=app.HTTP_POOL_SIZES.get(host, app.HTTP_POOL_SIZE),
+                block=False
+            )
+
+        return _managers[host]
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    A requests transport adapter which uses the shared pool for its host,
+    rather than a pool of its own.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        super().__init__()
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self.poolmanager = pool_manager(self.host)
+
+    def close(self):
+        # The pool outlives any one session, so leave it open
+        pass
+
+
+def pooled_session(url):
+    """
+    Returns a requests Session sending requests to url's host through the
+    shared pool, e.g. for atlassian.Jira(session=...)
+    """
+    parts = urlsplit(url)
+    session = requests.Session()
+    session.mount(f"{parts.scheme}://{parts.netloc}", PooledAdapter(parts.hostname))
+
+    return session
+
+
+class PooledWebClient(WebClient):
+    """
+    A Slack WebClient which sends its requests through the shared pool
+    rather than opening a new urllib connection for each. Retries, errors
+    and responses are handled by WebClient as before.
+    """
+
+    def _perform_urllib_http_request_internal(self, url, req):
+        if self.proxy is not None or self.ssl is not None or not url.lower().startswith("http"):
+            return super()._perform_urllib_http_request_internal(url, req)
+
+        try:
+            response = pool_manager(urlsplit(url).hostname).request(
+                "POST",
+                url,
+                body=req.data,
+                headers=dict(req.header_items()),
+                timeout=self.timeout,
+                retries=False,
+                redirect=False
+            )
+
+        # Raise what urllib would, which WebClient's retry handlers and the
+        # circuit breakers recognise
+        except urllib3.exceptions.TimeoutError as e:
+            raise TimeoutError(str(e)) from e
+
+        except urllib3.exceptions.HTTPError as e:
+            raise URLError(e) from e
+
+        # Like urllib, error responses are returned for WebClient to raise
+        if response.headers.get("Content-Type", "").startswith("application/gzip"):
+            body = response.data
+        else:
+            body = response.data.decode(_charset(response.headers.get("Content-Type", "")))
+
+        if self._logger.level <= logging.DEBUG:
+            self._logger.debug(f"Received the following response - status: {response.status}, body: {body}")
+
+        return {"status": response.status, "headers": response.headers, "body": body}
+
+
+def _charset(content_type):
+    for parameter in content_type.split(";")[1:]:
+        name, _, value = parameter.strip().partition("=")
+        if name.lower() == "charset" and value:
+            return value.strip('"')
+
+    return "utf-8"
+
+
+def pool_stats():
+    """
+    Reports the requests sent and connections opened for each host.
+
+    Returns:
+    {host: {"requests": n, "connections": n, "reused": n}}
+    """
+    stats = {}
+
+    with _managers_lock:
+        managers = list(_managers.items())
+
+    for host, manager in managers:
+
+        requests_sent, connections = 0, 0
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is not None:
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+
+        stats[host] = {"requests": requests_sent, "connections": connections, "reused": requests_sent - connections}
+
+    return stats
+
+
+POOL_REQUESTS.add_collector(lambda: {(host, ): stat["requests"] for host, stat in pool_stats().items()})
+POOL_CONNECTIONS.add_collector(lambda: {(host, ): stat["connections"] for host, stat in pool_stats().items()})
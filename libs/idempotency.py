@@ -0,0 +1,385 @@
+"""
+    idempotency.py -    De-duplicates webhooks which JIRA automation retries
+                        or fires more than once. Each request is given a key,
+                        from the Idempotency-Key header or derived from its
+                        body, and repeats are answered with the response of
+                        the first request rather than being run again.
+"""
+
+import sys
+import json
+import time
+import hashlib
+import datetime
+import threading
+from functools import wraps
+from collections import OrderedDict
+import sqlalchemy
+from flask import request, current_app, Response
+import app
+
+IDEMPOTENCY_HEADER  = "Idempotency-Key"
+
+SCHEMA_STATEMENT    = """
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        idempotency_key CHAR(64) NOT NULL PRIMARY KEY,
+        status_code SMALLINT NULL,
+        content_type VARCHAR(255) NULL,
+        body MEDIUMTEXT NULL,
+        expires_at DATETIME NOT NULL,
+        KEY ix_idempotency_keys_expires_at (expires_at)
+    )
+"""
+
+# Expired rows are purged on every Nth claim rather than on a timer
+PURGE_EVERY         = 500
+
+_local_responses    = OrderedDict()
+_local_lock         = threading.Lock()
+_claim_count        = 0
+
+
+def ensure_idempotency_schema(engine):
+    """
+    Creates the table used to share keys between instances.
+    """
+    with engine.connect() as conn:
+        create_idempotency_schema(conn)
+
+
+def create_idempotency_schema(conn):
+    """
+    The body of ensure_idempotency_schema, on an open connection.
+    """
+    conn.execute(sqlalchemy.text(SCHEMA_STATEMENT))
+    conn.commit()
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def _remember(key, stored):
+    """
+    Keeps a completed response in the bounded, in-process store.
+    """
+    with _local_lock:
+        _local_responses[key] = (time.monotonic() + app.IDEMPOTENCY_TTL, stored)
+        _local_responses.move_to_end(key)
+
+        while len(_local_responses) > app.IDEMPOTENCY_CACHE_SIZE:
+            _local_responses.popitem(last=False)
+
+
+def _recall(key):
+    """
+    Returns a completed response from the in-process store, if there is one.
+    """
+    with _local_lock:
+        entry = _local_responses.get(key)
+
+        if entry is None:
+            return None
+
+        if entry[0] < time.monotonic():
+            del _local_responses[key]
+            return None
+
+        return entry[1]
+
+
+def _claim(conn, key):
+    """
+    Tries to take ownership of a key in the database.
+
+    Returns:
+    None if this request now owns the key, otherwise the existing row as
+    (status_code, content_type, body), where status_code is None while the
+    first request is still running.
+    """
+    global _claim_count
+
+    now = _utcnow()
+    expires_at = now + datetime.timedelta(seconds=app.IDEMPOTENCY_TTL)
+
+    _claim_count += 1
+    if _claim_count % PURGE_EVERY == 0:
+        conn.execute(sqlalchemy.text("DELETE FROM idempotency_keys WHERE expires_at < :now"), {"now": now})
+
+    claimed = conn.execute(
+        sqlalchemy.text("INSERT IGNORE INTO idempotency_keys (idempotency_key, expires_at) VALUES (:key, :expires_at)"),
+        {"key": key, "expires_at": expires_at}
+    ).rowcount
+
+    # Someone has been here before, take the key over if their claim has expired
+    if not claimed:
+        claimed = conn.execute(
+            sqlalchemy.text(
+                "UPDATE idempotency_keys SET status_code = NULL, content_type = NULL, body = NULL, "
+                "expires_at = :expires_at WHERE idempotency_key = :key AND expires_at < :now"
+            ),
+            {"key": key, "expires_at": expires_at, "now": now}
+        ).rowcount
+
+    if claimed:
+        conn.commit()
+        return None
+
+    existing = conn.execute(
+        sqlalchemy.text("SELECT status_code, content_type, body FROM idempotency_keys WHERE idempotency_key = :key"),
+        {"key": key}
+    ).one()
+    conn.commit()
+
+    return tuple(existing)
+
+
+def _complete(key, response):
+    """
+    Records the response for a key, or releases the key if the request
+    failed so that a retry is run properly.
+    """
+    with app.db.connect() as conn:
+        _store(conn, key, (response.status_code, response.content_type, response.get_data(as_text=True)))
+
+
+def _store(conn, key, stored):
+    """
+    The body of _complete, on an open connection.
+
+    Args:
+    stored: (status_code, content_type, body)
+    """
+    status_code, content_type, body = stored
+
+    if 200 <= status_code < 300:
+        conn.execute(
+            sqlalchemy.text(
+                "UPDATE idempotency_keys SET status_code = :status_code, content_type = :content_type, "
+                "body = :body WHERE idempotency_key = :key"
+            ),
+            {"key": key, "status_code": status_code, "content_type": content_type, "body": body}
+        )
+    else:
+        conn.execute(sqlalchemy.text("DELETE FROM idempotency_keys WHERE idempotency_key = :key"), {"key": key})
+
+    conn.commit()
+
+
+def _replay(stored):
+    """
+    Rebuilds the response to a request we've already seen.
+    """
+    status_code, content_type, body = stored
+
+    return Response(body, status=status_code, content_type=content_type, headers={"Idempotent-Replay": "true"})
+
+
+def _hash_key(path, raw_key):
+    """
+    Keys are per end-point path, so both the Flask and ASGI apps agree, and
+    hashed so they fit a fixed width column.
+    """
+    return hashlib.sha256(f"{path}:{raw_key}".encode("utf-8")).hexdigest()
+
+
+def idempotent(derive_key=None, local_only=False):
+    """
+    A decorator which short-circuits repeats of a request.
+
+    Args:
+    derive_key: Optional, a function taking the view's arguments and returning
+                a string identifying the request from its body, or None if the
+                request can't be identified. The Idempotency-Key header always
+                takes precedence.
+    local_only: Optional, only catch repeats seen by this process rather than
+                sharing keys through the database, for end-points which
+                mustn't wait on the database.
+    """
+
+    def decorator(view_function):
+
+        @wraps(view_function)
+        def decorated_function(*args, **kwargs):
+
+            raw_key = request.headers.get(IDEMPOTENCY_HEADER)
+            if raw_key is None and derive_key is not None:
+                raw_key = derive_key(*args, **kwargs)
+
+            if raw_key is None:
+                return view_function(*args, **kwargs)
+
+            key = _hash_key(request.path, raw_key)
+
+            stored = _recall(key)
+            if stored is not None:
+                return _replay(stored)
+
+            # Share the key with other instances through the database
+            try:
+                if local_only:
+                    existing, shared = None, False
+                else:
+                    with app.db.connect() as conn:
+                        existing = _claim(conn, key)
+                    shared = True
+
+            except Exception as e:
+
+                # Without the database we can still de-duplicate within this instance
+                print(f"Idempotency store unavailable, continuing without it: {e}", file=sys.stderr)
+                existing, shared = None, False
+
+            if existing is not None:
+
+                if existing[0] is None:
+                    return Response("Duplicate Request In Progress", status=409, mimetype='text/plain',
+                                    headers={"Retry-After": "1"})
+
+                _remember(key, existing)
+                return _replay(existing)
+
+            response = current_app.make_response(view_function(*args, **kwargs))
+
+            if 200 <= response.status_code < 300:
+                _remember(key, (response.status_code, response.content_type, response.get_data(as_text=True)))
+
+            if shared:
+                try:
+                    _complete(key, response)
+                except Exception as e:
+                    print(f"Failed to record idempotency key: {e}", file=sys.stderr)
+
+            return response
+
+        return decorated_function
+
+    return decorator
+
+
+def idempotent_async(derive_key=None, local_only=False):
+    """
+    The asyncio equivalent of idempotent, for Starlette end-points.
+
+    Args:
+    derive_key: Optional, a coroutine function taking the request and
+                returning a string identifying it, or None.
+    local_only: Optional, as for idempotent
+    """
+    from starlette.responses import Response as StarletteResponse, PlainTextResponse
+
+    def replay(stored):
+        status_code, content_type, body = stored
+
+        return StarletteResponse(body, status_code=status_code,
+                                 headers={"Content-Type": content_type, "Idempotent-Replay": "true"})
+
+    def decorator(view_function):
+
+        @wraps(view_function)
+        async def decorated_function(request):
+
+            raw_key = request.headers.get(IDEMPOTENCY_HEADER)
+            if raw_key is None and derive_key is not None:
+                raw_key = await derive_key(request)
+
+            if raw_key is None:
+                return await view_function(request)
+
+            key = _hash_key(request.url.path, raw_key)
+
+            stored = _recall(key)
+            if stored is not None:
+                return replay(stored)
+
+            try:
+                if local_only:
+                    existing, shared = None, False
+                else:
+                    existing = await app.async_db.run(_claim, key)
+                    shared = True
+
+            except Exception as e:
+
+                print(f"Idempotency store unavailable, continuing without it: {e}", file=sys.stderr)
+                existing, shared = None, False
+
+            if existing is not None:
+
+                if existing[0] is None:
+                    return PlainTextResponse("Duplicate Request In Progress", status_code=409,
+                                             headers={"Retry-After": "1"})
+
+                _remember(key, existing)
+                return replay(existing)
+
+            response = await view_function(request)
+            stored = (response.status_code, response.headers.get("content-type"), response.body.decode("utf-8"))
+
+            if 200 <= response.status_code < 300:
+                _remember(key, stored)
+
+            if shared:
+                try:
+                    await app.async_db.run(_store, key, stored)
+                except Exception as e:
+                    print(f"Failed to record idempotency key: {e}", file=sys.stderr)
+
+            return response
+
+        return decorated_function
+
+    return decorator
+
+
+def _adr_key(request_data):
+    if not isinstance(request_data, dict) or ('status' not in request_data and 'updated' not in request_data):
+        return None
+
+    return json.dumps([request_data.get('key'), request_data.get('status'), request_data.get('updated')])
+
+
+def _event_key(source_system, request_data):
+    if not isinstance(request_data, dict) or 'source_timestamp' not in request_data:
+        return None
+
+    return json.dumps([source_system, request_data], sort_keys=True)
+
+
+async def _json_body(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def adr_request_key():
+    """
+    Identifies an ADR publication by its key plus the status or updated time
+    the automation sent. A bare key isn't enough, as a later transition of
+    the same ADR is a genuinely new publication.
+    """
+    return _adr_key(request.get_json(silent=True))
+
+
+def event_request_key(source_system):
+    """
+    Identifies an event by its whole body, but only when it carries its own
+    source_timestamp, otherwise two genuine identical events would collide.
+    Used with local_only, so accepting an event doesn't wait on the database.
+    """
+    return _event_key(source_system, request.get_json(silent=True))
+
+
+async def adr_request_key_async(request):
+    """
+    The asyncio equivalent of adr_request_key, for a Starlette request.
+    """
+    return _adr_key(await _json_body(request))
+
+
+async def event_request_key_async(request):
+    """
+    The asyncio equivalent of event_request_key, for a Starlette request.
+    """
+    return _event_key(request.path_params["source_system"], await _json_body(request))
@@ -3,108 +3,121 @@
                             functions of technical-governance in Slack. 
 """
 
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import arrow
-from flask import Response, request
 import app
-import sys
-from libs.template import load_template
-
-def publish_agenda():
+from libs.template import render_template
+from libs.jobs import report_progress
+from libs.adr_index import adr_index
+from libs.message_builder import MessageBuilder
+from libs.message_ledger import issue_lock, read_ledger, publish_to_channel, UNCHANGED
+from libs.adr_digest import queue_adr
+from libs.metrics import PUBLISH_MESSAGES
+from libs.jira_search import AGENDA_FIELDS, ADR_FIELDS, SCORECARD_FIELDS
+from libs.jira_mirror import MirroredJql
+
+# The pools which run JIRA queries and Slack posts side by side, created on first use
+_pools      = {}
+_pools_lock = threading.Lock()
+
+def _agenda_header_config():
     """
-    Publishes the TDA Agenda to the TDA Slack channel
-
-    Args:
-    None
+    Works out the date of the next TDA, and the template data for the header.
 
     Returns:
-    HTTP 200 + "OK"
+    (next wednesday as YYYY-MM-DD, template_config)
     """
 
-    # Search for issues which fit the criteria
-    search_jql       = f'filter = {app.JIRA_SEARCH_FILTER}'
-    agenda_issues   = app.jira.jql(search_jql)
-
     # It's a bit crude, but find next Wednesday to build the header message
     the_time_now = arrow.utcnow()
     next_wednesday_human = str(the_time_now.shift(weekday=2).humanize())
     next_wednesday_date = str(the_time_now.shift(weekday=2).format("YYYY-MM-DD"))
 
-    # Build the content for the template
     template_config = {
         "%LONGDATE%" : next_wednesday_date,
         "%HUMANDATE%": next_wednesday_human
     }
 
-    # Get the JSON for the header
-    message_agenda = load_template("tda_agenda_header", template_config)
+    return next_wednesday_date, template_config
 
-    # Post it to Slack
-    app.app.client.chat_postMessage(
-        channel=app.SLACK_CHANNEL,
-        blocks=message_agenda,
-        text=f"TDA Agenda: {next_wednesday_date}"
-    )
+def _agenda_item_config(agenda_issue):
+    """
+    Prepares the template data for a single agenda item.
+    """
+    issue_author    = agenda_issue['fields']['creator']['displayName']
+    issue_summary   = agenda_issue['fields']['summary']
+    issue_key       = agenda_issue['key']
+    issue_link      = app.ATLASSIAN_API_ROOT+"/browse/"+issue_key
+
+    return {
+        "%KEY%" : issue_key,
+        "%AUTHOR%": issue_author,
+        "%SUMMARY%": issue_summary,
+        "%LINK%": issue_link
+    }
 
-    # We need to behave differently if we don't have any items for TDA
-    if len(agenda_issues['issues']) == 0:
+def publish_agenda():
+    """
+    Publishes the TDA Agenda to the TDA Slack channel
 
-        # There's nothing required for the template
-        template_config = {}
+    Args:
+    None
 
-        # Get the JSON for the message
-        message_agenda = load_template("tda_agenda_noitems", template_config)
+    Returns:
+    None
+    """
 
-        # Post it to Slack
-        app.app.client.chat_postMessage(
-            channel=app.SLACK_CHANNEL,
-            blocks=message_agenda,
-            text=f"TDA Cancelled: {next_wednesday_date}"
-        )
+    # The issues which fit the criteria, read from the local mirror of the filter
+    agenda_search   = MirroredJql(app.JIRA_SEARCH_FILTER, AGENDA_FIELDS)
+    agenda_issues   = iter(agenda_search)
+
+    # Only the first issue is needed to know whether TDA is going ahead
+    first_issue     = next(agenda_issues, None)
 
+    # Build the content for the header template
+    next_wednesday_date, template_config = _agenda_header_config()
+
+    # The whole agenda is packed into as few messages as Slack allows
+    if first_issue is None:
+        message_builder = MessageBuilder(app.SLACK_CHANNEL, f"TDA Cancelled: {next_wednesday_date}")
     else:
+        message_builder = MessageBuilder(app.SLACK_CHANNEL, f"TDA Agenda: {next_wednesday_date}")
 
-        # Build and post a message for each item we've been given by the query
-        for agenda_issue in agenda_issues['issues']:
+    # Get the JSON for the header
+    message_builder.add(render_template("tda_agenda_header", template_config))
 
-            issue_author    = agenda_issue['fields']['creator']['displayName']
-            issue_summary   = agenda_issue['fields']['summary']
-            issue_key       = agenda_issue['key']
-            issue_link      = app.ATLASSIAN_API_ROOT+"/browse/"+issue_key
+    # We need to behave differently if we don't have any items for TDA
+    if first_issue is None:
 
+        # There's nothing required for the template
+        template_config = {}
 
-            # Prepare the template data
-            template_config = {
-                "%KEY%" : issue_key,
-                "%AUTHOR%": issue_author,
-                "%SUMMARY%": issue_summary,
-                "%LINK%": issue_link
-            }
+        # Get the JSON for the message
+        message_builder.add(render_template("tda_agenda_noitems", template_config))
 
-            # Get the JSON for the message
-            message_agenda = load_template("tda_agenda", template_config)
+    else:
 
-            # Post it to Slack
-            app.app.client.chat_postMessage(
-                channel=app.SLACK_CHANNEL,
-                blocks=message_agenda,
-                text="TDA Agenda Item"
-            )
+        # Build and post a message for each item we've been given by the query
+        for issue_number, agenda_issue in enumerate(itertools.chain([first_issue], agenda_issues), start=1):
 
-    return Response("OK", status=200, mimetype='text/plain')
+            # Get the JSON for the message, it's posted once the message is full
+            message_builder.add(render_template("tda_agenda", _agenda_item_config(agenda_issue)))
 
-def publish_adr():
-    """ 
-    Broadcasts the state of an ADR to the channels of those teams impacted by it
+            report_progress(issue_number, agenda_search.total)
 
-    Args:
-    None
+    # Post whatever is left
+    PUBLISH_MESSAGES.observe(message_builder.flush(), "publish_agenda")
 
-    Returns:
-    HTTP 200 + "OK"
+def _adr_message(issue_data):
     """
+    Builds the message for an ADR and maps its impacted value-streams to
+    their Slack channels.
 
-    # Get issue data from jira
-    issue_data = app.jira.issue(request.json['key'])
+    Returns:
+    (message blocks, [channel ids]), or (None, []) when no value-streams are impacted
+    """
 
     # Identify the stuff we want to post to Slack.
     impacted_value_stream_str       = str()
@@ -116,101 +129,158 @@ def publish_adr():
     issue_link                      = app.ATLASSIAN_API_ROOT+"/browse/"+issue_key
 
     # We may process ADRs which have no impacted value-stream
-    if type(issue_impacted_value_streams) is list:
-        # Produce a string of impacted value-streams for the message
-        for impacted_value_stream in issue_impacted_value_streams:
-            impacted_value_stream_str = impacted_value_stream_str + impacted_value_stream['value']+","
+    if type(issue_impacted_value_streams) is not list:
+        return None, []
 
-        # The last character will always be a , and needs to be trimmed to look less rubbish
-        impacted_value_stream_str = impacted_value_stream_str[0:-1]
-
-    else:
-        # If we have no impacted value-streams
-        impacted_value_stream_str = "No Impacted Value-Streams"
+    # Produce a string of impacted value-streams for the message
+    for impacted_value_stream in issue_impacted_value_streams:
+        impacted_value_stream_str = impacted_value_stream_str + impacted_value_stream['value']+","
 
+    # The last character will always be a , and needs to be trimmed to look less rubbish
+    impacted_value_stream_str = impacted_value_stream_str[0:-1]
 
     # Build the relevant information for each post we're go
-    if type(issue_impacted_value_streams) is list:
-
-        for impacted_value_stream in issue_impacted_value_streams:
-
-            # A bit crude - map the impacted value-stream to the respective slack channel.
-            if impacted_value_stream['value'] == "Mortgages":
-                vs_slack_id = app.SLACK_CHANNEL_MAP['Mortgages']
-            if impacted_value_stream['value'] == "Enterprise":
-                vs_slack_id = app.SLACK_CHANNEL_MAP['Enterprise']
-            if impacted_value_stream['value'] == "Platform":
-                vs_slack_id = app.SLACK_CHANNEL_MAP['Platform']
-            if impacted_value_stream['value'] == "Savings":
-                vs_slack_id = app.SLACK_CHANNEL_MAP['Savings']
-            if impacted_value_stream['value'] == "Business Banking":
-                vs_slack_id = app.SLACK_CHANNEL_MAP['Business Banking']
-            else:
-                vs_slack_id = app.SLACK_CHANNEL
-
-            template_config = {
-                "%KEY%" : issue_key,
-                "%STATUS%": issue_status,
-                "%AUTHOR%": issue_assignee,
-                "%VS_IMPACTED%": impacted_value_stream_str,
-                "%SUMMARY%": issue_summary,
-                "%LINK%": issue_link
-            }
-
-            message_adr = load_template("adr_published", template_config)
-
-            app.app.client.chat_postMessage(
-                channel=vs_slack_id,
-                blocks=message_adr,
-                text="ADR Published"
-            )
-
-    return Response("OK", status=200, mimetype='text/plain')
+    template_config = {
+        "%KEY%" : issue_key,
+        "%STATUS%": issue_status,
+        "%AUTHOR%": issue_assignee,
+        "%VS_IMPACTED%": impacted_value_stream_str,
+        "%SUMMARY%": issue_summary,
+        "%LINK%": issue_link
+    }
+
+    message_adr = render_template("adr_published", template_config)
+
+    # Map the impacted value-streams to their slack channels, each channel only once
+    vs_slack_ids = app.channel_router.channels_for(
+        [impacted_value_stream['value'] for impacted_value_stream in issue_impacted_value_streams]
+    )
+
+    return message_adr, vs_slack_ids
+
+def publish_adr(issue_key, issue_updated=None):
+    """ 
+    Broadcasts the state of an ADR to the channels of those teams impacted by it
+
+    Args:
+    issue_key: The JIRA key for the ADR
+    issue_updated: The issue's updated time if the caller knows it, saves revalidating the cache
+
+    Returns:
+    None
+    """
+
+    # Get issue data from jira
+    issue_data = app.jira.issue(issue_key, fields=ADR_FIELDS, updated=issue_updated)
+
+    # Keep the /adr search index in step with what was published
+    adr_index.update(issue_data)
+
+    # Build the message, and work out which channels it goes to
+    message_adr, vs_slack_ids = _adr_message(issue_data)
+
+    # In digest mode the message waits to be posted with the rest of its window
+    if message_adr is not None and app.ADR_DIGEST_WINDOW:
+        queue_adr(issue_data['key'], message_adr, vs_slack_ids)
+
+    elif message_adr is not None:
+
+        # Hold the ADR while we work out, and make, its posts and edits, so
+        # two publishes of it can't both post a first message
+        with issue_lock(issue_data['key']):
+
+            ledger = read_ledger(issue_data['key'])
+
+            # Post to every channel at once rather than one after another
+            fanout_pool = _shared_pool("adr_fanout", app.ADR_FANOUT_CONCURRENCY)
+            posts = [
+                fanout_pool.submit(
+                    publish_to_channel, issue_data['key'], vs_slack_id, message_adr, "ADR Published",
+                    ledger.get(vs_slack_id)
+                )
+                for vs_slack_id in vs_slack_ids
+            ]
+
+            for post_number, post in enumerate(as_completed(posts), start=1):
+                report_progress(post_number, len(posts))
+
+        # Only count the messages that were actually posted or edited
+        PUBLISH_MESSAGES.observe(
+            sum(1 for post in posts if post.exception() is None and post.result() != UNCHANGED),
+            "publish_adr"
+        )
+
+        # Let every post finish before reporting the first failure
+        for post in posts:
+            post.result()
+
+def _shared_pool(name, max_workers):
+    """
+    Returns a named, bounded thread pool, creating it on first use.
+    """
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"archibot-{name}")
+
+        return _pools[name]
+
+def _scorecard_filter(scorecard_topic):
+    """
+    Reads the filter behind a single scorecard topic from the mirror. Only the
+    fields we display are kept, so the whole result is small enough to hold.
+    """
+    return list(MirroredJql(scorecard_topic['filter_id'], SCORECARD_FIELDS))
+
+def _scorecard_item_config(issue):
+    """
+    Prepares the template data for a single scorecard task.
+    """
+    return {
+        "%NAME%": issue['fields']['assignee']['displayName'],
+        "%STATUS%": issue['fields']['status']['name'],
+        "%SUMMARY%": issue['fields']['summary'],
+        "%LINKURL%": "https://atombank.atlassian.net/issues/"+issue['key'],
+        "%ISSUEKEY%": issue['key']
+    }
 
 def scorecard_tasks_by_user():
     """
     Displays tasks currently assigned to users, organised by Scorecard category
 
     Args:
-    filter_id: The JIRA Filter ID which generates the results
+    None
 
     Returns:
-    HTTP 200 + "OK"
+    None
     """
 
+    # Every topic and item is packed into as few messages as Slack allows
+    message_builder = MessageBuilder(app.AA_SLACK_CHANNEL, "Scorecard Progress Update")
+
+    # Every filter runs at once, but results come back in the configured order
+    # so they can be posted as soon as the topics before them are done.
+    topic_results = _shared_pool("scorecard", app.SCORECARD_CONCURRENCY).map(_scorecard_filter, app.SCORECARD_MAP)
+
     # The scorecard map from app contains the structure we need to follow
-    for scorecard_topic in app.SCORECARD_MAP:
-        
-        # Execute a search of the filter
-        search_jql      = f'filter = {scorecard_topic['filter_id']}'
-        filter_data     = app.jira.jql(search_jql)
+    for topic_number, (scorecard_topic, filter_data) in enumerate(zip(app.SCORECARD_MAP, topic_results), start=1):
 
         # Post a header for the Scorecard topic
         template_config = {
             "%SCORECARD_TOPIC%": scorecard_topic['name']
 
         }
-        message = load_template("scorecard_topic", template_config)
-        app.app.client.chat_postMessage(channel=app.AA_SLACK_CHANNEL, blocks=message, text="Scorecard Progress Update")
+        message_builder.add(render_template("scorecard_topic", template_config))
 
         # Each item represents a task the team member is working on.
-        for issue in filter_data['issues']:
-
-            # Create the item to post, based on the template
-            template_config = {
-                "%NAME%": issue['fields']['assignee']['displayName'],
-                "%STATUS%": issue['fields']['status']['name'],
-                "%SUMMARY%": issue['fields']['summary'],
-                "%LINKURL%": "https://atombank.atlassian.net/issues/"+issue['key'],
-                "%ISSUEKEY%": issue['key']
-
-            }
+        for issue in filter_data:
 
             # Merge the data with the template
-            message = load_template("scorecard_item", template_config)
+            message_builder.add(render_template("scorecard_item", _scorecard_item_config(issue)))
 
-            # Post to Slack
-            app.app.client.chat_postMessage(channel=app.AA_SLACK_CHANNEL, blocks=message, text="Scorecard Progress Update")
+        report_progress(topic_number, len(app.SCORECARD_MAP))
+
+    # Post whatever is left
+    PUBLISH_MESSAGES.observe(message_builder.flush(), "scorecard_tasks_by_user")
 
 
     """
@@ -243,5 +313,3 @@ def scorecard_tasks_by_user():
         # Post to Slack
         app.app.client.chat_postMessage(channel=app.SLACK_CHANNEL, blocks=message, text="Scorecard Progress Update")
     """
-
-    return Response("OK", status=200, mimetype='text/plain')
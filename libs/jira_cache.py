@@ -0,0 +1,302 @@
+"""
+    jira_cache.py -     A caching layer in front of the atlassian Jira client.
+                        Issue and JQL lookups are kept in a bounded LRU with a
+                        TTL, and expired entries are revalidated against each
+                        issue's 'updated' field before being fetched in full.
+                        AsyncCachedJira does the same for libs/async_jira.py
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from libs.metrics import time_call
+from libs.metrics import time_call_async
+
+
+def _fields_with_updated(fields):
+    """
+    Makes sure 'updated' is requested, so that results can be revalidated.
+    """
+    if fields == "*all":
+        return fields
+
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+
+    if "updated" not in fields:
+        fields = list(fields) + ["updated"]
+
+    return ",".join(fields)
+
+
+def _issue_marker(issue):
+    """
+    Returns the value used to decide whether an issue has changed.
+    """
+    return (issue.get("key"), (issue.get("fields") or {}).get("updated"))
+
+
+def _jql_marker(result):
+    """
+    Returns the value used to decide whether a JQL result has changed.
+    """
+    return (result.get("total"), tuple(_issue_marker(issue) for issue in result.get("issues", [])))
+
+
+class CacheEntry:
+    """
+    A cached value along with when it was stored and its change marker.
+    """
+
+    def __init__(self, value, marker):
+        self.value      = value
+        self.marker     = marker
+        self.stored_at  = time.monotonic()
+
+
+class CachedJira:
+    """
+    Wraps an atlassian.Jira client, caching issue() and jql(). Anything else
+    is passed straight through to the wrapped client. Cached results are
+    shared, so callers must not change them.
+    """
+
+    def __init__(self, jira, max_entries, ttl):
+        self._jira          = jira
+        self._max_entries   = max_entries
+        self._ttl           = ttl
+        self._entries       = OrderedDict()
+        self._lock          = threading.Lock()
+        self._counters      = {
+            "hits": 0,
+            "misses": 0,
+            "revalidated": 0,
+            "stale": 0,
+            "invalidations": 0,
+            "evictions": 0
+        }
+
+    def __getattr__(self, name):
+        return getattr(self._jira, name)
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _get(self, cache_key):
+        """
+        Returns the entry for a key, marking it as recently used.
+        """
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                self._entries.move_to_end(cache_key)
+            return entry
+
+    def _put(self, cache_key, value, marker):
+        """
+        Stores a value, evicting the least recently used entries if full.
+        """
+        with self._lock:
+            self._entries[cache_key] = CacheEntry(value, marker)
+            self._entries.move_to_end(cache_key)
+
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def _usable(self, entry, expected_marker):
+        """
+        Decides whether an entry can be returned without asking JIRA.
+        """
+        # The caller told us what the current state is, so no need to ask
+        if expected_marker is not None:
+            usable = entry.marker == expected_marker
+        else:
+            usable = time.monotonic() - entry.stored_at < self._ttl
+
+        if usable:
+            self._count("hits")
+
+        return usable
+
+    def _revalidated(self, entry):
+        """
+        Keeps an old entry for another TTL, as JIRA says nothing has changed.
+        """
+        entry.stored_at = time.monotonic()
+        self._count("revalidated")
+
+        return entry.value
+
+    def _lookup(self, cache_key, fetch, revalidate, marker_of, expected_marker=None):
+        """
+        The common cache logic for issues and JQL.
+
+        Args:
+        cache_key: The key for the cache entry
+        fetch: Fetches the full value from JIRA
+        revalidate: Fetches a cheap marker from JIRA to compare against
+        marker_of: Works out the marker for a fully fetched value
+        expected_marker: A marker the caller already knows is current, if any
+
+        Returns:
+        The cached or freshly fetched value.
+        """
+        entry = self._get(cache_key)
+
+        if entry is not None:
+
+            if self._usable(entry, expected_marker):
+                return entry.value
+
+            # The entry is old, but if JIRA says nothing changed it can be kept
+            if expected_marker is None and entry.marker is not None and revalidate() == entry.marker:
+                return self._revalidated(entry)
+
+            self._count("stale")
+
+        else:
+
+            self._count("misses")
+
+        value = fetch()
+        self._put(cache_key, value, marker_of(value))
+
+        return value
+
+    def issue(self, key, fields="*all", expand=None, updated=None):
+        """
+        A cached version of Jira.issue().
+
+        Args:
+        key: The issue key
+        fields / expand: As for Jira.issue()
+        updated: The issue's current 'updated' value if known, e.g. from a webhook
+
+        Returns:
+        The issue, as returned by Jira.issue().
+        """
+        fields = _fields_with_updated(fields)
+        cache_key = ("issue", key, fields, expand)
+
+        return self._lookup(
+            cache_key,
+            fetch=lambda: time_call("jira.issue", self._jira.issue, key, fields=fields, expand=expand),
+            revalidate=lambda: _issue_marker(time_call("jira.issue", self._jira.issue, key, fields="updated")),
+            marker_of=_issue_marker,
+            expected_marker=None if updated is None else (key, updated)
+        )
+
+    def jql(self, jql, fields="*all", start=0, limit=None, expand=None, validate_query=None):
+        """
+        A cached version of Jira.jql(), with the same arguments.
+        """
+        fields = _fields_with_updated(fields)
+        cache_key = ("jql", jql, fields, start, limit, expand)
+
+        return self._lookup(
+            cache_key,
+            fetch=lambda: time_call("jira.jql", self._jira.jql, jql, fields=fields, start=start, limit=limit,
+                                    expand=expand, validate_query=validate_query),
+            revalidate=lambda: _jql_marker(time_call("jira.jql", self._jira.jql, jql, fields="updated",
+                                                     start=start, limit=limit)),
+            marker_of=_jql_marker
+        )
+
+    def invalidate(self, key=None):
+        """
+        Drops cached entries for an issue key, including any JQL results
+        containing it, or everything if no key is given.
+
+        Returns:
+        The number of entries dropped.
+        """
+        with self._lock:
+
+            if key is None:
+                dropped = list(self._entries)
+
+            else:
+                dropped = [
+                    cache_key for cache_key, entry in self._entries.items()
+                    if (cache_key[0] == "issue" and cache_key[1] == key)
+                    or (cache_key[0] == "jql" and any(issue_key == key for issue_key, _ in entry.marker[1]))
+                ]
+
+            for cache_key in dropped:
+                del self._entries[cache_key]
+
+            self._counters["invalidations"] += len(dropped)
+
+        return len(dropped)
+
+    def stats(self):
+        """
+        Returns the cache counters and current size.
+        """
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries))
+
+
+class AsyncCachedJira(CachedJira):
+    """
+    The asyncio equivalent of CachedJira, wrapping an AsyncJira client.
+    The cache itself is shared code, only the calls to JIRA are awaited.
+    """
+
+    async def _lookup(self, cache_key, fetch, revalidate, marker_of, expected_marker=None):
+        entry = self._get(cache_key)
+
+        if entry is not None:
+
+            if self._usable(entry, expected_marker):
+                return entry.value
+
+            if expected_marker is None and entry.marker is not None and await revalidate() == entry.marker:
+                return self._revalidated(entry)
+
+            self._count("stale")
+
+        else:
+
+            self._count("misses")
+
+        value = await fetch()
+        self._put(cache_key, value, marker_of(value))
+
+        return value
+
+    async def _marker(self, marker_of, dependency, func, *args, **kwargs):
+        return marker_of(await time_call_async(dependency, func, *args, **kwargs))
+
+    async def issue(self, key, fields="*all", expand=None, updated=None):
+        """
+        A cached version of AsyncJira.issue(), see CachedJira.issue()
+        """
+        fields = _fields_with_updated(fields)
+        cache_key = ("issue", key, fields, expand)
+
+        return await self._lookup(
+            cache_key,
+            fetch=lambda: time_call_async("jira.issue", self._jira.issue, key, fields=fields, expand=expand),
+            revalidate=lambda: self._marker(_issue_marker, "jira.issue", self._jira.issue, key, fields="updated"),
+            marker_of=_issue_marker,
+            expected_marker=None if updated is None else (key, updated)
+        )
+
+    async def jql(self, jql, fields="*all", start=0, limit=None, expand=None):
+        """
+        A cached version of AsyncJira.jql(), see CachedJira.jql()
+        """
+        fields = _fields_with_updated(fields)
+        cache_key = ("jql", jql, fields, start, limit, expand)
+
+        return await self._lookup(
+            cache_key,
+            fetch=lambda: time_call_async("jira.jql", self._jira.jql, jql, fields=fields, start=start, limit=limit,
+                                          expand=expand),
+            revalidate=lambda: self._marker(_jql_marker, "jira.jql", self._jira.jql, jql, fields="updated",
+                                            start=start, limit=limit),
+            marker_of=_jql_marker
+        )
@@ -0,0 +1,505 @@
+"""
+    jira_mirror.py -    Keeps a copy of the issues in the agenda and scorecard
+                        filters in the database. After the first load only the
+                        issues updated since the last sync are fetched, so the
+                        publishers read the filters locally rather than running
+                        each of them against JIRA every time.
+
+                        JQL dates are in the JIRA user's timezone, so changes
+                        are found with a relative 'updated >= -Nm' rather than
+                        a timestamp. Mirrored issues updated in the same window
+                        which no longer match the filter are removed, and an
+                        issue new to the filter triggers a full reload so it
+                        takes its place in the filter's order. The whole filter
+                        is also reloaded every JIRA_MIRROR_RECONCILE seconds, to
+                        catch anything else, e.g. an edit to the filter itself.
+"""
+
+import sys
+import json
+import math
+import asyncio
+import datetime
+import threading
+import sqlalchemy
+import app
+from libs.jobs import report_progress
+from libs.jira_search import PagedJql, AsyncPagedJql, MIRROR_FIELDS
+
+SCHEMA_STATEMENTS   = [
+    """
+    CREATE TABLE IF NOT EXISTS jira_mirror_issues (
+        filter_id VARCHAR(32) NOT NULL,
+        issue_key VARCHAR(64) NOT NULL,
+        position INT NOT NULL,
+        issue TEXT NOT NULL,
+        PRIMARY KEY (filter_id, issue_key)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS jira_mirror_state (
+        filter_id VARCHAR(32) NOT NULL PRIMARY KEY,
+        synced_at DATETIME NOT NULL,
+        reconciled_at DATETIME NOT NULL
+    )
+    """
+]
+
+# Only these parts of users, statuses and options are kept
+COMPACT_KEYS        = ("displayName", "name", "value")
+
+# Mirrored keys are checked for leaving a filter this many per search
+KEYS_PER_SEARCH     = 100
+
+# Only the key is needed from an issue which has left a filter
+DEPARTED_FIELDS     = ["updated"]
+
+# Syncs of the same filter in this process are run one at a time
+_filter_locks       = {}
+_filter_locks_lock  = threading.Lock()
+_async_filter_locks = {}
+
+
+def ensure_mirror_schema(engine):
+    """
+    Creates the mirror tables if they don't already exist.
+    """
+    with engine.connect() as conn:
+        create_mirror_schema(conn)
+
+
+def create_mirror_schema(conn):
+    """
+    The body of ensure_mirror_schema, on an open connection.
+    """
+    for statement in SCHEMA_STATEMENTS:
+        conn.execute(sqlalchemy.text(statement))
+    conn.commit()
+
+
+def mirrored_filters():
+    """
+    Returns the ids of every filter the publishers read.
+    """
+    return [str(app.JIRA_SEARCH_FILTER)] + [str(topic['filter_id']) for topic in app.SCORECARD_MAP]
+
+
+def _compact(value):
+    """
+    Drops everything but the display values from JIRA's user, status and
+    option objects, e.g. the avatars and links held in every user.
+    """
+    if isinstance(value, list):
+        return [_compact(item) for item in value]
+
+    if isinstance(value, dict) and any(key in value for key in COMPACT_KEYS):
+        return {key: value[key] for key in COMPACT_KEYS if key in value}
+
+    return value
+
+
+def _project(issue):
+    """
+    The part of an issue that is stored, shaped like JIRA's own results.
+    """
+    fields = issue.get('fields') or {}
+
+    return {
+        "key": issue['key'],
+        "fields": {name: _compact(fields.get(name)) for name in MIRROR_FIELDS}
+    }
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def read_state(conn, filter_id):
+    """
+    Returns (synced_at, reconciled_at) for a filter, or None if it has never
+    been synced.
+    """
+    row = conn.execute(
+        sqlalchemy.text(
+            "SELECT synced_at, reconciled_at FROM jira_mirror_state WHERE filter_id = :filter_id"
+        ).columns(synced_at=sqlalchemy.DateTime, reconciled_at=sqlalchemy.DateTime),
+        {"filter_id": filter_id}
+    ).first()
+
+    return None if row is None else (row.synced_at, row.reconciled_at)
+
+
+def read_issues(conn, filter_id):
+    """
+    Returns the mirrored issues of a filter, in the filter's order.
+    """
+    rows = conn.execute(
+        sqlalchemy.text("SELECT issue FROM jira_mirror_issues WHERE filter_id = :filter_id ORDER BY position"),
+        {"filter_id": filter_id}
+    )
+
+    return [json.loads(row.issue) for row in rows]
+
+
+def read_keys(conn, filter_id):
+    """
+    Returns the set of issue keys mirrored for a filter.
+    """
+    rows = conn.execute(
+        sqlalchemy.text("SELECT issue_key FROM jira_mirror_issues WHERE filter_id = :filter_id"),
+        {"filter_id": filter_id}
+    )
+
+    return {row.issue_key for row in rows}
+
+
+def write_issues(conn, filter_id, issues, synced_at, full, departed=()):
+    """
+    Stores the result of a sync and moves the filter's watermark on.
+
+    Args:
+    conn: An open connection
+    filter_id: The JIRA filter id
+    issues: The projected issues fetched
+    synced_at: When the sync started, the next sync looks for changes since then
+    full: True if issues is the whole filter, which replaces what's stored
+    departed: The keys of issues which have left the filter since the last sync
+    """
+    if departed:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM jira_mirror_issues WHERE filter_id = :filter_id AND issue_key = :issue_key"),
+            [{"filter_id": filter_id, "issue_key": issue_key} for issue_key in departed]
+        )
+
+    if full:
+
+        conn.execute(
+            sqlalchemy.text("DELETE FROM jira_mirror_issues WHERE filter_id = :filter_id"),
+            {"filter_id": filter_id}
+        )
+        positions = {}
+        next_position = 0
+
+    else:
+
+        # Issues already in the filter keep their place, a sync which finds new
+        # ones is made a full one
+        positions = dict(conn.execute(
+            sqlalchemy.text("SELECT issue_key, position FROM jira_mirror_issues WHERE filter_id = :filter_id"),
+            {"filter_id": filter_id}
+        ).all())
+        next_position = max(positions.values(), default=-1) + 1
+
+    rows = []
+    for issue in issues:
+
+        position = positions.get(issue['key'])
+        if position is None:
+            position = positions[issue['key']] = next_position
+            next_position += 1
+
+        rows.append({
+            "filter_id": filter_id,
+            "issue_key": issue['key'],
+            "position": position,
+            "issue": json.dumps(issue, separators=(",", ":"))
+        })
+
+    if rows:
+        conn.execute(
+            sqlalchemy.text(
+                "INSERT INTO jira_mirror_issues (filter_id, issue_key, position, issue) "
+                "VALUES (:filter_id, :issue_key, :position, :issue) "
+                "ON DUPLICATE KEY UPDATE position = VALUES(position), issue = VALUES(issue)"
+            ),
+            rows
+        )
+
+    # A full load also counts as a reconcile
+    conn.execute(
+        sqlalchemy.text(
+            "INSERT INTO jira_mirror_state (filter_id, synced_at, reconciled_at) "
+            "VALUES (:filter_id, :synced_at, :synced_at) "
+            "ON DUPLICATE KEY UPDATE synced_at = VALUES(synced_at)"
+            + (", reconciled_at = VALUES(reconciled_at)" if full else "")
+        ),
+        {"filter_id": filter_id, "synced_at": synced_at}
+    )
+    conn.commit()
+
+
+def changed_since(state, now):
+    """
+    Returns the JQL clause matching issues updated since the last sync.
+    """
+    # JQL only has minute precision, so look back a little further than needed
+    minutes = math.ceil(((now - state[0]).total_seconds() + app.JIRA_MIRROR_OVERLAP) / 60)
+
+    return f"updated >= -{minutes}m"
+
+
+def sync_query(filter_id, state, now):
+    """
+    Works out what to ask JIRA for.
+
+    Returns:
+    (jql, full), where full is True if the jql returns the whole filter
+    """
+    filter_jql = f"filter = {filter_id}"
+
+    if state is None:
+        return filter_jql, True
+
+    if (now - state[1]).total_seconds() >= app.JIRA_MIRROR_RECONCILE:
+        return filter_jql, True
+
+    return f"{filter_jql} AND {changed_since(state, now)}", False
+
+
+def departure_queries(filter_id, keys, state, now):
+    """
+    Builds the searches for mirrored issues which were updated since the
+    last sync and no longer match the filter, KEYS_PER_SEARCH keys at a time.
+    """
+    keys = sorted(keys)
+
+    return [
+        f"key in ({', '.join(keys[start:start + KEYS_PER_SEARCH])}) AND {changed_since(state, now)} "
+        f"AND NOT filter = {filter_id}"
+        for start in range(0, len(keys), KEYS_PER_SEARCH)
+    ]
+
+
+def _stale(state, now):
+    return state is None or (now - state[0]).total_seconds() >= app.JIRA_MIRROR_MAX_AGE
+
+
+def _filter_lock(filter_id):
+    with _filter_locks_lock:
+        return _filter_locks.setdefault(filter_id, threading.Lock())
+
+
+def sync_filter(filter_id):
+    """
+    Brings the mirror of one filter up to date.
+
+    Returns:
+    The number of issues fetched from JIRA
+    """
+    with _filter_lock(filter_id):
+
+        started = _now()
+
+        with app.db.connect() as conn:
+            state = read_state(conn, filter_id)
+            mirrored = read_keys(conn, filter_id)
+
+        jql, full = sync_query(filter_id, state, started)
+        issues = [_project(issue) for issue in PagedJql(jql, MIRROR_FIELDS)]
+        departed = set()
+
+        if not full:
+
+            # An issue new to the filter is only in its right place after a full load
+            full = any(issue['key'] not in mirrored for issue in issues)
+
+            try:
+                if not full:
+                    departed = {
+                        issue['key']
+                        for departure_jql in departure_queries(filter_id, mirrored, state, started)
+                        for issue in PagedJql(departure_jql, DEPARTED_FIELDS)
+                    }
+
+            except Exception as e:
+
+                print(f"Failed to check for issues leaving JIRA filter {filter_id}, reloading it: {e}", file=sys.stderr)
+                full = True
+
+            if full:
+                issues = [_project(issue) for issue in PagedJql(f"filter = {filter_id}", MIRROR_FIELDS)]
+
+        with app.db.connect() as conn:
+            write_issues(conn, filter_id, issues, started, full, departed)
+
+        return len(issues)
+
+
+def sync_mirror():
+    """
+    Syncs every mirrored filter, run as a background job.
+    """
+    filter_ids = mirrored_filters()
+
+    for filter_number, filter_id in enumerate(filter_ids, start=1):
+        sync_filter(filter_id)
+        report_progress(filter_number, len(filter_ids))
+
+
+def mirrored_issues(filter_id):
+    """
+    Returns a filter's issues from the mirror, syncing it first if it's older
+    than JIRA_MIRROR_MAX_AGE. If that sync fails the older copy is used.
+    """
+    with app.db.connect() as conn:
+        state = read_state(conn, filter_id)
+
+    if _stale(state, _now()):
+
+        try:
+            sync_filter(filter_id)
+
+        except Exception as e:
+
+            if state is None:
+                raise
+
+            print(f"Failed to sync JIRA filter {filter_id}, using the mirror from {state[0]}: {e}", file=sys.stderr)
+
+    with app.db.connect() as conn:
+        return read_issues(conn, filter_id)
+
+
+class MirroredJql:
+    """
+    A drop-in for PagedJql over 'filter = N' which reads the filter from the
+    mirror. JIRA is searched directly if the mirror is switched off or the
+    database can't be used.
+    """
+
+    def __init__(self, filter_id, fields):
+        """
+        Args:
+        filter_id: The JIRA filter id
+        fields: The fields needed, used when searching JIRA directly
+        """
+        self.filter_id  = str(filter_id)
+        self.fields     = fields
+        self.total      = None
+
+    def __iter__(self):
+        issues = None
+
+        if app.JIRA_MIRROR:
+
+            try:
+                issues = mirrored_issues(self.filter_id)
+
+            except Exception as e:
+
+                print(f"JIRA mirror unavailable, searching filter {self.filter_id} directly: {e}", file=sys.stderr)
+
+        if issues is None:
+
+            live = PagedJql(f"filter = {self.filter_id}", self.fields)
+            for issue in live:
+                self.total = live.total
+                yield issue
+
+            return
+
+        self.total = len(issues)
+        yield from issues
+
+
+def _async_filter_lock(filter_id):
+    return _async_filter_locks.setdefault(filter_id, asyncio.Lock())
+
+
+async def sync_filter_async(filter_id):
+    """
+    The asyncio equivalent of sync_filter.
+    """
+    async with _async_filter_lock(filter_id):
+
+        started = _now()
+        state = await app.async_db.run(read_state, filter_id)
+        mirrored = await app.async_db.run(read_keys, filter_id)
+
+        jql, full = sync_query(filter_id, state, started)
+        issues = [_project(issue) async for issue in AsyncPagedJql(jql, MIRROR_FIELDS)]
+        departed = set()
+
+        if not full:
+
+            full = any(issue['key'] not in mirrored for issue in issues)
+
+            try:
+                if not full:
+                    for departure_jql in departure_queries(filter_id, mirrored, state, started):
+                        departed.update([issue['key'] async for issue in AsyncPagedJql(departure_jql, DEPARTED_FIELDS)])
+
+            except Exception as e:
+
+                print(f"Failed to check for issues leaving JIRA filter {filter_id}, reloading it: {e}", file=sys.stderr)
+                full = True
+
+            if full:
+                issues = [_project(issue) async for issue in AsyncPagedJql(f"filter = {filter_id}", MIRROR_FIELDS)]
+
+        await app.async_db.run(write_issues, filter_id, issues, started, full, departed)
+
+        return len(issues)
+
+
+async def sync_mirror_async():
+    """
+    The asyncio equivalent of sync_mirror.
+    """
+    filter_ids = mirrored_filters()
+
+    for filter_number, filter_id in enumerate(filter_ids, start=1):
+        await sync_filter_async(filter_id)
+        report_progress(filter_number, len(filter_ids))
+
+
+async def mirrored_issues_async(filter_id):
+    """
+    The asyncio equivalent of mirrored_issues.
+    """
+    state = await app.async_db.run(read_state, filter_id)
+
+    if _stale(state, _now()):
+
+        try:
+            await sync_filter_async(filter_id)
+
+        except Exception as e:
+
+            if state is None:
+                raise
+
+            print(f"Failed to sync JIRA filter {filter_id}, using the mirror from {state[0]}: {e}", file=sys.stderr)
+
+    return await app.async_db.run(read_issues, filter_id)
+
+
+class AsyncMirroredJql(MirroredJql):
+    """
+    The asyncio equivalent of MirroredJql, iterated with async for.
+    """
+
+    async def __aiter__(self):
+        issues = None
+
+        if app.JIRA_MIRROR:
+
+            try:
+                issues = await mirrored_issues_async(self.filter_id)
+
+            except Exception as e:
+
+                print(f"JIRA mirror unavailable, searching filter {self.filter_id} directly: {e}", file=sys.stderr)
+
+        if issues is None:
+
+            live = AsyncPagedJql(f"filter = {self.filter_id}", self.fields)
+            async for issue in live:
+                self.total = live.total
+                yield issue
+
+            return
+
+        self.total = len(issues)
+        for issue in issues:
+            yield issue
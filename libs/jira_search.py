@@ -0,0 +1,75 @@
+"""
+    jira_search.py -    Lazily pages through the results of a JQL search,
+                        asking JIRA only for the fields the caller needs.
+                        AsyncPagedJql does the same with app.async_jira
+"""
+
+import app
+
+# The fields each publisher actually reads, everything else is left in JIRA
+AGENDA_FIELDS       = ["summary", "creator"]
+SCORECARD_FIELDS    = ["summary", "assignee", "status"]
+ADR_FIELDS          = ["summary", "assignee", "customfield_10383", "customfield_10241"]
+
+# The fields kept for each issue in the JIRA mirror, enough for the agenda and scorecard
+MIRROR_FIELDS       = ["summary", "creator", "assignee", "status", "updated"]
+
+
+class PagedJql:
+    """
+    An iterable over every issue matching a JQL search. Pages are fetched
+    as they are needed, so the first issues can be used before the last
+    page has arrived and only one page is held at a time.
+    """
+
+    def __init__(self, jql, fields, page_size=None):
+        """
+        Args:
+        jql: The JQL to search with
+        fields: The list of fields to return for each issue
+        page_size: The number of issues per request, defaults to JIRA_PAGE_SIZE
+        """
+        self.jql        = jql
+        self.fields     = fields
+        self.page_size  = page_size or app.JIRA_PAGE_SIZE
+        self.total      = None
+
+    def __iter__(self):
+        start = 0
+
+        while True:
+
+            page = app.jira.jql(self.jql, fields=self.fields, start=start, limit=self.page_size)
+            issues = page.get('issues', [])
+            self.total = page.get('total', start + len(issues))
+
+            yield from issues
+
+            start += len(issues)
+
+            # Stop once we've seen everything, or JIRA returns an empty page
+            if not issues or start >= self.total:
+                return
+
+
+class AsyncPagedJql(PagedJql):
+    """
+    The asyncio equivalent of PagedJql, iterated with async for.
+    """
+
+    async def __aiter__(self):
+        start = 0
+
+        while True:
+
+            page = await app.async_jira.jql(self.jql, fields=self.fields, start=start, limit=self.page_size)
+            issues = page.get('issues', [])
+            self.total = page.get('total', start + len(issues))
+
+            for issue in issues:
+                yield issue
+
+            start += len(issues)
+
+            if not issues or start >= self.total:
+                return
@@ -0,0 +1,290 @@
+"""
+    jobs.py -   A small in-process job queue, which allows the slower
+                webhooks to be accepted straight away and then worked
+                through by a bounded pool of background workers.
+
+                Under asgi.py jobs are coroutines instead, run as asyncio
+                tasks with a bound on how many run at once.
+"""
+
+import sys
+import time
+import uuid
+import queue
+import asyncio
+import threading
+import traceback
+import contextvars
+from collections import OrderedDict
+import app
+from libs.metrics import JOB_DURATION
+
+# The states a job moves through, in order.
+JOB_QUEUED      = "queued"
+JOB_RUNNING     = "running"
+JOB_SUCCEEDED   = "succeeded"
+JOB_FAILED      = "failed"
+
+# Shared state for the queue, the worker threads and the job history.
+_job_queue      = None
+_job_history    = OrderedDict()
+_job_lock       = threading.Lock()
+_job_workers    = []
+
+# The job being run, per worker thread or asyncio task
+_current_job    = contextvars.ContextVar("current_job", default=None)
+
+# Shared state for jobs run as asyncio tasks
+_async_slots    = None
+_async_waiting  = 0
+_async_tasks    = set()
+
+
+class Job:
+    """
+    A single unit of background work and its current status.
+    """
+
+    def __init__(self, name, func, args, kwargs):
+        self.job_id     = uuid.uuid4().hex
+        self.name       = name
+        self.func       = func
+        self.args       = args
+        self.kwargs     = kwargs
+        self.state      = JOB_QUEUED
+        self.created    = time.time()
+        self.started    = None
+        self.finished   = None
+        self.progress   = {"done": 0, "total": None}
+        self.result     = None
+        self.error      = None
+
+    def to_dict(self):
+        """
+        Returns a JSON friendly summary of the job for the status end-point.
+        """
+        return {
+            "job_id": self.job_id,
+            "name": self.name,
+            "state": self.state,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "progress": dict(self.progress),
+            "result": self.result,
+            "error": self.error
+        }
+
+
+def _start_workers():
+    """
+    Lazily creates the queue and the worker threads. This happens on first
+    use, so each gunicorn worker process gets its own threads after forking.
+    """
+    global _job_queue
+
+    with _job_lock:
+        if _job_queue is None:
+            _job_queue = queue.Queue(maxsize=app.JOB_QUEUE_SIZE)
+
+            for worker_number in range(app.JOB_WORKERS):
+                worker = threading.Thread(
+                    target=_run_worker,
+                    name=f"archibot-job-worker-{worker_number}",
+                    daemon=True
+                )
+                worker.start()
+                _job_workers.append(worker)
+
+    return _job_queue
+
+
+def _run_job(job):
+    """
+    Marks a job as running, and returns the context token for it.
+    """
+    job.state   = JOB_RUNNING
+    job.started = time.time()
+
+    return _current_job.set(job)
+
+
+def _job_failed(job, e):
+    print(f"Job {job.job_id} ({job.name}) failed: {e}", file=sys.stderr)
+    traceback.print_exc(file=sys.stderr)
+    job.error = str(e)
+    job.state = JOB_FAILED
+
+
+def _job_finished(job, token):
+    job.finished = time.time()
+    JOB_DURATION.observe(job.finished - job.started, job.name, job.state)
+    _current_job.reset(token)
+
+
+def _run_worker():
+    """
+    The body of each worker thread, runs jobs from the queue forever.
+    """
+    while True:
+        job = _job_queue.get()
+        token = _run_job(job)
+
+        try:
+            job.result = job.func(*job.args, **job.kwargs)
+
+        except Exception as e:
+
+            _job_failed(job, e)
+
+        else:
+
+            job.state = JOB_SUCCEEDED
+
+        finally:
+
+            _job_finished(job, token)
+            _job_queue.task_done()
+
+
+def _remember_job(job):
+    """
+    Adds a job to the history used by the status end-point.
+    """
+    with _job_lock:
+        _job_history[job.job_id] = job
+
+        # Only a bounded number of jobs are remembered, oldest finished first.
+        while len(_job_history) > app.JOB_HISTORY_SIZE:
+            oldest_id = next(iter(_job_history))
+            if _job_history[oldest_id].state in (JOB_QUEUED, JOB_RUNNING):
+                break
+            _job_history.popitem(last=False)
+
+
+def submit_job(name, func, *args, **kwargs):
+    """
+    Places a function on the queue to be run by one of the background workers.
+
+    Args:
+    name: A friendly name for the job, shown by the status end-point
+    func: The function to run, followed by its arguments
+
+    Returns:
+    The queued Job, raises queue.Full if the queue has no space left.
+    """
+
+    job_queue = _start_workers()
+    job = Job(name, func, args, kwargs)
+
+    # Register the job before queueing it so the status is always available.
+    _remember_job(job)
+
+    try:
+        job_queue.put_nowait(job)
+
+    except queue.Full:
+
+        with _job_lock:
+            _job_history.pop(job.job_id, None)
+        raise
+
+    return job
+
+
+async def _run_async_job(job):
+    """
+    Runs a coroutine job once one of the ASYNC_JOB_CONCURRENCY slots is free.
+    """
+    global _async_waiting
+
+    waiting = True
+
+    try:
+        async with _async_slots:
+            _async_waiting -= 1
+            waiting = False
+            token = _run_job(job)
+
+            try:
+                job.result = await job.func(*job.args, **job.kwargs)
+
+            except Exception as e:
+
+                _job_failed(job, e)
+
+            else:
+
+                job.state = JOB_SUCCEEDED
+
+            finally:
+
+                _job_finished(job, token)
+
+    except asyncio.CancelledError:
+
+        # The event loop is shutting down
+        if waiting:
+            _async_waiting -= 1
+        job.error = "Cancelled"
+        job.state = JOB_FAILED
+        raise
+
+
+def submit_job_async(name, func, *args, **kwargs):
+    """
+    The asyncio equivalent of submit_job, called from the event loop.
+
+    Args:
+    name: A friendly name for the job, shown by the status end-point
+    func: The coroutine function to run, followed by its arguments
+
+    Returns:
+    The queued Job, raises queue.Full if JOB_QUEUE_SIZE jobs are already waiting.
+    """
+    global _async_slots, _async_waiting
+
+    if _async_slots is None:
+        _async_slots = asyncio.Semaphore(app.ASYNC_JOB_CONCURRENCY)
+
+    if _async_waiting >= app.JOB_QUEUE_SIZE:
+        raise queue.Full
+
+    job = Job(name, func, args, kwargs)
+    _remember_job(job)
+    _async_waiting += 1
+
+    # Keep a reference, the event loop only holds tasks weakly
+    task = asyncio.get_running_loop().create_task(_run_async_job(job))
+    _async_tasks.add(task)
+    task.add_done_callback(_async_tasks.discard)
+
+    return job
+
+
+def get_job(job_id):
+    """
+    Looks up a job by its id, returning None if it isn't known.
+    """
+    with _job_lock:
+        return _job_history.get(job_id)
+
+
+def queue_depth():
+    """
+    Returns the number of jobs waiting for a worker.
+    """
+    return (0 if _job_queue is None else _job_queue.qsize()) + _async_waiting
+
+
+def report_progress(done, total=None):
+    """
+    Updates the progress of the job running on the current thread or task,
+    this is a no-op when the caller is not running as a background job.
+    """
+    job = _current_job.get()
+
+    if job is not None:
+        job.progress["done"] = done
+        if total is not None:
+            job.progress["total"] = total
@@ -0,0 +1,206 @@
+"""
+    message_builder.py -    Packs the blocks rendered from many templates
+                            into as few Slack messages as Slack allows,
+                            keeping them in the order they were added.
+"""
+
+import copy
+import json
+from libs.slack_dispatch import post_message
+from libs.slack_dispatch import post_message_async
+
+# Slack's documented limits for a single message and its blocks.
+MAX_BLOCKS_PER_MESSAGE  = 50
+MAX_MESSAGE_CHARS       = 40000
+BLOCK_TEXT_LIMITS       = {
+    "header": 150,
+    "section": 3000,
+    "context": 3000
+}
+BUTTON_TEXT_LIMIT       = 75
+ELLIPSIS                = "…"
+
+
+def _clip(text, limit):
+    """
+    Trims a string to fit within a Slack text limit.
+    """
+    if len(text) <= limit:
+        return text
+    return text[0:limit - len(ELLIPSIS)] + ELLIPSIS
+
+
+def _needs_clipping(block):
+    """
+    Works out whether any of the text in a block is over Slack's limits.
+    """
+    limit = BLOCK_TEXT_LIMITS.get(block.get("type"))
+
+    if limit is not None:
+
+        if isinstance(block.get("text"), dict) and len(str(block["text"].get("text", ""))) > limit:
+            return True
+
+        for element in block.get("elements", []):
+            if isinstance(element, dict) and len(str(element.get("text", ""))) > limit:
+                return True
+
+    accessory = block.get("accessory")
+    if isinstance(accessory, dict) and accessory.get("type") == "button":
+        return len(accessory["text"]["text"]) > BUTTON_TEXT_LIMIT
+
+    return False
+
+
+def clip_block(block):
+    """
+    Trims the text of a single block so that Slack won't reject the message.
+
+    Args:
+    block: A Block Kit block, as a dict
+
+    Returns:
+    The block, or a trimmed copy of it where a limit was exceeded. Rendered
+    templates share their static parts, so blocks are never changed in place.
+    """
+    if not _needs_clipping(block):
+        return block
+
+    block = copy.deepcopy(block)
+    limit = BLOCK_TEXT_LIMITS.get(block.get("type"))
+
+    if limit is not None:
+
+        if isinstance(block.get("text"), dict) and isinstance(block["text"].get("text"), str):
+            block["text"]["text"] = _clip(block["text"]["text"], limit)
+
+        for element in block.get("elements", []):
+            if isinstance(element, dict) and isinstance(element.get("text"), str):
+                element["text"] = _clip(element["text"], limit)
+
+    accessory = block.get("accessory")
+    if isinstance(accessory, dict) and accessory.get("type") == "button":
+        accessory["text"]["text"] = _clip(accessory["text"]["text"], BUTTON_TEXT_LIMIT)
+
+    return block
+
+
+def pack_blocks(block_groups, max_blocks=MAX_BLOCKS_PER_MESSAGE, max_chars=MAX_MESSAGE_CHARS):
+    """
+    Packs groups of blocks into messages. A group (normally the output of one
+    template) is only split across messages when it is too big for one alone.
+
+    Args:
+    block_groups: An iterable of lists of blocks, in posting order
+
+    Returns:
+    A generator of lists of blocks, one list per message.
+    """
+    message, message_chars = [], 0
+
+    for group in block_groups:
+
+        group = [clip_block(block) for block in group]
+        group_chars = sum(len(json.dumps(block)) for block in group)
+
+        # Start a new message if this group won't fit in the current one
+        if message and (len(message) + len(group) > max_blocks or message_chars + group_chars > max_chars):
+            yield message
+            message, message_chars = [], 0
+
+        for block in group:
+
+            block_chars = len(json.dumps(block))
+
+            # Only reached for groups which are too large for a message of their own
+            if message and (len(message) == max_blocks or message_chars + block_chars > max_chars):
+                yield message
+                message, message_chars = [], 0
+
+            message.append(block)
+            message_chars += block_chars
+
+    if message:
+        yield message
+
+
+class MessageBuilder:
+    """
+    Collects blocks for a channel and posts them in as few messages as
+    possible. Messages are posted as soon as they are full, so only one
+    message is ever held in memory.
+    """
+
+    def __init__(self, channel, text, max_blocks=MAX_BLOCKS_PER_MESSAGE, max_chars=MAX_MESSAGE_CHARS):
+        self.channel        = channel
+        self.text           = text
+        self.max_blocks     = max_blocks
+        self.max_chars      = max_chars
+        self.messages_sent  = 0
+        self._pending       = []
+
+    def _complete_messages(self, blocks):
+        """
+        Adds the blocks from a single template and returns the messages
+        which are now full, keeping the last one back for more blocks.
+        """
+        self._pending.append(blocks)
+
+        # Everything but the last packed message is complete and can be posted
+        messages = list(pack_blocks(self._pending, self.max_blocks, self.max_chars))
+        self._pending = [messages[-1]] if messages else []
+
+        return messages[0:-1]
+
+    def _remaining_messages(self):
+        """
+        Returns every message still to be posted, emptying the builder.
+        """
+        messages = list(pack_blocks(self._pending, self.max_blocks, self.max_chars))
+        self._pending = []
+
+        return messages
+
+    def add(self, blocks):
+        """
+        Adds the blocks from a single template, posting any messages which
+        have been filled up.
+        """
+        for message in self._complete_messages(blocks):
+            self._post(message)
+
+    def flush(self):
+        """
+        Posts whatever is left over, call this once all blocks are added.
+        """
+        for message in self._remaining_messages():
+            self._post(message)
+
+        return self.messages_sent
+
+    def _post(self, blocks):
+        """
+        Sends a single packed message to Slack.
+        """
+        post_message(self.channel, blocks, self.text)
+        self.messages_sent += 1
+
+
+class AsyncMessageBuilder(MessageBuilder):
+    """
+    The asyncio equivalent of MessageBuilder, add() and flush() are awaited.
+    """
+
+    async def add(self, blocks):
+        for message in self._complete_messages(blocks):
+            await self._post(message)
+
+    async def flush(self):
+        for message in self._remaining_messages():
+            await self._post(message)
+
+        return self.messages_sent
+
+    async def _post(self, blocks):
+        await post_message_async(self.channel, blocks, self.text)
+        self.messages_sent += 1
@@ -0,0 +1,233 @@
+"""
+    message_ledger.py -     Remembers the Slack message posted for each ADR in
+                            each channel, along with a hash of its content, so
+                            that later publications edit that message in place
+                            or, if nothing has changed, leave it alone.
+"""
+
+import sys
+import json
+import hashlib
+import datetime
+import weakref
+import threading
+import sqlalchemy
+from slack_sdk.errors import SlackApiError
+import app
+from libs.slack_dispatch import post_message
+from libs.slack_dispatch import post_message_async
+from libs.slack_dispatch import update_message
+from libs.slack_dispatch import update_message_async
+
+SCHEMA_STATEMENT    = """
+    CREATE TABLE IF NOT EXISTS adr_messages (
+        issue_key VARCHAR(64) NOT NULL,
+        channel VARCHAR(64) NOT NULL,
+        ts VARCHAR(32) NOT NULL,
+        content_hash CHAR(64) NOT NULL,
+        updated_at DATETIME NOT NULL,
+        PRIMARY KEY (issue_key, channel)
+    )
+"""
+
+# What happened to each channel's message, as returned by publish_to_channel
+POSTED              = "posted"
+UPDATED             = "updated"
+UNCHANGED           = "unchanged"
+
+# Slack errors which mean the message we remembered can no longer be edited
+MESSAGE_GONE_ERRORS = ("message_not_found", "cant_update_message", "channel_not_found")
+
+# Publications of the same ADR in this process are run one at a time, so
+# two can't both decide to post a first message. A lock is dropped once
+# nothing holds or waits on it, so the table doesn't grow with every ADR
+_issue_locks        = weakref.WeakValueDictionary()
+_issue_locks_lock   = threading.Lock()
+
+
+def ensure_ledger_schema(engine):
+    """
+    Creates the ledger table if it doesn't already exist.
+    """
+    with engine.connect() as conn:
+        create_ledger_schema(conn)
+
+
+def create_ledger_schema(conn):
+    """
+    The body of ensure_ledger_schema, on an open connection.
+    """
+    conn.execute(sqlalchemy.text(SCHEMA_STATEMENT))
+    conn.commit()
+
+
+def content_hash(blocks, text):
+    """
+    Hashes a message's content, ignoring key order so equal content always
+    hashes the same.
+    """
+    content = json.dumps([blocks, text], sort_keys=True, separators=(",", ":"))
+
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def read_entries(conn, issue_key):
+    """
+    Returns the messages already posted for an ADR.
+
+    Returns:
+    {channel: (ts, content_hash)}
+    """
+    rows = conn.execute(
+        sqlalchemy.text("SELECT channel, ts, content_hash FROM adr_messages WHERE issue_key = :issue_key"),
+        {"issue_key": issue_key}
+    )
+
+    return {row.channel: (row.ts, row.content_hash) for row in rows}
+
+
+def write_entry(conn, issue_key, channel, ts, message_hash):
+    """
+    Records the message, and content, now in a channel for an ADR.
+    """
+    conn.execute(
+        sqlalchemy.text(
+            "INSERT INTO adr_messages (issue_key, channel, ts, content_hash, updated_at) "
+            "VALUES (:issue_key, :channel, :ts, :content_hash, :updated_at) "
+            "ON DUPLICATE KEY UPDATE ts = VALUES(ts), content_hash = VALUES(content_hash), "
+            "updated_at = VALUES(updated_at)"
+        ),
+        {
+            "issue_key": issue_key,
+            "channel": channel,
+            "ts": ts,
+            "content_hash": message_hash,
+            "updated_at": datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        }
+    )
+    conn.commit()
+
+
+def issue_lock(issue_key):
+    """
+    Returns the lock serialising publications of one ADR in this process.
+    """
+    with _issue_locks_lock:
+        return _issue_locks.setdefault(issue_key, threading.Lock())
+
+
+def read_ledger(issue_key):
+    """
+    Reads the entries for an ADR. Without the database every channel is
+    treated as new, which is how ADRs were published before the ledger.
+    """
+    try:
+        with app.db.connect() as conn:
+            return read_entries(conn, issue_key)
+
+    except Exception as e:
+
+        print(f"Message ledger unavailable, posting new messages for {issue_key}: {e}", file=sys.stderr)
+        return {}
+
+
+def _record(issue_key, channel, ts, message_hash):
+    try:
+        with app.db.connect() as conn:
+            write_entry(conn, issue_key, channel, ts, message_hash)
+
+    except Exception as e:
+
+        print(f"Failed to record the message for {issue_key} in {channel}: {e}", file=sys.stderr)
+
+
+def _message_gone(error):
+    return error.response.get("error") in MESSAGE_GONE_ERRORS
+
+
+def publish_to_channel(issue_key, channel, blocks, text, entry):
+    """
+    Posts, updates or skips an ADR's message in one channel.
+
+    Args:
+    issue_key: The JIRA key for the ADR
+    channel: The Slack channel id
+    blocks / text: The rendered message
+    entry: The (ts, content_hash) from the ledger, or None if never posted
+
+    Returns:
+    POSTED, UPDATED or UNCHANGED
+    """
+    message_hash = content_hash(blocks, text)
+
+    if entry is not None:
+
+        ts, previous_hash = entry
+        if previous_hash == message_hash:
+            return UNCHANGED
+
+        try:
+            update_message(channel, ts, blocks, text)
+            _record(issue_key, channel, ts, message_hash)
+            return UPDATED
+
+        except SlackApiError as e:
+
+            # Someone deleted the original, so start again with a new one
+            if not _message_gone(e):
+                raise
+
+    response = post_message(channel, blocks, text)
+    _record(issue_key, channel, response["ts"], message_hash)
+
+    return POSTED
+
+
+async def read_ledger_async(issue_key):
+    """
+    The asyncio equivalent of read_ledger.
+    """
+    try:
+        return await app.async_db.run(read_entries, issue_key)
+
+    except Exception as e:
+
+        print(f"Message ledger unavailable, posting new messages for {issue_key}: {e}", file=sys.stderr)
+        return {}
+
+
+async def _record_async(issue_key, channel, ts, message_hash):
+    try:
+        await app.async_db.run(write_entry, issue_key, channel, ts, message_hash)
+
+    except Exception as e:
+
+        print(f"Failed to record the message for {issue_key} in {channel}: {e}", file=sys.stderr)
+
+
+async def publish_to_channel_async(issue_key, channel, blocks, text, entry):
+    """
+    The asyncio equivalent of publish_to_channel.
+    """
+    message_hash = content_hash(blocks, text)
+
+    if entry is not None:
+
+        ts, previous_hash = entry
+        if previous_hash == message_hash:
+            return UNCHANGED
+
+        try:
+            await update_message_async(channel, ts, blocks, text)
+            await _record_async(issue_key, channel, ts, message_hash)
+            return UPDATED
+
+        except SlackApiError as e:
+
+            if not _message_gone(e):
+                raise
+
+    response = await post_message_async(channel, blocks, text)
+    await _record_async(issue_key, channel, response["ts"], message_hash)
+
+    return POSTED
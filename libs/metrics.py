@@ -0,0 +1,348 @@
+"""
+    metrics.py -    Counts and times what the app does, and what it waits
+                    on, and serves it from /metrics in the Prometheus text
+                    format. Each observation is a bisect and an increment
+                    under a lock, so this can stay on in production.
+
+                    Metrics are per process, so each gunicorn worker is
+                    scraped, or reports, on its own.
+"""
+
+import time
+import bisect
+import threading
+from flask import request, g, Response
+
+# Latency buckets, in seconds, from a cache hit to a slow JIRA search
+LATENCY_BUCKETS     = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Buckets for the number of Slack messages a single publish produces
+MESSAGE_BUCKETS     = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE        = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry           = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names, label_values, extra=""):
+    """
+    Formats a label set as {name="value",...}, escaping the values.
+    """
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    A histogram with a fixed set of buckets per combination of labels.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name           = name
+        self.documentation  = documentation
+        self.label_names    = tuple(label_names)
+        self.buckets        = tuple(buckets)
+        self._series        = {}
+        self._lock          = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """
+        Records a value, labels are given positionally in label_names order.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # One count per bucket plus +Inf, then the sum
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        """
+        Yields (sample name with labels, value) for the cumulative buckets,
+        sum and count of every series.
+        """
+        with self._lock:
+            series = {labels: list(counts) for labels, counts in self._series.items()}
+
+        for label_values, counts in sorted(series.items()):
+            cumulative = 0
+            for upper, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                bucket_label = 'le="' + _format_value(float(upper)) + '"'
+                yield f"{self.name}_bucket{_format_labels(self.label_names, label_values, bucket_label)}", cumulative
+            yield f"{self.name}_sum{_format_labels(self.label_names, label_values)}", counts[-1]
+            yield f"{self.name}_count{_format_labels(self.label_names, label_values)}", cumulative
+
+
+class Gauge:
+    """
+    A gauge whose values are read from a function when /metrics is scraped.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, label_names=(), collect=None):
+        """
+        Args:
+        collect: Returns {label values tuple: value} for every series
+        """
+        self.name           = name
+        self.documentation  = documentation
+        self.label_names    = tuple(label_names)
+        self._collectors    = [collect] if collect else []
+
+    def add_collector(self, collect):
+        """
+        Adds another function whose values are reported, e.g. one per engine.
+        """
+        self._collectors.append(collect)
+
+    def samples(self):
+        """
+        Yields (sample name with labels, value) from every collector.
+        """
+        for collect in self._collectors:
+            for label_values, value in sorted(collect().items()):
+                yield f"{self.name}{_format_labels(self.label_names, label_values)}", value
+
+
+class Counter(Gauge):
+    """
+    A counter whose values are read from a function when /metrics is
+    scraped, the function's values must only ever go up.
+    """
+
+    kind = "counter"
+
+
+def register(metric):
+    """
+    Adds a metric to those served by /metrics and returns it.
+    """
+    _registry.append(metric)
+    return metric
+
+
+def render():
+    """
+    Returns every registered metric in the Prometheus text format.
+    """
+    lines = []
+
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{sample} {_format_value(value)}" for sample, value in metric.samples())
+
+    return "\n".join(lines) + "\n"
+
+
+# The metrics the app records
+REQUEST_LATENCY     = register(Histogram(
+    "archibot_http_request_duration_seconds",
+    "Time taken to answer each Flask route",
+    ("route", "method", "status")
+))
+OUTBOUND_LATENCY    = register(Histogram(
+    "archibot_outbound_call_duration_seconds",
+    "Time taken by calls out to JIRA, Slack and the database",
+    ("dependency", "outcome")
+))
+POOL_CHECKOUT_WAIT  = register(Histogram(
+    "archibot_db_pool_checkout_wait_seconds",
+    "Time spent waiting for a database connection from the pool, including opening new ones"
+))
+POOL_CONNECTIONS    = register(Gauge(
+    "archibot_db_pool_connections",
+    "Database connections by state",
+    ("state",)
+))
+JOB_DURATION        = register(Histogram(
+    "archibot_job_duration_seconds",
+    "Time taken to run each background job",
+    ("job", "state")
+))
+PUBLISH_MESSAGES    = register(Histogram(
+    "archibot_publish_messages",
+    "The number of Slack messages posted by each publish",
+    ("publisher",),
+    buckets=MESSAGE_BUCKETS
+))
+
+
+def _slack_queue_depth():
+    # Imported here, both modules record their own metrics from this one
+    from libs.slack_dispatch import dispatcher
+    return {(): dispatcher.queue_depth()}
+
+
+def _job_queue_depth():
+    from libs.jobs import queue_depth
+    return {(): queue_depth()}
+
+
+SLACK_QUEUE_DEPTH   = register(Gauge(
+    "archibot_slack_dispatch_queue_depth",
+    "Slack API calls waiting for their rate limit",
+    collect=_slack_queue_depth
+))
+JOB_QUEUE_DEPTH     = register(Gauge(
+    "archibot_job_queue_depth",
+    "Background jobs waiting for a worker",
+    collect=_job_queue_depth
+))
+
+
+def time_call(dependency, func, *args, **kwargs):
+    """
+    Calls an outbound dependency and records how long it took, and whether
+    it raised.
+    """
+    started = time.perf_counter()
+    outcome = "error"
+
+    try:
+        result = func(*args, **kwargs)
+        outcome = "ok"
+        return result
+
+    finally:
+        OUTBOUND_LATENCY.observe(time.perf_counter() - started, dependency, outcome)
+
+
+async def time_call_async(dependency, func, *args, **kwargs):
+    """
+    The asyncio equivalent of time_call, for coroutine functions.
+    """
+    started = time.perf_counter()
+    outcome = "error"
+
+    try:
+        result = await func(*args, **kwargs)
+        outcome = "ok"
+        return result
+
+    finally:
+        OUTBOUND_LATENCY.observe(time.perf_counter() - started, dependency, outcome)
+
+
+def instrument_flask(flask_app):
+    """
+    Records the latency of every request to the Flask app, labelled by the
+    route pattern rather than the URL so ids don't create new series.
+    """
+
+    @flask_app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @flask_app.after_request
+    def _observe_request(response):
+        started = g.pop("metrics_started", None)
+
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            REQUEST_LATENCY.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+
+        return response
+
+
+class RequestMetricsMiddleware:
+    """
+    The ASGI equivalent of instrument_flask, wrapped around asgi.py
+    """
+
+    def __init__(self, asgi_app):
+        self.asgi_app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.asgi_app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = ["500"]
+
+        async def send_and_record_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = str(message["status"])
+            await send(message)
+
+        try:
+            await self.asgi_app(scope, receive, send_and_record_status)
+
+        finally:
+
+            # The router leaves the matched route in the scope
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_LATENCY.observe(time.perf_counter() - started, route, scope["method"], status[0])
+
+
+def instrument_engine(engine):
+    """
+    Records the time taken by each database statement, the wait for pool
+    connections and the number of connections in use.
+    """
+    import sqlalchemy
+
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def _start_statement(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+    def _observe_statement(conn, cursor, statement, parameters, context, executemany):
+        OUTBOUND_LATENCY.observe(time.perf_counter() - context._metrics_started, "db.execute", "ok")
+
+    @sqlalchemy.event.listens_for(engine, "handle_error")
+    def _observe_failed_statement(exception_context):
+        started = getattr(exception_context.execution_context, "_metrics_started", None)
+        if started is not None:
+            OUTBOUND_LATENCY.observe(time.perf_counter() - started, "db.execute", "error")
+
+    # SQLAlchemy has no event for the start of a checkout, so time the pool's own getter
+    pool = engine.pool
+    get_connection = pool._do_get
+
+    def _timed_do_get():
+        started = time.perf_counter()
+        try:
+            return get_connection()
+        finally:
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+    pool._do_get = _timed_do_get
+
+    def _pool_connections():
+        connections = {("in_use",): pool.checkedout()}
+        if hasattr(pool, "checkedin"):
+            connections[("idle",)] = pool.checkedin()
+        if hasattr(pool, "overflow"):
+            connections[("overflow",)] = max(pool.overflow(), 0)
+        return connections
+
+    POOL_CONNECTIONS.add_collector(_pool_connections)
+
+
+def metrics_response():
+    """
+    Serves the /metrics end-point.
+    """
+    return Response(render(), status=200, content_type=CONTENT_TYPE)
@@ -0,0 +1,321 @@
+"""
+    resilience.py -     Keeps a slow or failing dependency from taking the
+                        rest of the app down with it.
+
+                        Each of JIRA, Confluence and Slack gets a bulkhead,
+                        i.e. its own budget of calls in flight, and a circuit
+                        breaker. When a dependency's budget is spent, or it has
+                        failed repeatedly, calls to it fail straight away with
+                        DependencyUnavailable rather than tying up a worker.
+                        After a cool-off a single trial call is let through,
+                        and the breaker closes again once one succeeds.
+
+                        Per-call deadlines are the timeouts given to each client
+                        in app.py and asgi.py.
+"""
+
+import time
+import asyncio
+import threading
+import app
+from libs.metrics import register, Gauge, Counter
+
+# Circuit breaker states, and their values for /metrics
+CLOSED              = "closed"
+HALF_OPEN           = "half_open"
+OPEN                = "open"
+STATE_VALUES        = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_STATE       = register(Gauge(
+    "archibot_circuit_state",
+    "Circuit breaker state by dependency, 0 closed, 1 half open, 2 open",
+    ("dependency",)
+))
+BULKHEAD_IN_USE     = register(Gauge(
+    "archibot_bulkhead_in_use",
+    "Calls in flight to each dependency",
+    ("dependency",)
+))
+BULKHEAD_REJECTED   = register(Counter(
+    "archibot_dependency_rejected_total",
+    "Calls refused without being made, by dependency and reason",
+    ("dependency", "reason")
+))
+
+
+class DependencyUnavailable(Exception):
+    """
+    Raised instead of calling a dependency whose breaker is open or whose
+    bulkhead is full.
+    """
+
+    def __init__(self, dependency, reason):
+        super().__init__(f"{dependency} unavailable: {reason}")
+        self.dependency = dependency
+        self.reason     = reason
+
+
+def is_failure(error):
+    """
+    Decides whether an error says something about the health of the
+    dependency, rather than about our request. Timeouts, connection errors
+    and 5xx responses count, 4xx responses (including 429) don't.
+    """
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None) or getattr(error, "status", None)
+
+    if isinstance(status, int):
+        return status >= 500
+
+    return isinstance(error, (OSError, asyncio.TimeoutError))
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures. After reset_timeout
+    seconds one trial call is allowed through, which closes the breaker if
+    it succeeds or opens it for another reset_timeout if it fails.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold  = failure_threshold
+        self.reset_timeout      = reset_timeout
+        self.state              = CLOSED
+        self._failures          = 0
+        self._opened_at         = 0.0
+        self._lock              = threading.Lock()
+
+    def allow(self):
+        """
+        Returns True if a call may be made now.
+        """
+        with self._lock:
+
+            if self.state == CLOSED:
+                return True
+
+            # Only one trial call at a time
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                return True
+
+            return False
+
+    def cancel(self):
+        """
+        Hands back a trial call which was never made, so the next caller
+        can have it.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def record(self, failed):
+        """
+        Records the outcome of a call allowed through by allow().
+        """
+        with self._lock:
+
+            if not failed:
+                self.state = CLOSED
+                self._failures = 0
+                return
+
+            self._failures += 1
+
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+
+
+class Dependency:
+    """
+    A bulkhead and circuit breaker for one outbound dependency.
+    """
+
+    def __init__(self, name, limit, failure_threshold, reset_timeout, bulkhead_wait):
+        """
+        Args:
+        name: The name used in errors and /metrics, e.g. jira
+        limit: The most calls in flight at once
+        failure_threshold / reset_timeout: As for CircuitBreaker
+        bulkhead_wait: How long, in seconds, a call waits for a free slot before failing
+        """
+        self.name           = name
+        self.limit          = limit
+        self.bulkhead_wait  = bulkhead_wait
+        self.breaker        = CircuitBreaker(failure_threshold, reset_timeout)
+        self.in_use         = 0
+        self.rejected       = {"open": 0, "full": 0}
+        self._slots         = threading.BoundedSemaphore(limit)
+        self._async_slots   = None
+        self._lock          = threading.Lock()
+
+    def _reject(self, reason):
+        with self._lock:
+            self.rejected[reason] += 1
+
+        return DependencyUnavailable(self.name, "circuit open" if reason == "open" else "too many calls in flight")
+
+    def _enter(self, acquired):
+        if not acquired:
+            raise self._reject("full")
+
+        with self._lock:
+            self.in_use += 1
+
+    def _exit(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def _record(self, error):
+        self.breaker.record(error is not None and is_failure(error))
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs) inside the bulkhead and breaker.
+        """
+        if not self.breaker.allow():
+            raise self._reject("open")
+
+        # A call which doesn't get a slot hasn't tested the dependency
+        try:
+            self._enter(self._slots.acquire(timeout=self.bulkhead_wait))
+        except DependencyUnavailable:
+            self.breaker.cancel()
+            raise
+
+        try:
+            result = func(*args, **kwargs)
+
+        except Exception as e:
+
+            self._record(e)
+            raise
+
+        finally:
+
+            self._exit()
+            self._slots.release()
+
+        self._record(None)
+        return result
+
+    def _async_semaphore(self):
+        # Created inside the event loop, the same limit applies to coroutines
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.limit)
+
+        return self._async_slots
+
+    async def call_async(self, func, *args, **kwargs):
+        """
+        The asyncio equivalent of call, for coroutine functions.
+        """
+        if not self.breaker.allow():
+            raise self._reject("open")
+
+        slots = self._async_semaphore()
+
+        try:
+            acquired = await asyncio.wait_for(slots.acquire(), self.bulkhead_wait)
+        except asyncio.TimeoutError:
+            acquired = False
+
+        try:
+            self._enter(acquired)
+        except DependencyUnavailable:
+            self.breaker.cancel()
+            raise
+
+        try:
+            result = await func(*args, **kwargs)
+
+        except Exception as e:
+
+            self._record(e)
+            raise
+
+        finally:
+
+            self._exit()
+            slots.release()
+
+        self._record(None)
+        return result
+
+
+class Guarded:
+    """
+    Wraps a client so every method call goes through a Dependency, e.g.
+    Guarded(Jira(...), "jira").jql(...). Coroutine methods are awaited
+    through call_async.
+    """
+
+    # Methods which tidy up locally, and must work even if the circuit is open
+    UNGUARDED = ("close",)
+
+    def __init__(self, client, dependency_name):
+        self._client            = client
+        self._dependency_name   = dependency_name
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+
+        if not callable(attribute) or name in self.UNGUARDED:
+            return attribute
+
+        dependency = get_dependency(self._dependency_name)
+
+        if asyncio.iscoroutinefunction(attribute):
+            async def guarded_async(*args, **kwargs):
+                return await dependency.call_async(attribute, *args, **kwargs)
+            return guarded_async
+
+        def guarded(*args, **kwargs):
+            return dependency.call(attribute, *args, **kwargs)
+        return guarded
+
+
+# One Dependency for each upstream, created on first use from the settings in app.py
+_dependencies       = {}
+_dependencies_lock  = threading.Lock()
+
+
+def get_dependency(name):
+    """
+    Returns the Dependency for jira, confluence or slack.
+    """
+    with _dependencies_lock:
+
+        if name not in _dependencies:
+            _dependencies[name] = Dependency(
+                name,
+                limit=app.DEPENDENCY_CONCURRENCY[name],
+                failure_threshold=app.BREAKER_FAILURES,
+                reset_timeout=app.BREAKER_RESET,
+                bulkhead_wait=app.BULKHEAD_WAIT
+            )
+
+        return _dependencies[name]
+
+
+def _circuit_states():
+    return {(name,): STATE_VALUES[dependency.breaker.state] for name, dependency in list(_dependencies.items())}
+
+
+def _in_use():
+    return {(name,): dependency.in_use for name, dependency in list(_dependencies.items())}
+
+
+def _rejected():
+    return {
+        (name, reason): count
+        for name, dependency in list(_dependencies.items())
+        for reason, count in dependency.rejected.items()
+    }
+
+
+CIRCUIT_STATE.add_collector(_circuit_states)
+BULKHEAD_IN_USE.add_collector(_in_use)
+BULKHEAD_REJECTED.add_collector(_rejected)
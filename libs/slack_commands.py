@@ -0,0 +1,121 @@
+"""
+    slack_commands.py -     The slash commands ArchiBot answers through Bolt.
+
+                            /adr search <terms>     Finds ADRs in the local index
+                            /adr <KEY>              Shows a single ADR
+
+                            Slack expects an ack within 3 seconds, so commands
+                            are acked straight away and answered by a lazy
+                            listener, which replies through response_url.
+"""
+
+import app
+from libs.template import render_template
+from libs.adr_index import adr_index
+
+USAGE               = "Usage: `/adr search <terms>` to find ADRs, or `/adr <KEY>` to show one"
+LOADING             = "The ADR index is still loading, please try again in a moment"
+
+
+def register_commands(bolt_app):
+    """
+    Adds the slash command listeners to a Bolt App.
+    """
+    bolt_app.command(app.ADR_COMMAND)(ack=_ack, lazy=[adr_command])
+
+
+def register_commands_async(bolt_app):
+    """
+    Adds the slash command listeners to a Bolt AsyncApp.
+    """
+    bolt_app.command(app.ADR_COMMAND)(ack=_ack_async, lazy=[adr_command_async])
+
+
+def _ack(ack):
+    ack()
+
+
+async def _ack_async(ack):
+    await ack()
+
+
+def _message(text):
+    return {
+        "response_type": "ephemeral",
+        "text": text,
+        "blocks": render_template("adr_search_message", {"%MESSAGE%": text})
+    }
+
+
+def _item_config(document):
+    return {
+        "%KEY%": document['key'],
+        "%STATUS%": document['status'],
+        "%AUTHOR%": document['author'],
+        "%VS_IMPACTED%": ",".join(document['value_streams']),
+        "%SUMMARY%": document['summary'],
+        "%LINK%": app.ATLASSIAN_API_ROOT+"/browse/"+document['key']
+    }
+
+
+def adr_response(text):
+    """
+    Answers an /adr command from the index.
+
+    Args:
+    text: Whatever followed the command
+
+    Returns:
+    The arguments for respond(), an ephemeral message
+    """
+    words = text.split()
+
+    if not words or words[0].lower() == "help":
+        return _message(USAGE)
+
+    if not adr_index.ready:
+        return _message(LOADING)
+
+    if words[0].lower() == "search":
+
+        terms = " ".join(words[1:])
+        total, documents = adr_index.search(terms, app.ADR_SEARCH_LIMIT)
+
+        if not documents:
+            return _message(f"No ADRs match '{terms}'")
+
+        summary = f"{total} ADRs match '{terms}'"
+        if total > len(documents):
+            summary += f", showing the newest {len(documents)}"
+        blocks = render_template("adr_search_message", {"%MESSAGE%": summary})
+
+        for document in documents:
+            blocks.extend(render_template("adr_search_item", _item_config(document)))
+
+        return {"response_type": "ephemeral", "text": summary, "blocks": blocks}
+
+    document = adr_index.get(words[0])
+    if document is None:
+        return _message(f"No ADR found for {words[0]}. {USAGE}")
+
+    return {
+        "response_type": "ephemeral",
+        "text": f"{document['key']}: {document['summary']}",
+        "blocks": render_template("adr_published", _item_config(document))
+    }
+
+
+def adr_command(command, respond):
+    """
+    Replies to /adr, run by Bolt after the ack.
+    """
+    adr_index.ensure_fresh()
+    respond(**adr_response(command.get("text") or ""))
+
+
+async def adr_command_async(command, respond):
+    """
+    The asyncio equivalent of adr_command.
+    """
+    adr_index.ensure_fresh_async()
+    await respond(**adr_response(command.get("text") or ""))
@@ -0,0 +1,250 @@
+"""
+    slack_dispatch.py -     The single route out to the Slack Web API. Calls
+                            are paced with per-method and per-channel token
+                            buckets, and wait their turn rather than failing
+                            when Slack tells us to slow down. Once paced they
+                            go through the slack bulkhead and circuit breaker.
+"""
+
+import sys
+import time
+import asyncio
+import threading
+from slack_sdk.errors import SlackApiError
+import app
+from libs.metrics import time_call
+from libs.metrics import time_call_async
+from libs.resilience import get_dependency
+
+# Approximate Slack tier limits, as (calls per second, burst size).
+# chat.postMessage is limited to roughly one message per second per
+# channel, with a workspace wide limit of several hundred per minute.
+METHOD_LIMITS           = {
+    "chat.postMessage": (5.0, 10),
+    "chat.update": (50 / 60, 5),
+    "chat.postEphemeral": (100 / 60, 10)
+}
+DEFAULT_METHOD_LIMIT    = (50 / 60, 5)
+CHANNEL_LIMIT           = (1.0, 3)
+
+# The number of times a rate limited call is retried before giving up.
+MAX_RATE_LIMIT_RETRIES  = 10
+
+
+class TokenBucket:
+    """
+    A token bucket which hands out reservations, so callers queue up in
+    the order they asked rather than racing each other for tokens.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate           = rate
+        self.burst          = burst
+        self.tokens         = float(burst)
+        self.updated        = time.monotonic()
+        self.blocked_until  = 0.0
+
+    def reserve(self, now):
+        """
+        Takes a token and returns how long the caller must wait to use it.
+        The bucket may go into debt, which is how the queue is formed.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+        return max(wait, self.blocked_until - now)
+
+    def block(self, now, seconds):
+        """
+        Stops the bucket handing out tokens for a while, used for Retry-After.
+        """
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class SlackDispatcher:
+    """
+    Paces every outbound Slack call and retries those which are rate limited.
+    """
+
+    def __init__(self):
+        self._lock              = threading.Lock()
+        self._method_buckets    = {}
+        self._channel_buckets   = {}
+        self._waiting           = 0
+
+    def _bucket(self, buckets, key, limit):
+        """
+        Returns the bucket for a key, creating it on first use.
+        """
+        if key not in buckets:
+            buckets[key] = TokenBucket(*limit)
+        return buckets[key]
+
+    def _reserve(self, method, channel):
+        """
+        Reserves a slot against the method and channel and returns the wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            method_limit = METHOD_LIMITS.get(method, DEFAULT_METHOD_LIMIT)
+            wait = self._bucket(self._method_buckets, method, method_limit).reserve(now)
+
+            if channel is not None:
+                wait = max(wait, self._bucket(self._channel_buckets, (method, channel), CHANNEL_LIMIT).reserve(now))
+
+            return wait
+
+    def _block(self, method, channel, seconds):
+        """
+        Applies a Retry-After to the method and channel.
+        """
+        with self._lock:
+            now = time.monotonic()
+            method_limit = METHOD_LIMITS.get(method, DEFAULT_METHOD_LIMIT)
+            self._bucket(self._method_buckets, method, method_limit).block(now, seconds)
+
+            if channel is not None:
+                self._bucket(self._channel_buckets, (method, channel), CHANNEL_LIMIT).block(now, seconds)
+
+    def queue_depth(self):
+        """
+        Returns the number of calls currently waiting to be sent.
+        """
+        return self._waiting
+
+    def _rate_limited(self, method, channel, error, attempt):
+        """
+        Decides whether a failed call should be retried, applying Slack's
+        Retry-After if so. Anything other than rate limiting is re-raised.
+        """
+        if error.response.status_code != 429 or attempt >= MAX_RATE_LIMIT_RETRIES:
+            raise error
+
+        headers = {k.lower(): v for k, v in error.response.headers.items()}
+        retry_after = float(headers.get("retry-after", 1))
+
+        print(f"Slack rate limited {method} for {channel}, retrying in {retry_after}s", file=sys.stderr)
+        self._block(method, channel, retry_after)
+
+    def dispatch(self, method, **kwargs):
+        """
+        Calls a Slack Web API method once the rate limits allow it.
+
+        Args:
+        method: The Slack method name, e.g. chat.postMessage
+        kwargs: The arguments for the method, as passed to the WebClient
+
+        Returns:
+        The SlackResponse from the WebClient.
+        """
+        channel     = kwargs.get("channel")
+        client_call = getattr(app.app.client, method.replace(".", "_"))
+        slack       = get_dependency("slack")
+        attempt     = 0
+
+        while True:
+
+            with self._lock:
+                self._waiting += 1
+
+            try:
+                wait = self._reserve(method, channel)
+                if wait > 0:
+                    time.sleep(wait)
+
+            finally:
+
+                with self._lock:
+                    self._waiting -= 1
+
+            try:
+                return slack.call(time_call, method.replace(".", "_"), client_call, **kwargs)
+
+            except SlackApiError as e:
+
+                self._rate_limited(method, channel, e, attempt)
+                attempt += 1
+
+    async def dispatch_async(self, method, **kwargs):
+        """
+        The asyncio equivalent of dispatch, using the AsyncWebClient of the
+        AsyncApp. The same buckets are used, so limits hold across both.
+        """
+        channel     = kwargs.get("channel")
+        client_call = getattr(app.async_app.client, method.replace(".", "_"))
+        slack       = get_dependency("slack")
+        attempt     = 0
+
+        while True:
+
+            with self._lock:
+                self._waiting += 1
+
+            try:
+                wait = self._reserve(method, channel)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+            finally:
+
+                with self._lock:
+                    self._waiting -= 1
+
+            try:
+                return await slack.call_async(time_call_async, method.replace(".", "_"), client_call, **kwargs)
+
+            except SlackApiError as e:
+
+                self._rate_limited(method, channel, e, attempt)
+                attempt += 1
+
+
+# The dispatcher is shared by everything in the process
+dispatcher = SlackDispatcher()
+
+
+def post_message(channel, blocks, text):
+    """
+    Posts a message to a Slack channel through the shared dispatcher.
+
+    Args:
+    channel: The Slack channel id
+    blocks: The Block Kit blocks for the message
+    text: The notification / fallback text
+
+    Returns:
+    The SlackResponse from the WebClient.
+    """
+    return dispatcher.dispatch("chat.postMessage", channel=channel, blocks=blocks, text=text)
+
+
+async def post_message_async(channel, blocks, text):
+    """
+    The asyncio equivalent of post_message.
+    """
+    return await dispatcher.dispatch_async("chat.postMessage", channel=channel, blocks=blocks, text=text)
+
+
+def update_message(channel, ts, blocks, text):
+    """
+    Replaces the content of a message we've already posted.
+
+    Args:
+    channel: The Slack channel id
+    ts: The ts of the original message
+    blocks / text: The new content
+
+    Returns:
+    The SlackResponse from the WebClient.
+    """
+    return dispatcher.dispatch("chat.update", channel=channel, ts=ts, blocks=blocks, text=text)
+
+
+async def update_message_async(channel, ts, blocks, text):
+    """
+    The asyncio equivalent of update_message.
+    """
+    return await dispatcher.dispatch_async("chat.update", channel=channel, ts=ts, blocks=blocks, text=text)
@@ -1,24 +1,189 @@
 """
     template.py     A few simple tools to make templating messages
-                    in this app a bit less terrible. 
+                    in this app a bit less terrible.
+
+                    Templates are read and parsed once, the placeholder
+                    locations are worked out up-front, and rendering then
+                    produces Block Kit structures directly without going
+                    anywhere near the filesystem.
 """
 
-def load_template(template_name, template_config):
+import os
+import re
+import json
+import glob
+import threading
+
+# Where the templates live, relative to the root of the app rather than the cwd
+TEMPLATE_DIR        = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+
+# Placeholders look like %NAME%
+PLACEHOLDER_PATTERN = re.compile(r"%[A-Z0-9_]+%")
+
+# The compiled templates, keyed by name, along with the mtime they were read at
+_registry           = {}
+_registry_lock      = threading.Lock()
+_registry_loaded    = False
+
+
+def _compile_string(text):
+    """
+    Splits a string into literal text and placeholders, or returns None if
+    there are no placeholders in it.
     """
-    Loads a given template, and performs text subsitutios based
-    on the provided configuration. 
+    segments = []
+    position = 0
 
-    Requires that the subsitutions are already expressed in the 
-    /template/file.json file.
+    for match in PLACEHOLDER_PATTERN.finditer(text):
+        if match.start() > position:
+            segments.append((False, text[position:match.start()]))
+        segments.append((True, match.group(0)))
+        position = match.end()
+
+    if not segments:
+        return None
+
+    if position < len(text):
+        segments.append((False, text[position:]))
+
+    return ("str", segments)
+
+
+def _compile_node(node):
+    """
+    Compiles part of a template. Parts without placeholders compile to None
+    and are shared between renders, only the containers leading down to a
+    placeholder are copied when rendering.
+    """
+    if isinstance(node, str):
+        return _compile_string(node)
+
+    if isinstance(node, (dict, list)):
+        items = node.items() if isinstance(node, dict) else enumerate(node)
+        dynamic = []
+
+        for key, value in items:
+            compiled = _compile_node(value)
+            if compiled is not None:
+                dynamic.append((key, compiled))
+
+        if not dynamic:
+            return None
+
+        return ("dict" if isinstance(node, dict) else "list", node, dynamic)
+
+    return None
+
+
+def _render_node(compiled, template_config):
+    """
+    Renders a compiled part of a template with the given substitutions.
+    """
+    if compiled[0] == "str":
+        return "".join(
+            str(template_config.get(text, text)) if is_placeholder else text
+            for is_placeholder, text in compiled[1]
+        )
+
+    node_type, original, dynamic = compiled
+    rendered = dict(original) if node_type == "dict" else list(original)
+
+    for key, child in dynamic:
+        rendered[key] = _render_node(child, template_config)
+
+    return rendered
+
+
+class Template:
+    """
+    A parsed template, with the location of each placeholder already known.
     """
 
-    with open(f'templates/{template_name}.json', 'r', encoding="utf-8") as file_data:
+    def __init__(self, name, content, mtime):
+        self.name       = name
+        self.mtime      = mtime
+        self.content    = content
+        self.compiled   = _compile_node(content)
 
-        file_content = file_data.read()
+    def render(self, template_config):
+        """
+        Renders the template to Block Kit blocks. Parts of the template
+        without placeholders are shared, so callers should copy before
+        changing them.
+        """
+        if self.compiled is None:
+            return list(self.content)
 
-        # Look through the subsitution config and make changes
-        for k, v in template_config.items():
+        return _render_node(self.compiled, template_config)
 
-            file_content = file_content.replace(k, v, 1)
 
-        return file_content
+def _read_template(path):
+    """
+    Reads and compiles a single template file.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    mtime = os.path.getmtime(path)
+
+    with open(path, 'r', encoding="utf-8") as file_data:
+        return Template(name, json.load(file_data), mtime)
+
+
+def reload_templates():
+    """
+    Reads any template which is new, or has changed on disk since it was
+    last read. This is done once on first use and may be called again to
+    pick up edits without a restart.
+
+    Returns:
+    The names of the templates which were (re)loaded.
+    """
+    global _registry_loaded
+
+    reloaded = []
+
+    with _registry_lock:
+        for path in glob.glob(os.path.join(TEMPLATE_DIR, "*.json")):
+            name = os.path.splitext(os.path.basename(path))[0]
+            existing = _registry.get(name)
+
+            if existing is None or existing.mtime != os.path.getmtime(path):
+                _registry[name] = _read_template(path)
+                reloaded.append(name)
+
+        _registry_loaded = True
+
+    return reloaded
+
+
+def get_template(template_name):
+    """
+    Returns the compiled template for a given name.
+    """
+    if not _registry_loaded:
+        reload_templates()
+
+    template = _registry.get(template_name)
+    if template is None:
+        raise KeyError(f"Unknown template: {template_name}")
+
+    return template
+
+
+def render_template(template_name, template_config):
+    """
+    Renders a given template, performing the substitutions in the
+    provided configuration, and returns the Block Kit blocks.
+
+    Requires that the subsitutions are already expressed in the
+    /template/file.json file.
+    """
+    return get_template(template_name).render(template_config)
+
+
+def load_template(template_name, template_config):
+    """
+    Renders a given template and returns it as a JSON string, kept for
+    callers which expect the original string based interface. Values are
+    escaped properly, unlike the old string replacement.
+    """
+    return json.dumps(render_template(template_name, template_config))
@@ -47,8 +47,16 @@ resource "google_cloud_run_v2_service" "default" {
   ingress   = "INGRESS_TRAFFIC_INTERNAL_LOAD_BALANCER"
 
   template {
+    # Background jobs, the event spool replayer and the ADR digest flusher run
+    # after the response is sent, so keep the CPU allocated and an instance up
+    scaling {
+      min_instance_count = 1
+    }
     containers {
       image = var.docker_image_location
+        resources {
+          cpu_idle = false
+        }
         env {
           name = "IMAGE_DETAILS"
           value = var.docker_image_location
@@ -61,6 +69,12 @@ resource "google_cloud_run_v2_service" "default" {
           name = "GOOGLE_APPLICATION_CREDENTIALS"
           value = "credentials.json"
         }
+        # Cloud Run's filesystem is held in memory and goes with the instance, so
+        # events are buffered in memory rather than spooled to disk, see README.md
+        env {
+          name = "EVENT_SPOOL_DIR"
+          value = ""
+        }
         startup_probe {
             initial_delay_seconds = 5
             timeout_seconds = 1